@@ -5,9 +5,16 @@ Created: 02-Jan-18 18:50
 License: MIT
 """
 
+from abc import ABCMeta, abstractmethod
 import paramiko
 import traceback
 import uuid
+import json
+import math
+import time
+import os
+import tempfile
+import shapely
 
 def get_event_stream_names(data_scheme):
     """
@@ -38,6 +45,25 @@ def map_datatastream(generator_id, data_unit, location, event_stream_definition)
     :return: JSON object
     """
 
+    observation = data_unit[0]["Observations"][0]
+    return map_observation(generator_id, observation['@iot.id'], observation['resultTime'],
+                           data_unit[0]['unitOfMeasurement']['symbol'], observation['result'], location,
+                           event_stream_definition)
+
+
+def map_observation(generator_id, observation_id, result_time, symbol, result, location, event_stream_definition):
+    """
+    maps a single observation into CEP default JSON format
+    :param generator_id: id of the generator
+    :param observation_id: SensorAPI observation id
+    :param result_time: result time of the observation
+    :param symbol: symbol of the unit of measurement
+    :param result: result of the observation
+    :param location: observation location as [x, y]
+    :param event_stream_definition: schema of event definition in processing engine as JSON
+    :return: JSON object
+    """
+
     # metadata = get_event_stream_names(event_stream_definition['metaData'])
     # correlation_data = get_event_stream_names(event_stream_definition['correlationData'])
     payload_data = get_event_stream_names(event_stream_definition['payloadData'])
@@ -49,15 +75,15 @@ def map_datatastream(generator_id, data_unit, location, event_stream_definition)
     event_stream = {
         "event": {
             "metaData": {
-                "observation_id": data_unit[0]["Observations"][0]['@iot.id'],
-                "result_time": data_unit[0]["Observations"][0]['resultTime'],
-                "symbol": data_unit[0]['unitOfMeasurement']['symbol']
+                "observation_id": observation_id,
+                "result_time": result_time,
+                "symbol": symbol
             },
             "correlationData": {
                 "event_id": generator_id
             },
             "payloadData": {
-                next(payload_names): data_unit[0]["Observations"][0]['result'],
+                next(payload_names): result,
                 "x_coord": location[0],
                 "y_coord": location[1]
             }
@@ -66,17 +92,93 @@ def map_datatastream(generator_id, data_unit, location, event_stream_definition)
     return event_stream
 
 
+def _json_number(value):
+    """ Encodes a number as JSON. NaN, infinity and None are encoded as null"""
+    if value is None or (isinstance(value, float) and not math.isfinite(value)):
+        return 'null'
+    return repr(value)
+
+
+class EventMapper:
+    """
+    Maps observations into CEP default JSON format. The mapper is compiled once per event stream definition and
+    converts whole batches of observations into events encoded as JSON bytes, ready to be posted.
+    Unlike map_datatastream(), the event_id of every event is the id of the generator
+    Attributes:
+        event_stream_definition: schema of event definition in processing engine as JSON
+        phenomenon: name of the payload attribute holding the result of the observations
+    """
+
+    def __init__(self, event_stream_definition):
+        self.event_stream_definition = event_stream_definition
+        self.phenomenon = next(iter(get_event_stream_names(event_stream_definition['payloadData'])))
+        self._template = '{"event": {"metaData": {"observation_id": %s, "result_time": %s, "symbol": %s}, ' \
+                         '"correlationData": {"event_id": %s}, ' \
+                         '"payloadData": {' + json.dumps(self.phenomenon) + ': %s, "x_coord": %s, "y_coord": %s}}}'
+
+    def map_store(self, store, generator_id):
+        """
+        Maps all rows of an observation store in one pass
+        :param store: ObservationStore
+        :param generator_id: id of the generator
+        :return: list of events, each encoded as JSON bytes
+        """
+        template = self._template
+        event_id = json.dumps(generator_id)
+        symbols = [json.dumps(symbol) for symbol in store.symbols]
+        results = [_json_number(result) for result in store.result.tolist()]
+        # ids may be strings (see ObservationStore). ISO times and unit symbols do not need escaping
+        return [(template % (json.dumps(observation_id), '"' + result_time + '"', symbols[unit], event_id, result,
+                             _json_number(x), _json_number(y))).encode()
+                for observation_id, result_time, unit, result, x, y in zip(store.observation_id.tolist(),
+                                                                           store.result_time_iso().tolist(),
+                                                                           store.unit.tolist(), results,
+                                                                           store.x.tolist(), store.y.tolist())]
+
+    def map_things(self, things, generator_id):
+        """
+        Maps Things with their latest observation, as returned by the Sensor API
+        :param things: iterable of Things with their Datastreams, Observations and Locations
+        :param generator_id: id of the generator
+        :return: list of events, each encoded as JSON bytes
+        """
+        template = self._template
+        event_id = json.dumps(generator_id)
+        events = []
+        for thing in things:
+            datastream = thing['Datastreams'][0]
+            observation = datastream['Observations'][0]
+            x, y = thing['Locations'][0]['location']['coordinates'][:2]
+            result = observation['result']
+            result = json.dumps(result) if isinstance(result, str) else _json_number(result)
+            events.append((template % (json.dumps(observation['@iot.id']), json.dumps(observation['resultTime']),
+                                       json.dumps(datastream['unitOfMeasurement']['symbol']), event_id, result,
+                                       _json_number(x), _json_number(y))).encode())
+        return events
+
+    @staticmethod
+    def encode_batch(events):
+        """
+        Joins encoded events into a JSON array
+        :param events: list of events encoded as JSON bytes
+        :return: bytes
+        """
+        return b'[' + b','.join(events) + b']'
+
+
 def define_stream(name, phenomenon, version, description=''):
     """
     Event stream definition in CEP format
     :param name: stream name, usually the same as the name of a Gevent
     :param phenomenon: name and data type (JSON data types) of a phenomenon associated with the stream.
     Ex. {"name": "temperature", "data type": "DOUBLE"}, or {"name": "wind_direction", "data type": "STING"}, etc.
+    A list of them defines a stream of composite events, with one attribute per phenomenon
     :param version: version of the stream. Ex. 1.0.0
     :param description: string describing the event. Optional
     :return: data stream definition in CEP format
     """
 
+    phenomena = phenomenon if isinstance(phenomenon, list) else [phenomenon]
     cep_stream = {
                     "name": name,
                     "version": version,
@@ -104,9 +206,9 @@ def define_stream(name, phenomenon, version, description=''):
                               ],
                     "payloadData": [
                                 {
-                                  "name": phenomenon["name"],
-                                  "type": phenomenon["data type"]
-                                },
+                                  "name": phenomenon_["name"],
+                                  "type": phenomenon_["data type"]
+                                } for phenomenon_ in phenomena] + [
                                 {
                                   "name": "x_coord",
                                   "type": "DOUBLE"
@@ -164,22 +266,76 @@ def map_stream_to_processor(stream_definition):
     return mapped_stream
 
 
-def cep_query(event_condition, in_alias, out_alias):
+_siddhi_operators = {'>': '>', '>=': '>=', '<': '<', '<=': '<=', '==': '==', '===': '==', '!=': '!=', '!==': '!='}
+
+
+def condition_to_siddhi(conditions, attributes=None):
+    """
+    Compile the JsonLogic conditions of an event definition into a Siddhi expression, walking nested and, or
+    and not statements
+    :param conditions: JsonLogic statement. Ex. {"and": [{">": ["Temperature", 25]}, {"<": ["Luminosity", 3]}]}
+    :param attributes: optional dictionary of phenomenon: attribute, to qualify phenomena with the alias of
+    their stream in joins. Ex. {"Temperature": "e1.Temperature"}
+    :return: expression (a string) in siddhiql. Ex. Temperature > 25 and Luminosity < 3
+    """
+    attributes = attributes or {}
+
+    def operand(argument, position):
+        if isinstance(argument, dict) and 'var' in argument:
+            return attributes.get(argument['var'], argument['var'])
+        elif isinstance(argument, str) and position == 0:  # phenomenon given first, ex. ["Temperature", 25]
+            return attributes.get(argument, argument)
+        elif isinstance(argument, bool):
+            return 'true' if argument else 'false'
+        elif isinstance(argument, str):
+            return "'" + argument + "'"
+        return str(argument)
+
+    def compile_(statement, nested):
+        operator, arguments = next(iter(statement.items()))
+        if operator in ('and', 'or'):
+            expression = (' ' + operator + ' ').join(compile_(argument, True) for argument in arguments)
+            return '(' + expression + ')' if nested and len(arguments) > 1 else expression
+        elif operator in ('!', 'not'):
+            return 'not (' + compile_(arguments[0] if isinstance(arguments, list) else arguments, False) + ')'
+        elif operator in _siddhi_operators:
+            return operand(arguments[0], 0) + ' ' + _siddhi_operators[operator] + ' ' + operand(arguments[1], 1)
+        raise ValueError('JsonLogic operator is not supported: %s' % operator)
+
+    return compile_(conditions, False)
+
+
+def _extent_filter(extent):
+    """
+    Siddhi expression selecting the events located in an extent, with geo:within of the geo extension of Siddhi.
+    The bounding box of the extent is checked first, as it is cheaper
+    :param extent: polygon, as WKT or a shapely geometry
+    """
+    if isinstance(extent, str):
+        extent = shapely.from_wkt(extent)
+    bounds = extent.bounds
+    return 'x_coord >= ' + repr(bounds[0]) + ' and x_coord <= ' + repr(bounds[2]) + \
+           ' and y_coord >= ' + repr(bounds[1]) + ' and y_coord <= ' + repr(bounds[3]) + \
+           " and geo:within(x_coord, y_coord, '" + shapely.to_geojson(extent) + "')"
+
+
+def cep_query(event_condition, in_alias, out_alias, extent=None):
     """
     Translate conditions in an event definition into a filter query
-    :param event_condition: event conditions in event definition file,
-    a tuple of the format: ('operator', ['phenomenon', value])
+    :param event_condition: event conditions in event definition file, a JsonLogic statement
+    or a tuple of the format: ('operator', ['phenomenon', value])
     :param in_alias: alias of the input stream
     :param out_alias: alias of the output stream
+    :param extent: optional polygon, as WKT or a shapely geometry. Only events located in the extent are selected,
+    for input streams shared by events with different extents
     :return: query (a string) in siddhiql
     """
 
-    # create key iterator
-    # i = event_condition.keys().__iter__()
-
-    filter_ = ''
-    operator = event_condition[0]
-    filter_ = event_condition[1][0] + ' ' + operator + ' ' + str(event_condition[1][1])
+    if not isinstance(event_condition, dict):
+        event_condition = {event_condition[0]: event_condition[1]}
+    filter_ = condition_to_siddhi(event_condition)
+    if extent is not None:
+        filter_ = '(' + filter_ + ') and ' + _extent_filter(extent)
 
     query = 'from ' + in_alias + ' [' + filter_ + '] select * ' \
         'insert into ' + out_alias
@@ -187,15 +343,143 @@ def cep_query(event_condition, in_alias, out_alias):
     return query
 
 
-def define_execution_plan(name, input_streams, output_stream, event_condition, description=''):
+def _variables(statement):
+    """ Phenomena compared in a JsonLogic statement"""
+    operator, arguments = next(iter(statement.items()))
+    if operator in ('and', 'or'):
+        return set().union(*(_variables(argument) for argument in arguments))
+    elif operator in ('!', 'not'):
+        return _variables(arguments[0] if isinstance(arguments, list) else arguments)
+    names = set()
+    for position, argument in enumerate(arguments):
+        if isinstance(argument, dict) and 'var' in argument:
+            names.add(argument['var'])
+        elif isinstance(argument, str) and position == 0:
+            names.add(argument)
+    return names
+
+
+def _has_operator(statement, operators):
+    """ True if a JsonLogic statement uses one of the operators, at any level"""
+    operator, arguments = next(iter(statement.items()))
+    if operator in operators:
+        return True
+    if operator in ('and', 'or'):
+        return any(_has_operator(argument, operators) for argument in arguments)
+    elif operator in ('!', 'not'):
+        return _has_operator(arguments[0] if isinstance(arguments, list) else arguments, operators)
+    return False
+
+
+def partial_condition(conditions, phenomena):
+    """
+    Condition on some of the phenomena of a composite event, which holds whenever the whole condition may hold.
+    Comparisons of the other phenomena are unknown, and the statement is simplified accordingly. Used as join
+    condition of the intermediate joins of cep_join_query, before all the phenomena are joined
+    :param conditions: JsonLogic statement. Ex. {"and": [{">": ["Temperature", 25]}, {"<": ["Luminosity", 3]}]}
+    :param phenomena: phenomena available. Ex. ['Temperature']
+    :return: JsonLogic statement, or None if nothing can be checked on the phenomena. Ex. {">": ["Temperature", 25]}
+    """
+
+    def bounds(statement):
+        # (condition which may be true, condition which is true for sure). True and False are constants
+        operator, arguments = next(iter(statement.items()))
+        if operator in ('and', 'or'):
+            parts = [bounds(argument) for argument in arguments]
+            return combine(operator, [part[0] for part in parts]), combine(operator, [part[1] for part in parts])
+        elif operator in ('!', 'not'):
+            may, must = bounds(arguments[0] if isinstance(arguments, list) else arguments)
+            return negate(must), negate(may)
+        elif _variables(statement) <= set(phenomena):
+            return statement, statement
+        return True, False
+
+    def combine(operator, parts):
+        absorbing = operator == 'or'  # True in a disjunction, False in a conjunction
+        if absorbing in parts:
+            return absorbing
+        parts = [part for part in parts if not isinstance(part, bool)]
+        if not parts:
+            return not absorbing
+        return parts[0] if len(parts) == 1 else {operator: parts}
+
+    def negate(statement):
+        return not statement if isinstance(statement, bool) else {'!': [statement]}
+
+    may = bounds(conditions)[0]
+    return None if isinstance(may, bool) else may
+
+
+def cep_join_query(event_condition, inputs, out_alias, window='1 min', extent=None):
+    """
+    Translate the conditions of a composite event into queries joining one input stream per phenomenon.
+    Events of every stream are kept in a time window, and the conditions are evaluated on the joined events, so
+    a composite event is detected by a single execution plan. More than two streams are joined in a chain of
+    inner streams (joined_2, joined_3, ...), carrying the phenomena joined so far. Intermediate joins are
+    restricted with the part of the conditions on the phenomena joined so far (see partial_condition).
+    Conditions with a disjunction may hold without some of the phenomena: streams are joined with full outer joins,
+    the phenomena without events are null, and the conditions are evaluated on the last inner stream
+    :param event_condition: event conditions in event definition file, a JsonLogic statement
+    :param inputs: list of (alias of an input stream, name of the phenomenon in the stream), at least two
+    :param out_alias: alias of the output stream. Its attributes are the phenomena, in the order of inputs
+    :param window: length of the time windows, in siddhiql. Ex. 1 min, 30 sec
+    :param extent: optional polygon of the events to join. See cep_query
+    :return: queries (a string) in siddhiql, separated by semicolons
+    """
+
+    outer = _has_operator(event_condition, ('or',))
+    location = '' if extent is None else '[' + _extent_filter(extent) + ']'
+    left_alias, left = 'e1', inputs[0][0] + location + '#window.time(' + window + ') as e1'
+    joined = [inputs[0][1]]
+    queries = []
+    for position, (alias, phenomenon) in enumerate(inputs[1:], 2):
+        right_alias = 'e' + str(position)
+        query = 'from ' + left + (' full outer join ' if outer else ' join ') + alias + location + \
+                '#window.time(' + window + ') as ' + right_alias
+        last = position == len(inputs) and not outer
+        condition = event_condition if last else partial_condition(event_condition, joined + [phenomenon])
+        if condition is not None:
+            attributes = {name: left_alias + '.' + name for name in joined}
+            attributes[phenomenon] = right_alias + '.' + phenomenon
+            query = query + ' on ' + condition_to_siddhi(condition, attributes)
+        # meta data, correlation data and location are those of the first stream, or of the right stream when
+        # there is no event in the left one (outer joins)
+        selection = []
+        for name in ['meta_observation_id', 'meta_result_time', 'meta_symbol', 'correlation_event_id'] + joined + \
+                [phenomenon, 'x_coord', 'y_coord']:
+            if name in joined:
+                source = left_alias + '.' + name
+            elif name == phenomenon:
+                source = right_alias + '.' + name
+            elif outer:
+                source = 'coalesce(' + left_alias + '.' + name + ', ' + right_alias + '.' + name + ')'
+            else:
+                source = left_alias + '.' + name
+            selection.append(source + ' as ' + name)
+        target = out_alias if last else 'joined_' + str(position)
+        queries.append(query + ' select ' + ', '.join(selection) + ' insert into ' + target)
+        joined.append(phenomenon)
+        left_alias = 'j' + str(position)
+        left = target + '#window.time(' + window + ') as ' + left_alias
+    if outer:
+        queries.append('from joined_' + str(len(inputs)) + ' [' + condition_to_siddhi(event_condition) + '] '
+                       'select * insert into ' + out_alias)
+
+    return ';\n            '.join(queries)
+
+
+def define_execution_plan(name, input_streams, output_stream, event_condition, description='', extent=None,
+                          window='1 min'):
     """
     Generates a text file describing a CEP execution plan. Execution plan define detection rules a  queries
     :param name: unique name for the execution plan. Alphanumeric, underscore (_) is allowed
     :param input_streams: a none empty list of stream definition
     :param output_stream: a single stream definition for collecting results from the event processor.
-    :param event_condition: event conditions in event definition file,
-    a tuple of the format: ('operator', ['phenomenon', value])
+    :param event_condition: event conditions in event definition file, a JsonLogic statement
+    or a tuple of the format: ('operator', ['phenomenon', value])
     :param description: unique description for the execution plan. Optional.
+    :param extent: optional polygon of the events to select, as WKT or a shapely geometry. See cep_query
+    :param window: time window in which the events of several input streams are joined. See cep_join_query
     :return: string defining a valid execution plan for the CEP engine
     """
 
@@ -218,6 +502,7 @@ def define_execution_plan(name, input_streams, output_stream, event_condition, d
         mapped_stream = map_stream_to_processor(stream)
         mapped_inputs = mapped_inputs + "@Import('" + stream_name + "') define stream " + alias + " " + mapped_stream + ";"
         input_aliases.append(alias)
+        idx += 1
 
     # mapping output stream
     output_alias = 'output_1'  # Common case is a single output stream
@@ -229,7 +514,11 @@ def define_execution_plan(name, input_streams, output_stream, event_condition, d
     else:
         plan_description = description
 
-    query = cep_query(event_condition, input_aliases[0], output_alias)
+    if len(input_streams) == 1:
+        query = cep_query(event_condition, input_aliases[0], output_alias, extent)
+    else:  # composite event, one input stream per phenomenon
+        inputs = [(alias, stream['payloadData'][0]['name']) for alias, stream in zip(input_aliases, input_streams)]
+        query = cep_join_query(event_condition, inputs, output_alias, window, extent)
 
     plan = """/* Enter a unique ExecutionPlan */
             @Plan:name('""" + name + """')
@@ -365,95 +654,318 @@ def generate_data_requirements(event_object):
 #     #         pass
 
 
-def upload_to_cep(file_path, file_object, cep_conf, handler_conf):
+_log_files = set()
+
+
+def _log_to_file(log_file):
+    """ Send paramiko logs to a file. The log handler is added only once per file"""
+    if log_file not in _log_files:
+        paramiko.util.log_to_file(log_file)
+        _log_files.add(log_file)
+
+
+class Deployer:
     """
-    Uploads a file from CEP hot directories, for http-receivers, event streams and execution plans
-    :param file_path: path  of the file that will be created in the CEP server
-    :param cep_conf: parameters to connect to server where cep is running. Parameters are define in the config.json file
-    :param handler_conf: parameter of the event handler, as defines in the config.json file
-    :param file_object: open file (or file-like object) containing a definition of a configuration file
-    :return: True on successful execution
+    Backend writing configuration files into the hot directories of the CEP server.
+    A deployer is used for all the files of a deployment or undeployment and closed afterwards.
+    Attributes:
+        cep_conf: parameters to connect to server where cep is running. Parameters are define in the config.json file
+        timings: seconds spent per phase
+        files: number of files uploaded and removed
     """
-    # log file
-    paramiko.util.log_to_file(handler_conf['logs'])
 
-    # host conf
-    port = cep_conf["port"]
-    hostname = cep_conf["hostname"]
-    username = cep_conf["username"]
-    passphrase = cep_conf["passphrase"]
-    key_file = cep_conf["private key"]
+    __metaclass__ = ABCMeta
+
+    def __init__(self, cep_conf):
+        self.cep_conf = cep_conf
+        self.handshakes = 0
+        self.timings = {"key": 0.0, "connect": 0.0, "upload": 0.0, "remove": 0.0}
+        self.files = {"upload": 0, "remove": 0}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback_):
+        self.close()
+
+    def stats(self):
+        """
+        :return: dictionary with the number of handshakes, files transferred and time spent per phase
+        """
+        return {"handshakes": self.handshakes, "files": dict(self.files), "timings": dict(self.timings)}
+
+    @abstractmethod
+    def put(self, file_object, file_path):
+        """
+        Creates a file
+        :param file_object: open file (or file-like object) containing a definition of a configuration file
+        :param file_path: path of the file in the CEP server
+        :return: True on successful execution
+        """
+        pass
+
+    @abstractmethod
+    def remove(self, file_path):
+        """
+        Deletes a file
+        :param file_path: path of the file in the CEP server
+        :return: True on successful execution
+        """
+        pass
+
+    @abstractmethod
+    def listdir(self, path):
+        """
+        :param path: directory in the CEP server
+        :return: list of file names in the directory
+        """
+        pass
+
+    def close(self):
+        """ Release the resources of the deployer"""
+        pass
+
+
+class SftpDeployer(Deployer):
+    """
+    SSH/SFTP session to the CEP server, shared by all the files of a deployment or undeployment.
+    The private key is loaded once, the connection is opened on first use and opened again only when it fails.
+    Attributes:
+        cep_conf: parameters to connect to server where cep is running. Parameters are define in the config.json file
+        handler_conf: parameter of the event handler, as defines in the config.json file
+        handshakes: number of SSH connections opened
+        timings: seconds spent per phase: loading the key, connecting (handshake and authentication),
+        uploading and removing files
+    """
 
-    try:
-        private_key = paramiko.RSAKey.from_private_key_file(key_file, passphrase)
-    except FileNotFoundError:
-        print('** file for primary key was not found in: %s' % key_file)
-    except ValueError:
-        print('** Passphrase is incorrect')
-    else:
+    def __init__(self, cep_conf, handler_conf):
+        Deployer.__init__(self, cep_conf)
+        self.handler_conf = handler_conf
+        self._key = None
+        self._transport = None
+        self._sftp = None
+        _log_to_file(handler_conf['logs'])
+
+    def sftp(self):
+        """
+        SFTP client of the session, connecting if needed
+        :return: paramiko.SFTPClient
+        """
+        if self._transport is None or not self._transport.is_active():
+            self._connect()
+        return self._sftp
+
+    def put(self, file_object, file_path):
+        """
+        Uploads a file
+        :param file_object: open file (or file-like object) containing a definition of a configuration file
+        :param file_path: path  of the file that will be created in the CEP server
+        :return: True on successful execution
+        """
+        position = file_object.tell()
+
+        def upload(sftp):
+            file_object.seek(position)
+            sftp.putfo(file_object, file_path)
+        return self._execute('upload', upload)
+
+    def remove(self, file_path):
+        """
+        Deletes a file
+        :param file_path: path to the file to be removed
+        :return: True on successful execution
+        """
+        return self._execute('remove', lambda sftp: sftp.remove(file_path))
+
+    def listdir(self, path):
+        """
+        :param path: directory in the CEP server
+        :return: list of file names in the directory
+        """
+        return self.sftp().listdir(path)
+
+    def close(self):
+        """ Close the SFTP channel and the SSH connection"""
         try:
-            t = paramiko.Transport((hostname, port))
-            t.connect(username=username, pkey=private_key)
-            sftp = paramiko.SFTPClient.from_transport(t)
-
-            # deployment: upload files
-            upload = sftp.putfo(file_object, file_path)
-            t.close()
-            return True
-
+            if self._sftp is not None:
+                self._sftp.close()
+            if self._transport is not None:
+                self._transport.close()
+        except Exception:
+            pass
+        self._sftp = None
+        self._transport = None
+
+    def _private_key(self):
+        if self._key is None:
+            start = time.perf_counter()
+            try:
+                self._key = paramiko.RSAKey.from_private_key_file(self.cep_conf["private key"],
+                                                                  self.cep_conf["passphrase"])
+            finally:
+                self.timings["key"] += time.perf_counter() - start
+        return self._key
+
+    def _connect(self):
+        self.close()
+        key = self._private_key()
+        start = time.perf_counter()
+        try:
+            self._transport = paramiko.Transport((self.cep_conf["hostname"], self.cep_conf["port"]))
+            self.handshakes += 1
+            self._transport.connect(username=self.cep_conf["username"], pkey=key)
+            self._sftp = paramiko.SFTPClient.from_transport(self._transport)
+        finally:
+            self.timings["connect"] += time.perf_counter() - start
+
+    def _execute(self, phase, operation):
+        """ Run an SFTP operation, connecting again and retrying once if the connection was lost"""
+        try:
+            sftp = self.sftp()
+        except FileNotFoundError:
+            print('** file for primary key was not found in: %s' % self.cep_conf["private key"])
+            return False
+        except ValueError:
+            print('** Passphrase is incorrect')
+            return False
         except Exception as e:
             print('***Caught exception: %s' % e.__class__)
-            print('here')
             traceback.print_exc()
+            self.close()
+            return False
+
+        for attempt in range(2):
+            start = time.perf_counter()
             try:
-                t.close()
-                return False
-            except:
+                operation(sftp)
+                self.files[phase] += 1
+                return True
+            except Exception as e:
+                if attempt == 0 and (self._transport is None or not self._transport.is_active()):
+                    try:
+                        sftp = self.sftp()  # connection lost: reconnect and retry
+                        continue
+                    except Exception:
+                        pass
+                print('***Caught exception: %s' % e.__class__)
+                traceback.print_exc()
                 return False
+            finally:
+                self.timings[phase] += time.perf_counter() - start
+        return False
 
 
-def remove_from_cep(file_path, cep_conf, handler_conf):
+class LocalDeployer(Deployer):
     """
-    Deletes a file from CEP hot directories, for http-receivers, event streams and execution plans
-    :param file_path: path to the file to be removed
-    :param cep_conf: parameters to connect to server where cep is running. Parameters are define in the config.json file
-    :param handler_conf: parameter of the event handler, as defines in the config.json file
-    :return: True on successful execution
+    Writes the configuration files directly into the hot directories of a CEP server running on the same host,
+    or reachable through a shared volume. No SSH connection is needed.
+    Files are written to a temporary file in the target directory and renamed, so the CEP server never reads a
+    partially written file.
+    Attributes:
+        cep_conf: parameters of the CEP server. Parameters are define in the config.json file
+        home_directory: local path of the home directory of the CEP server. Paths under the 'home directory' of
+        cep_conf are mapped to it. If None, paths are used as they are
     """
-    # log file
-    paramiko.util.log_to_file(handler_conf['logs'])
-
-    # host conf
-    port = cep_conf["port"]
-    hostname = cep_conf["hostname"]
-    username = cep_conf["username"]
-    passphrase = cep_conf["passphrase"]
-    key_file = cep_conf["private key"]
 
-    try:
-        private_key = paramiko.RSAKey.from_private_key_file(key_file, passphrase)
-    except FileNotFoundError:
-        print('** File for primary key was not found in: %s' % key_file)
-    except ValueError:
-        print('** Passphrase is incorrect')
-    else:
+    def __init__(self, cep_conf, home_directory=None):
+        Deployer.__init__(self, cep_conf)
+        self.home_directory = home_directory
+
+    def local_path(self, file_path):
+        """
+        :param file_path: path of a file in the CEP server
+        :return: path of the file in the local file system
+        """
+        remote_home = self.cep_conf.get("home directory", '')
+        if self.home_directory and remote_home and file_path.startswith(remote_home):
+            return self.home_directory + file_path[len(remote_home):]
+        return file_path
+
+    def put(self, file_object, file_path):
+        start = time.perf_counter()
+        path = self.local_path(file_path)
+        directory, name = os.path.split(path)
+        temp_path = None
         try:
-            t = paramiko.Transport((hostname, port))
-            t.connect(username=username, pkey=private_key)
-            sftp = paramiko.SFTPClient.from_transport(t)
-
-            # Delete file
-            upload = sftp.remove(file_path)
-            t.close()
+            content = file_object.read()
+            mode = 'wb' if isinstance(content, bytes) else 'w'
+            # hidden name and .tmp extension, ignored by the hot deployers of the CEP server
+            fd, temp_path = tempfile.mkstemp(prefix='.' + name, suffix='.tmp', dir=directory)
+            with os.fdopen(fd, mode) as fo:
+                fo.write(content)
+                fo.flush()
+                os.fsync(fo.fileno())
+            os.replace(temp_path, path)
+            self.files["upload"] += 1
             return True
-
         except Exception as e:
             print('***Caught exception: %s' % e.__class__)
-            print('here')
             traceback.print_exc()
-            try:
-                t.close()
-                return False
-            except:
-                return False
+            if temp_path is not None and os.path.exists(temp_path):
+                os.remove(temp_path)
+            return False
+        finally:
+            self.timings["upload"] += time.perf_counter() - start
+
+    def remove(self, file_path):
+        start = time.perf_counter()
+        try:
+            os.remove(self.local_path(file_path))
+            self.files["remove"] += 1
+            return True
+        except OSError as e:
+            print('***Caught exception: %s' % e.__class__)
+            traceback.print_exc()
+            return False
+        finally:
+            self.timings["remove"] += time.perf_counter() - start
+
+    def listdir(self, path):
+        return os.listdir(self.local_path(path))
 
+
+def get_deployer(cep_conf, handler_conf):
+    """
+    Creates the deployer defined by the 'deployer' parameter of the cep configuration: 'sftp' (default) or 'local'.
+    The 'local home directory' parameter gives the local path to the home directory of the CEP server
+    :param cep_conf: parameters to connect to server where cep is running. Parameters are define in the config.json file
+    :param handler_conf: parameter of the event handler, as defines in the config.json file
+    :return: Deployer
+    """
+    kind = cep_conf.get("deployer", "sftp")
+    if kind == "sftp":
+        return SftpDeployer(cep_conf, handler_conf)
+    elif kind == "local":
+        return LocalDeployer(cep_conf, cep_conf.get("local home directory") or None)
+    raise ValueError('Deployer is not supported: %s' % kind)
+
+
+def upload_to_cep(file_path, file_object, cep_conf, handler_conf, session=None):
+    """
+    Uploads a file from CEP hot directories, for http-receivers, event streams and execution plans
+    :param file_path: path  of the file that will be created in the CEP server
+    :param cep_conf: parameters to connect to server where cep is running. Parameters are define in the config.json file
+    :param handler_conf: parameter of the event handler, as defines in the config.json file
+    :param file_object: open file (or file-like object) containing a definition of a configuration file
+    :param session: Deployer to reuse. If None, a deployer is created for this file only
+    :return: True on successful execution
+    """
+    if session is not None:
+        return session.put(file_object, file_path)
+    with get_deployer(cep_conf, handler_conf) as session:
+        return session.put(file_object, file_path)
+
+
+def remove_from_cep(file_path, cep_conf, handler_conf, session=None):
+    """
+    Deletes a file from CEP hot directories, for http-receivers, event streams and execution plans
+    :param file_path: path to the file to be removed
+    :param cep_conf: parameters to connect to server where cep is running. Parameters are define in the config.json file
+    :param handler_conf: parameter of the event handler, as defines in the config.json file
+    :param session: Deployer to reuse. If None, a deployer is created for this file only
+    :return: True on successful execution
+    """
+    if session is not None:
+        return session.remove(file_path)
+    with get_deployer(cep_conf, handler_conf) as session:
+        return session.remove(file_path)
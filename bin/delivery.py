@@ -0,0 +1,274 @@
+"""
+Project: Formalizer. Delivery of events to CEP receivers through a bounded queue, with timeouts, retries with
+jittered backoff and a circuit breaker, so a slow or failing receiver does not block the generators
+License: MIT
+"""
+
+import queue
+import random
+import threading
+import time
+import requests
+from bin import gevent
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests to a receiver after consecutive failures. The circuit is 'closed' while the receiver
+    works, 'open' for reset_timeout seconds after failure_threshold consecutive failures, and then 'half-open':
+    a single probe request is let through, closing the circuit when it succeeds and opening it again when it fails
+    Attributes:
+        failure_threshold: number of consecutive failures opening the circuit
+        reset_timeout: seconds the circuit stays open before a probe request is allowed
+        state: 'closed', 'open' or 'half-open'
+        failures: current number of consecutive failures
+        opened: number of times the circuit was opened
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened = 0
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        :return: True if a request can be sent now
+        """
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = 'half-open'
+            if self.state == 'half-open' and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def retry_in(self):
+        """
+        :return: seconds until a request can be sent, 0 when the circuit is closed
+        """
+        with self._lock:
+            if self.state != 'open':
+                return 0.0
+            return max(self.reset_timeout - (time.monotonic() - self._opened_at), 0.0)
+
+    def record_success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half-open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    self.opened += 1
+                self.state = 'open'
+                self._opened_at = time.monotonic()
+            self._probing = False
+
+
+class DeliveryQueue:
+    """
+    Bounded queue of payloads (batches of events encoded as JSON) posted to a CEP receiver by worker threads.
+    Posts have a timeout and failed posts are retried with exponential backoff and full jitter. Payloads are
+    dropped when the queue is full, or when all their retries failed. While the circuit breaker is open, workers
+    wait instead of posting, and new payloads are dropped as the queue fills up.
+    Attributes:
+        receiver: URL of a receiver in the processing engine, or an in-process receiver of a local_cep.LocalCEP
+        max_queue: max number of payloads waiting to be posted
+        workers: number of threads posting payloads
+        timeout: (connect, read) timeouts of a post, in seconds
+        max_retries: max number of retries of a payload after its first post failed
+        backoff: base delay in seconds between retries. The delay before retry n is drawn uniformly
+        between 0 and min(max_backoff, backoff * 2 ** n)
+        max_backoff: max delay in seconds between retries
+        breaker: CircuitBreaker of the receiver
+        on_delivery: callable(events, status) called after a payload is delivered or given up; status is the
+        status code of the response or the last exception raised by the post
+    """
+
+    def __init__(self, receiver_endpoint, max_queue=1000, workers=4, timeout=(5, 30), max_retries=3, backoff=0.5,
+                 max_backoff=10, breaker=None, on_delivery=None):
+        self.receiver = receiver_endpoint
+        self.max_queue = max_queue
+        self.workers = workers
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.on_delivery = on_delivery
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._closed = threading.Event()
+        self._lock = threading.Lock()
+        self._stats = {"submitted": 0, "delivered": 0, "dropped": 0, "failed": 0, "retries": 0, "max depth": 0,
+                       "in flight": 0}
+        self._threads = [threading.Thread(target=self._work, name='delivery-' + str(i), daemon=True)
+                         for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    @classmethod
+    def from_config(cls, receiver_endpoint, delivery_conf, on_delivery=None):
+        """
+        :param receiver_endpoint: URL of a receiver, or an in-process receiver
+        :param delivery_conf: parameters of the delivery, as defined in the "delivery" section of the config.json file
+        :param on_delivery: see DeliveryQueue
+        :return: DeliveryQueue
+        """
+        breaker = CircuitBreaker(delivery_conf.get("failure threshold", 5), delivery_conf.get("reset timeout", 30))
+        return cls(receiver_endpoint, max_queue=delivery_conf.get("max queue", 1000),
+                   workers=delivery_conf.get("workers", 4),
+                   timeout=(delivery_conf.get("connect timeout", 5), delivery_conf.get("read timeout", 30)),
+                   max_retries=delivery_conf.get("max retries", 3), backoff=delivery_conf.get("backoff", 0.5),
+                   max_backoff=delivery_conf.get("max backoff", 10), breaker=breaker, on_delivery=on_delivery)
+
+    def submit(self, payload, size=1, on_done=None):
+        """
+        Queue a payload without blocking
+        :param payload: JSON array of mapped datastreams, encoded as bytes
+        :param size: number of events in the payload
+        :param on_done: optional callable(status) called once the payload is delivered or given up, with the
+        status code of the response or the exception raised by the last post. Not called when the payload is dropped
+        :return: True if the payload was queued, False if it was dropped because the queue is full or closed
+        """
+        if self._closed.is_set():
+            accepted = False
+        else:
+            try:
+                self._queue.put_nowait((payload, size, on_done))
+                accepted = True
+            except queue.Full:
+                accepted = False
+        with self._lock:
+            if accepted:
+                self._stats["submitted"] += size
+                self._stats["max depth"] = max(self._stats["max depth"], self._queue.qsize())
+            else:
+                self._stats["dropped"] += size
+        return accepted
+
+    def join(self, timeout=None):
+        """
+        Wait until all queued payloads are delivered or given up
+        :param timeout: max seconds to wait. None waits until the queue is empty
+        :return: True if the queue is empty
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._queue.all_tasks_done:
+            while self._queue.unfinished_tasks:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._queue.all_tasks_done.wait(remaining)
+        return True
+
+    def close(self, timeout=None):
+        """
+        Stop accepting payloads, wait for the queued ones and stop the workers
+        :param timeout: max seconds to wait for the queued payloads. Payloads still queued are dropped
+        """
+        self._closed.set()
+        if not self.join(timeout):
+            while True:
+                try:
+                    _, size, on_done = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                with self._lock:
+                    self._stats["dropped"] += size
+                self._queue.task_done()
+                if on_done is not None:
+                    on_done(ConnectionError('Delivery queue was closed'))
+        for thread in self._threads:
+            thread.join(1)
+
+    def stats(self):
+        """
+        :return: dictionary with the current queue depth, the max depth reached, the number of events submitted,
+        delivered, dropped (queue full) and failed (retries exhausted), the number of retries, the events being
+        posted and the state of the circuit breaker
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        stats["depth"] = self._queue.qsize()
+        stats["circuit"] = self.breaker.state
+        stats["circuit opened"] = self.breaker.opened
+        return stats
+
+    def _work(self):
+        while True:
+            try:
+                payload, size, on_done = self._queue.get(timeout=0.2)
+            except queue.Empty:
+                if self._closed.is_set():
+                    return
+                continue
+            try:
+                with self._lock:
+                    self._stats["in flight"] += size
+                self._deliver(payload, size, on_done)
+            finally:
+                with self._lock:
+                    self._stats["in flight"] -= size
+                self._queue.task_done()
+
+    def _deliver(self, payload, size, on_done=None):
+        attempt = 0
+        while True:
+            while not self.breaker.allow():
+                # the receiver is failing: wait for the breaker instead of hammering it. Once the queue is closed,
+                # payloads are not kept waiting for a probe to close the circuit
+                if self._closed.wait(max(self.breaker.retry_in(), 0.05)) and self.breaker.state != 'closed':
+                    self._give_up(size, ConnectionError('Circuit breaker is %s' % self.breaker.state), on_done)
+                    return
+            try:
+                status = gevent.push_batch_to_cep(payload, self.receiver, size, timeout=self.timeout)
+            except Exception as exc:
+                retry = self._retryable(exc)
+                if retry:
+                    self.breaker.record_failure()
+                else:  # the receiver answered, the payload is wrong
+                    self.breaker.record_success()
+                if not retry or attempt >= self.max_retries:
+                    self._give_up(size, exc, on_done)
+                    return
+                attempt += 1
+                with self._lock:
+                    self._stats["retries"] += 1
+                # returns early when the queue is closed, the retries left are then sent without waiting
+                self._closed.wait(random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt)))
+                continue
+            self.breaker.record_success()
+            with self._lock:
+                self._stats["delivered"] += size
+            if self.on_delivery is not None:
+                self.on_delivery(size, status)
+            if on_done is not None:
+                on_done(status)
+            return
+
+    def _give_up(self, size, exc, on_done=None):
+        print('*** Delivery to %s failed for %s events: %r' % (self.receiver, size, exc))
+        with self._lock:
+            self._stats["failed"] += size
+        if self.on_delivery is not None:
+            self.on_delivery(size, exc)
+        if on_done is not None:
+            on_done(exc)
+
+    @staticmethod
+    def _retryable(exc):
+        """ Timeouts, connection errors and 5xx, 408 and 429 responses are retried. Other client errors are not"""
+        if isinstance(exc, requests.HTTPError) and exc.response is not None:
+            status = exc.response.status_code
+            return status >= 500 or status in (408, 429)
+        return True
@@ -0,0 +1,154 @@
+"""
+Project: Formalizer. Shared retrieval of observations for events observing the same phenomenon.
+Events are grouped by phenomenon and every group is fetched with one request per polygon of the union of the extents
+of its events. Observations are then routed to the events whose extent contains them
+License: MIT
+"""
+
+import numpy as np
+import shapely
+import shapely.ops as ops
+import shapely.wkt as wkt
+from bin import gevent
+from bin.observation_store import ObservationStore
+
+
+class FetchGroup:
+    """
+    Events observing the same phenomenon, retrieved with one request per polygon of their cover
+    Attributes:
+        phenomenon: name of the phenomenon, as in the Sensor API
+        events: dictionary of event id: GEvent
+        cover: list of WKT polygons covering the extents of all the events. See FetchPlanner.cover_extents
+        requests: prepared observations requests, one per polygon of the cover. See
+        gevent.prepare_observations_request
+    """
+
+    def __init__(self, phenomenon, events, cover, requests):
+        self.phenomenon = phenomenon
+        self.events = events
+        self.cover = cover
+        self.requests = requests
+        self._index = gevent.ExtentIndex(event.compile() for event in events.values())
+
+    def route_store(self, store):
+        """
+        Split observations among the events of the group
+        :param store: ObservationStore with the observations retrieved for the group
+        :return: dictionary of event id: ObservationStore with the observations located in the extent of the event
+        """
+        return {event_id: store.select(np.sort(rows)) for event_id, rows in self._index.route(store.x, store.y).items()}
+
+    def route(self, things):
+        """
+        Split Things among the events of the group
+        :param things: list of Things as returned by the requests of the group
+        :return: dictionary of event id: list of the Things located in the extent of the event
+        """
+        coords = np.array([thing['Locations'][0]['location']['coordinates'][:2] for thing in things],
+                          dtype=np.float64).reshape(-1, 2)
+        routed = self._index.route(coords[:, 0], coords[:, 1])
+        return {event_id: [things[row] for row in np.sort(rows).tolist()] for event_id, rows in routed.items()}
+
+
+class FetchPlanner:
+    """
+    Plans the retrieval of observations for a set of active events, so that the load on the Sensor API grows with
+    the number of distinct sensors and not with the number of events.
+    An event observing several phenomena belongs to one group per phenomenon.
+    Attributes:
+        sensor_api_root: root url to the Sensor API
+        cover: how the extents of a group are combined: 'union' (one request per polygon when the union is not a
+        single polygon), 'convex hull' or 'envelope' (bounding box)
+        page_size: page size of the requests
+        stats: number of requests, Things retrieved and Things routed to events by fetch()
+    """
+
+    covers = ('union', 'convex hull', 'envelope')
+
+    def __init__(self, sensor_api_root, cover='union', page_size=200):
+        if cover not in self.covers:
+            raise ValueError('Cover is not supported: %s' % cover)
+        self.sensor_api_root = sensor_api_root
+        self.cover = cover
+        self.page_size = page_size
+        self.events = {}  # event id: GEvent
+        self.stats = {"requests": 0, "things": 0, "routed": 0}
+        self._groups = None
+
+    def add(self, event):
+        """
+        Add an active event
+        :param event: GEvent
+        """
+        self.events[event.id_] = event
+        self._groups = None
+
+    def remove(self, event):
+        """
+        Remove an event which is not active anymore
+        :param event: GEvent or id of the event
+        """
+        self.events.pop(getattr(event, 'id_', event), None)
+        self._groups = None
+
+    def groups(self):
+        """
+        :return: dictionary of phenomenon: FetchGroup
+        """
+        if self._groups is None:
+            events_by_phenomenon = {}
+            for event_id, event in self.events.items():
+                for phenomenon in event.phenomena_names():
+                    events_by_phenomenon.setdefault(phenomenon, {})[event_id] = event
+            groups = {}
+            for phenomenon, events in events_by_phenomenon.items():
+                cover = self.cover_extents([event.extent for event in events.values()])
+                requests = [gevent.prepare_observations_request(self.sensor_api_root, polygon, phenomenon,
+                                                                self.page_size) for polygon in cover]
+                groups[phenomenon] = FetchGroup(phenomenon, events, cover, requests)
+            self._groups = groups
+        return self._groups
+
+    def cover_extents(self, extents):
+        """
+        Polygons covering several extents. The union of disjoint extents is a MultiPolygon, which is covered by
+        its polygons, so the area between the extents is not requested
+        :param extents: list of WKT polygons
+        :return: list of WKT polygons
+        """
+        polygons = [wkt.loads(extent) for extent in extents]
+        if self.cover == 'envelope':
+            return [shapely.box(*shapely.GeometryCollection(polygons).bounds).wkt]
+        cover = ops.unary_union(polygons)
+        if self.cover == 'convex hull':
+            return [cover.convex_hull.wkt]
+        if cover.geom_type == 'MultiPolygon':
+            return [polygon.wkt for polygon in cover.geoms]
+        return [cover.wkt]
+
+    def fetch(self, parallel=False, workers=4, columnar=False):
+        """
+        Retrieve the latest observations of every group with the requests of the group, and route them to the events
+        :param parallel: if True, fetch all pages concurrently. See gevent.fetch_pages_parallel()
+        :param workers: max number of threads used to fetch pages when parallel is True
+        :param columnar: if True, observations are returned as ObservationStore instead of lists of Things
+        :return: dictionary of event id: {phenomenon: observations located in the extent of the event}
+        """
+        routed = {event_id: {} for event_id in self.events}
+        for phenomenon, group in self.groups().items():
+            things = []
+            for request in group.requests:
+                request_things = gevent.collect_observations(request, parallel, workers)
+                self.stats["requests"] += 1
+                if request_things is not None:
+                    things.extend(request_things)
+            self.stats["things"] += len(things)
+            if columnar:
+                observations = group.route_store(ObservationStore.from_things(things))
+            else:
+                observations = group.route(things)
+            for event_id, event_observations in observations.items():
+                routed[event_id][phenomenon] = event_observations
+                self.stats["routed"] += len(event_observations)
+        return routed
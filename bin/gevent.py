@@ -12,12 +12,24 @@ import shapely.geos as geos
 import shapely.wkt as wkt
 import requests
 from bin import cep
+from bin import http_client
+from bin import json_codec
+from bin.prefilter import compile_conditions
+from bin.observation_store import ObservationStore, GridAggregation
+from bin.pipeline import Pipeline
+from bin import stream_parser
 import time
 import tempfile
 import json
+import hashlib
+import re
 import threading
 import logging
 import concurrent.futures
+import functools
+import queue
+import numpy as np
+import shapely
 
 log = logging.getLogger('formalizer')
 log.setLevel(logging.INFO)
@@ -36,7 +48,7 @@ class SensorApi(object):
         """
         Prints response code of a get request. 200 == successful connection
         """
-        response = requests.get(self.url)
+        response = http_client.get_client().get(self.url)
         return response.status_code
 
 
@@ -99,6 +111,30 @@ class CityAdmin(User):
         return 'city administrator'
 
 
+@functools.lru_cache(maxsize=1024)
+def parse_time_interval(time_interval):
+    """
+    Parse a time interval. Intervals are parsed once and cached, as the same definitions are validated repeatedly
+    :param time_interval: string describing a time interval as ISO 8601. Ex. 2015-11-24T10:00:00Z/2018-11-24T11:00:00Z
+    :return: start and end of the interval, as datetime
+    """
+    ind = time_interval.find('/')
+    if ind == -1:
+        raise ValueError('Time interval is not valid: %s' % time_interval)
+    return (datetime.datetime.strptime(time_interval[:ind], "%Y-%m-%dT%H:%M:%SZ"),
+            datetime.datetime.strptime(time_interval[ind + 1:], "%Y-%m-%dT%H:%M:%SZ"))
+
+
+def as_utc(time_):
+    """
+    :param time_: datetime. Naive datetimes, as parsed from ISO 8601 times ending in Z, are taken as UTC
+    :return: the time as a datetime with the UTC time zone
+    """
+    if time_.tzinfo is None:
+        return time_.replace(tzinfo=datetime.timezone.utc)
+    return time_.astimezone(datetime.timezone.utc)
+
+
 def is_valid_time_interval(time_interval):
     """
     Validate format and validity of a time interval.
@@ -108,8 +144,7 @@ def is_valid_time_interval(time_interval):
 
     ind = time_interval.find('/')
     if ind != -1:
-        start_time = datetime.datetime.strptime(time_interval[:ind], "%Y-%m-%dT%H:%M:%SZ")
-        end_time = datetime.datetime.strptime(time_interval[ind + 1:], "%Y-%m-%dT%H:%M:%SZ")
+        start_time, end_time = parse_time_interval(time_interval)
         if end_time > start_time:
             return True
         else:
@@ -128,7 +163,7 @@ def is_valid_wkt_polygon(wkt_geometry):
     """
 
     try:
-        geometry = wkt.loads(wkt_geometry)
+        geometry = _load_wkt(wkt_geometry)
     except geos.WKTReadingError:
         return False
     else:
@@ -137,13 +172,21 @@ def is_valid_wkt_polygon(wkt_geometry):
     return True
 
 
-def find_datastreams(sensor_api_root, extent, phenomenon, event_object=''):
+@functools.lru_cache(maxsize=1024)
+def _load_wkt(wkt_geometry):
+    """ Geometry of a WKT string, parsed once. Extents are validated on every request prepared for an event"""
+    return wkt.loads(wkt_geometry)
+
+
+def find_datastreams(sensor_api_root, extent, phenomenon, event_object='', parallel=False, workers=4):
     """
     Identifies datastreams in the Sensor API which match spatial and phenomenon filters
     :param sensor_api_root: root url to the sensor api
     :param extent: Spatial feature use to as bounding box in WKT (Well Known Text). A polygon
     :param phenomenon: name of observable property
     :param event_object: event object
+    :param parallel: if True, fetch all pages concurrently. See fetch_pages_parallel()
+    :param workers: max number of threads used to fetch pages when parallel is True
     :return: list of datastreams  URIS
     """
 
@@ -161,36 +204,17 @@ def find_datastreams(sensor_api_root, extent, phenomenon, event_object=''):
               extent + "')" + \
               " and Datastreams/ObservedProperty/name eq '" + phenomenon + "'"
         print(request_uri)
-
-        try:
-            request = requests.get(url=request_uri)  #json object
-
-        except requests.HTTPError:
-            print('HTTP error for the request: ' + str(request_uri))
     else:
         print('Extent definition is not valid')
         return
 
-    # make first request
-
-    response_json = request.json()
-    # collect data
-    things_collector = response_json["value"] # collect things from all responses. A list
-
-    make_request = True
-    # retrieve data from all pages
-    while make_request:
-        if '@iot.nextLink' in response_json:
-            request = requests.get(response_json['@iot.nextLink'])
-            response_json = request.json()
-            things_collector = things_collector + response_json['value']
-        else:
-            make_request = False
-
     # collect a list of ids
     ids = []
-    for thing in things_collector:
-        ids.append(thing['@iot.selfLink'])
+    try:
+        for thing in iter_observations(request_uri, parallel, workers):
+            ids.append(thing['@iot.selfLink'])
+    except requests.HTTPError:
+        print('HTTP error for the request: ' + str(request_uri))
     return ids
 
 
@@ -224,7 +248,7 @@ def prepare_observations_request(sensor_api_root, extent, phenomenon, page_size=
             "&$filter=geo.intersects(Things/Locations/location," + \
                       "geography'" + extent + "')" + \
                       " and Datastreams/ObservedProperty/name eq '" + phenomenon + "'" + \
-            "&$select=name,@iot.id&$expand=Datastreams($select=@iot.selflink,unitOfMeasurement;$filter=ObservedProperty/name eq '" + phenomenon + "';" + \
+            "&$select=name,@iot.id&$expand=Datastreams($select=@iot.id,@iot.selflink,unitOfMeasurement;$filter=ObservedProperty/name eq '" + phenomenon + "';" + \
             "$expand=Observations($orderby=phenomenonTime desc;$top=1)),Locations($select=location;$expand=HistoricalLocations($select=time;$orderby=time desc;$top=1))"
 
     else:
@@ -233,34 +257,173 @@ def prepare_observations_request(sensor_api_root, extent, phenomenon, page_size=
     return observations_request
 
 
-def collect_observations(observations_request):
+def add_time_filter(observations_request, since):
+    """
+    Restricts a prepared observations request to observations with a phenomenonTime after a given time.
+    Things without newer observations are not included in the response
+    :param observations_request: request prepared with prepare_observations_request()
+    :param since: ISO 8601 time, ex. 2018-01-10T10:00:00.000Z
+    :return: http request
+    """
+    ind = observations_request.find('&$select=')
+    observations_request = observations_request[:ind] + \
+        " and Datastreams/Observations/phenomenonTime gt " + since + observations_request[ind:]
+    return observations_request.replace("$expand=Observations(",
+                                        "$expand=Observations($filter=phenomenonTime gt " + since + ";", 1)
+
+
+def parse_phenomenon_time(phenomenon_time):
+    """
+    Converts the phenomenonTime of an observation into a datetime in UTC. For time intervals the end of the
+    interval is used
+    :param phenomenon_time: ISO 8601 time or time interval
+    :return: datetime, timezone aware
+    """
+    ind = phenomenon_time.find('/')
+    if ind != -1:
+        phenomenon_time = phenomenon_time[ind + 1:]
+    time_ = datetime.datetime.fromisoformat(phenomenon_time.replace('Z', '+00:00'))
+    if time_.tzinfo is None:
+        return time_.replace(tzinfo=datetime.timezone.utc)
+    return time_.astimezone(datetime.timezone.utc)
+
+
+def format_phenomenon_time(time_):
+    """
+    Formats a datetime in UTC as used in SensorThings filters
+    :param time_: datetime, timezone aware
+    :return: ISO 8601 string with milliseconds. Ex. 2018-01-10T10:00:00.000Z
+    """
+    return time_.strftime('%Y-%m-%dT%H:%M:%S') + '.%03dZ' % (time_.microsecond // 1000)
+
+
+def _add_query_option(request_uri, option):
+    """
+    Appends a query option to a SensorThings request
+    :param request_uri: request URL, with or without a query string
+    :param option: query option as 'name=value'. Ex. '$count=true'
+    :return: request URL including the option
+    """
+    if '?' in request_uri:
+        return request_uri + '&' + option
+    return request_uri + '?' + option
+
+
+def _get_page(page_uri):
+    """
+    Retrieve a single page of a SensorThings collection
+    :param page_uri: URL of the page
+    :return: list of entities in the page
+    """
+    request = http_client.get_client().get(url=page_uri)
+    request.raise_for_status()
+    return request.json()['value']
+
+
+def fetch_pages_parallel(request_uri, workers=4):
+    """
+    Retrieve all pages of a SensorThings collection using concurrent requests.
+    The first page is requested with $count=true; the offsets ($skip) of the remaining pages are computed from
+    the total count and the page size returned by the server, and those pages are requested using a thread pool.
+    Servers that do not report a count are paginated by following @iot.nextLink.
+    :param request_uri: request for the collection. It must not contain $skip or $count
+    :param workers: max number of concurrent requests
+    :return: list of pages, each page is a list of entities. Pages are in the same order as served by the API
+    """
+
+    request = http_client.get_client().get(url=_add_query_option(request_uri, '$count=true'))
+    request.raise_for_status()
+    response_json = request.json()
+    pages = [response_json['value']]
+    if '@iot.nextLink' not in response_json:
+        return pages
+
+    page_size = len(response_json['value'])  # the server may serve less than $top
+    total = response_json.get('@iot.count')
+    if total is None or page_size == 0:
+        while '@iot.nextLink' in response_json:
+            request = http_client.get_client().get(response_json['@iot.nextLink'])
+            request.raise_for_status()
+            response_json = request.json()
+            pages.append(response_json['value'])
+        return pages
+
+    page_uris = [_add_query_option(request_uri, '$skip=' + str(skip)) for skip in range(page_size, total, page_size)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        pages.extend(executor.map(_get_page, page_uris))  # map() keeps the order of the pages
+    return pages
+
+
+def iter_pages(request_uri):
+    """
+    Iterate over the pages of a SensorThings collection by following @iot.nextLink.
+    A page is requested only when the previous one has been consumed
+    :param request_uri: request for the collection
+    :return: generator of pages, each page is a list of entities
+    """
+    request = http_client.get_client().get(url=request_uri)
+    request.raise_for_status()
+    response_json = request.json()
+    yield response_json['value']
+
+    while '@iot.nextLink' in response_json:
+        request = http_client.get_client().get(response_json['@iot.nextLink'])
+        request.raise_for_status()
+        response_json = request.json()
+        yield response_json['value']
+
+
+def iter_store_pages(request_uri, low_memory=False):
+    """
+    Iterate over the pages of an observations request by following @iot.nextLink. Only the fields of the latest
+    observations are kept (see stream_parser.parse_things_page)
+    :param request_uri: prepared observations request
+    :param low_memory: if True, the body of every response is parsed as it is read from the connection
+    :return: generator of pages, each page is an ObservationStore
+    """
+    next_link = request_uri
+    while next_link is not None:
+        response = http_client.get_client().get(url=next_link, stream=True)
+        try:
+            response.raise_for_status()
+            response.raw.decode_content = True  # compressed responses are decoded while they are read
+            store, next_link = stream_parser.parse_things_page(response.raw, low_memory=low_memory)
+        finally:
+            response.close()
+        yield store
+
+
+def iter_observations(observations_request, parallel=False, workers=4):
+    """
+    Iterate over the Things returned by an observations request, one Thing at a time.
+    Unlike collect_observations(), only the page being consumed is kept in memory (except when parallel is True)
+    :param observations_request: prepared observations request
+    :param parallel: if True, fetch all pages concurrently. See fetch_pages_parallel()
+    :param workers: max number of threads used to fetch pages when parallel is True
+    :return: generator of things, their locations and the latest observation
+    """
+    if parallel:
+        pages = fetch_pages_parallel(observations_request, workers)
+    else:
+        pages = iter_pages(observations_request)
+    for page in pages:
+        yield from page
+
+
+def collect_observations(observations_request, parallel=False, workers=4):
     """
     Retrieve latest observations from all Things (sensing devices) that intersect the extent and belong to phenomena
     :param observations_request: prepared observations request
+    :param parallel: if True, fetch all pages concurrently. See fetch_pages_parallel()
+    :param workers: max number of threads used to fetch pages when parallel is True
     :return: A list  of things, their locations and the latest observation
     """
 
     try:
-            request = requests.get(url=observations_request)  # json object
+        observations = list(iter_observations(observations_request, parallel, workers))
     except requests.HTTPError:
-            print('HTTP error for the request: ' + str(observations_request))
+        print('HTTP error for the request: ' + str(observations_request))
     else:
-        # make first request
-
-        response_json = request.json()
-        # collect data
-        observations = response_json["value"]  # collect things from all responses. A list
-        # print('type of observations', type(observations))
-        # print(observations)
-        make_request = True
-        # retrieve data from all pages
-        while make_request:
-            if '@iot.nextLink' in response_json:
-                request = requests.get(response_json['@iot.nextLink'])
-                response_json = request.json()
-                observations = observations + response_json['value']
-            else:
-                make_request = False
         return observations
 
 
@@ -268,7 +431,7 @@ def test_remote_connection(url):
     """ Test if a remote HTTP connection is listening
     :param url: valid URL for the connection
     """
-    r = requests.get(url)
+    r = http_client.get_client().get(url)
     r.raise_for_status()
     return True
 
@@ -278,30 +441,62 @@ class Buffer:
     Buffers a list of observations from the SensorThingAPI
 
     Attributes:
-        request: request definition to collect observations
+        request: request definition to collect observations, or list of requests whose observations are combined
+        (ex. the requests of a fetch_planner.FetchGroup)
         data: list of observations
-        update_interval: time interval in seconds
+        update_interval: time interval in seconds between automatic updates
+        parallel: fetch pages of observations concurrently
+        workers: max number of concurrent page requests when parallel is True
+        prefetch: if False, observations are not collected on instantiation. Use with iter_data()
+        incremental: if True, every update only requests observations newer than the ones already pushed,
+        and data holds only the Things with new observations. Observations are pushed once they are confirmed
+        (see confirm()); until then, they are fetched again by every update
+        last_seen: newest (phenomenonTime, observation id) pushed per Datastream, when incremental is True
+        stale_after: seconds a Datastream may lag behind the newest observation seen before it is dropped from
+        last_seen, so a sensor which stops reporting does not hold back the time filter of the requests.
+        Defaults to 10 update intervals
+        columnar: if True, updates fill store instead of data
+        streaming: if True, columnar updates parse the responses of the Sensor API into stores, without building
+        Things (see iter_store_pages). Pages are requested sequentially. Not used in incremental mode, which needs
+        the Things to drop the observations already seen
+        low_memory: if True, streaming updates parse the responses as they are read, which is slower
+        store: latest observations as an ObservationStore, when columnar is True
         control = control the start and stop of auto_update
     Methods:
         update_data: Update list of observations in data attribute
-        auto_update: continuously update the buffer given a time time interval
+        iter_data: Stream observations page by page without holding them in the buffer
+        set_request: Replace the request of the buffer
+        auto_update: continuously update the buffer given a time time interval, using a Scheduler
     """
 
-    def __init__(self, request, update_interval):
+    def __init__(self, request, update_interval, parallel=False, workers=4, prefetch=True, incremental=False,
+                 columnar=False, streaming=False, stale_after=None, low_memory=False):
         self.data = None
+        self.store = None
+        self.columnar = columnar
+        self.streaming = streaming
+        self.low_memory = low_memory
         self.request = request
         self.last_update = None
         self.update_interval = update_interval
+        self.parallel = parallel
+        self.workers = workers
+        self.incremental = incremental
+        self.last_seen = {}
+        self.stale_after = 10 * update_interval if stale_after is None else stale_after
+        self._time_filter = True  # False until the first update after the request changed, see set_request
+        # newest observation of every Datastream in every fetch, until it is confirmed or older than last_seen:
+        self._pending = {}  # Datastream id: {observation id: phenomenonTime}
+        self._pending_ids = {}  # observation id: Datastream id
+        self._seen_lock = threading.Lock()
         self.size = 0  # number of data units
-        # self.control = 'stop'
+        self.control = 'stopped'
+        self._id = uuid.uuid4().hex
+        self._update_task = None
 
-        try:
-            self.data = collect_observations(request)
-        except Exception as e:
-            print('Requesting data raised an exception: ', e)
-        else:
-            self.last_update = datetime.datetime.now().isoformat()
-            self.size = len(self.data)
+        if not prefetch:
+            return
+        self.update_data()
 
     def update_data(self):
         """
@@ -310,41 +505,177 @@ class Buffer:
         """
         # if self.control == 'stopped':
         try:
-            self.data = collect_observations(self.request)
+            if self.columnar and self.streaming and not self.incremental:
+                self.store = ObservationStore.concat([page for request in self._next_requests()
+                                                      for page in iter_store_pages(request, self.low_memory)])
+            elif self.columnar:
+                things = (thing for request in self._next_requests()
+                          for thing in iter_observations(request, self.parallel, self.workers))
+                self.store = ObservationStore.from_things(self._drop_seen(things))
+            else:
+                things = []
+                for request in self._next_requests():
+                    things.extend(collect_observations(request, self.parallel, self.workers))
+                self.data = list(self._drop_seen(things))
         except Exception as e:
             print('Requesting data raised an exception: ', e)
         else:
             self.last_update = datetime.datetime.now().isoformat()
-            self.size = len(self.data)
+            self.size = len(self.store) if self.columnar else len(self.data)
+            self._time_filter = True
         # else:
         #     print('Auto update is running. This function call has no effect')
         #     return
 
-    # def auto_update(self, update_interval, command):
-    #     """
-    #     Update buffer manually
-    #     :param update_interval: time in seconds
-    #     :param command: start/stop
-    #     :return:
-    #     """
-    #
-    #     if command == 'start' and self.control == 'started':
-    #         print('Auto update was started already')
-    #         return
-    #     elif command == 'stop' and self.control == 'stopped':
-    #         print('Auto update was stopped already')
-    #         return
-    #     else:
-    #         self.control = command
-    #
-    #     while self.control == 'start':
-    #             try:
-    #                 self.data = collect_observations(self.request)
-    #             except Exception as e:
-    #                 print('Requesting data raised an exception: ', e)
-    #             else:
-    #                 self.last_update = datetime.datetime.now().isoformat()
-    #                 time.sleep(update_interval)
+    def iter_data(self):
+        """
+        Stream observations from the Sensor API, one Thing at a time. Observations are not stored in data,
+        so memory use is bounded by the page size of the request
+        :return: generator of things, their locations and the latest observation
+        """
+        size = 0
+        things = (thing for request in self._next_requests()
+                  for thing in iter_observations(request, self.parallel, self.workers))
+        for thing in self._drop_seen(things):
+            size += 1
+            yield thing
+        self.last_update = datetime.datetime.now().isoformat()
+        self.size = size
+        self._time_filter = True
+
+    def set_request(self, request):
+        """
+        Replace the request of the buffer, ex. when the cover of a fetch_planner.FetchGroup changes. In incremental
+        mode, the next update is not filtered by time, so the latest observations of sensors new to the request
+        are not missed; observations already pushed are still dropped
+        :param request: request, or list of requests
+        """
+        self.request = request
+        self._time_filter = False
+
+    def _next_requests(self):
+        """ Requests for the next update, one per request of the buffer. See _next_request"""
+        requests_ = self.request if isinstance(self.request, list) else [self.request]
+        return [self._next_request(request) for request in requests_]
+
+    def _next_request(self, request=None):
+        """
+        Request for the next update. In incremental mode, observations older than the oldest of the newest
+        observations per Datastream are filtered out by the Sensor API. Datastreams lagging more than
+        stale_after seconds behind the newest observation are forgotten first (see _drop_stale)
+        :param request: one of the requests of the buffer. Defaults to request
+        """
+        if request is None:
+            request = self.request
+        if not self.incremental or not self.last_seen or not self._time_filter:
+            return request
+        with self._seen_lock:
+            self._drop_stale()
+            since = min(time_ for time_, _ in self.last_seen.values())
+        return add_time_filter(request, format_phenomenon_time(since))
+
+    def _drop_stale(self):
+        """ Forget the Datastreams of last_seen which lag more than stale_after seconds behind the newest one.
+        Their next observations are newer than the time filter, so none is pushed twice. Call with _seen_lock"""
+        cutoff = max(time_ for time_, _ in self.last_seen.values()) - datetime.timedelta(seconds=self.stale_after)
+        for datastream_id in [key for key, (time_, _) in self.last_seen.items() if time_ < cutoff]:
+            del self.last_seen[datastream_id]
+            for observation_id in self._pending.pop(datastream_id, ()):
+                self._pending_ids.pop(observation_id, None)
+
+    def confirm(self, observation_ids=None):
+        """
+        Mark fetched observations as pushed, so they are not requested nor returned by later updates.
+        Observations which are not confirmed (ex. their push failed) are returned again by the next update.
+        Has no effect unless incremental is True
+        :param observation_ids: ids of the pushed observations. If None, all the observations fetched so far
+        """
+        with self._seen_lock:
+            if observation_ids is None:
+                observation_ids = list(self._pending_ids)
+            for observation_id in observation_ids:
+                datastream_id = self._pending_ids.pop(observation_id, None)
+                if datastream_id is None:
+                    continue
+                pending = self._pending[datastream_id]
+                time_ = pending.pop(observation_id)
+                last = self.last_seen.get(datastream_id)
+                if last is None or time_ > last[0]:
+                    last = self.last_seen[datastream_id] = (time_, observation_id)
+                # observations of earlier fetches which are not newer are dropped anyway
+                for other_id in [key for key, other_time in pending.items() if other_time <= last[0]]:
+                    del pending[other_id]
+                    self._pending_ids.pop(other_id, None)
+                if not pending:
+                    del self._pending[datastream_id]
+
+    def _drop_seen(self, things):
+        """
+        Drops observations which were already pushed, and Things left without observations. The newest
+        observation of every Datastream is kept until it is confirmed. Has no effect unless incremental is True
+        :param things: iterable of Things as returned by the Sensor API
+        :return: generator of Things with new observations only
+        """
+        if not self.incremental:
+            yield from things
+            return
+
+        for thing in things:
+            datastreams = []
+            for datastream in thing['Datastreams']:
+                datastream_id = datastream.get('@iot.id', datastream.get('@iot.selfLink'))
+                with self._seen_lock:
+                    last = self.last_seen.get(datastream_id)
+                observations = []
+                for observation in datastream['Observations']:
+                    time_ = parse_phenomenon_time(observation['phenomenonTime'])
+                    if last is not None and (time_ <= last[0] or observation['@iot.id'] == last[1]):
+                        continue
+                    observations.append(observation)
+                if not observations:
+                    continue
+                newest = max(observations, key=lambda o: parse_phenomenon_time(o['phenomenonTime']))
+                self._fetch(datastream_id, (parse_phenomenon_time(newest['phenomenonTime']), newest['@iot.id']))
+                datastream = dict(datastream)
+                datastream['Observations'] = observations
+                datastreams.append(datastream)
+            if datastreams:
+                thing = dict(thing)
+                thing['Datastreams'] = datastreams
+                yield thing
+
+    def _fetch(self, datastream_id, newest):
+        """ Keep the newest observation of a Datastream in a fetch until it is confirmed. Observations of earlier
+        fetches stay pending, their pushes may be confirmed later"""
+        with self._seen_lock:
+            self._pending.setdefault(datastream_id, {})[newest[1]] = newest[0]
+            self._pending_ids[newest[1]] = datastream_id
+
+    def auto_update(self, scheduler, command='start'):
+        """
+        Update the buffer every update_interval seconds
+        :param scheduler: Scheduler running the updates
+        :param command: start/stop
+        :return:
+        """
+
+        if command == 'start' and self.control == 'started':
+            print('Auto update was started already')
+            return
+        elif command == 'stop' and self.control == 'stopped':
+            print('Auto update was stopped already')
+            return
+
+        if command == 'start':
+            self._update_task = scheduler.schedule_periodic('buffer-' + self._id, self.update_interval,
+                                                            self.update_data)
+            self.control = 'started'
+        elif command == 'stop':
+            scheduler.cancel(self._update_task)
+            self._update_task = None
+            self.control = 'stopped'
+        else:
+            raise ValueError('Command is not valid. Use "start" or "stop". Command: %s' % command)
 
 
 class GEvent:
@@ -372,79 +703,516 @@ class GEvent:
         self.validity = temporal_properties["validity"]
         self.conditions = attrib_properties["conditions"]
         self.id_ = uuid.uuid4().hex
+        self._compiled = None
 
     def phenomena_names(self):
         """
-            :param condition: a dictionary containing detection rules, using JSON-logic syntax
-            :return:
-            """
+        Names of the phenomena used in the conditions of the event, at any depth of nested and/or statements
+        :return: list of names, in order of first appearance
+        """
         names = []
-        key_ = self.conditions.keys()
-        values = self.conditions[list(key_)[0]]
-        statements = [self.conditions]
-
-        while isinstance(values[0], dict):
-            key_ = values[0].keys()
-            statements = values
-            values = values[0][list(key_)[0]]
-        for s in statements:
-            names.append(list(s.values())[0][0])
+        for arguments in _comparison_arguments(self.conditions):
+            name = _phenomenon_argument(arguments)
+            if name is not None and name not in names:
+                names.append(name)
         return names
 
+    def prefilter(self):
+        """
+        Compile the conditions of the event into a vectorized predicate, used to push only the observations
+        which can match the event
+        :return: CompiledCondition
+        """
+        return compile_conditions(self.conditions)
+
+    def compile(self):
+        """
+        Parse the definition of the event once, for repeated evaluation. The compiled form is kept, as the
+        definition of an event does not change (see EventHandler.update_event, which uses a new GEvent)
+        :return: CompiledGEvent
+        """
+        if self._compiled is None:
+            self._compiled = CompiledGEvent(self)
+        return self._compiled
+
     def phenomenon_json_type(self, phenomenon_name):
         """ Converts python datatypes into JSON (CEP specific) data types"""
-        for name_value in self.conditions.values(): # TODO: deal with nested statements
-            try:
-                phenomenon_name in name_value
-            except ValueError:
-                print('No name match, continue looking')
+        for arguments in _comparison_arguments(self.conditions):
+            if _phenomenon_argument(arguments) != phenomenon_name:
                 continue
+            python_type = type(arguments[1])
+            if python_type == int or python_type == float:
+                return 'DOUBLE'
+            elif python_type == str:
+                return 'STRING'
             else:
-                python_type = type(name_value[1])
-                if python_type == int or python_type == float:
-                    return 'DOUBLE'
-                elif python_type == str:
-                    return 'STRING'
-                else:
-                    raise TypeError('Type conversion not defined!!')
+                raise TypeError('Type conversion not defined!!')
+        raise ValueError('Phenomenon is not used in the conditions of the event: %s' % phenomenon_name)
+
+
+def _comparison_arguments(conditions):
+    """
+    Arguments of every comparison in JsonLogic conditions, walking nested and, or and not statements
+    :param conditions: JsonLogic statement. Ex. {"and": [{">": ["Temperature", 25]}, {"<": ["Luminosity", 3]}]}
+    :return: generator of lists of arguments. Ex. ['Temperature', 25]
+    """
+    for operator, arguments in conditions.items():
+        if operator in ('and', 'or'):
+            for statement in arguments:
+                yield from _comparison_arguments(statement)
+        elif operator in ('!', 'not'):
+            yield from _comparison_arguments(arguments[0] if isinstance(arguments, list) else arguments)
+        else:
+            yield arguments
+
+
+def _phenomenon_argument(arguments):
+    """ Name of the phenomenon compared by a JsonLogic comparison, given first or as {"var": name}"""
+    first = arguments[0]
+    if isinstance(first, dict):
+        return first.get('var')
+    return first if isinstance(first, str) else None
+
+
+class CompiledGEvent:
+    """
+    A GEvent parsed once for repeated evaluation: prepared extent, parsed time intervals and compiled conditions.
+    Attributes:
+        event: the GEvent
+        id_: id of the event
+        extent: extent of the event, a prepared shapely Polygon
+        bounds: bounding box of the extent (min x, min y, max x, max y)
+        time_start, time_end: time window for the detection of the event, datetime
+        validity_start, validity_end: validity of the event, datetime
+        phenomena: names of the phenomena in the conditions
+        condition: conditions of the event as a CompiledCondition
+    """
+
+    __slots__ = ('event', 'id_', 'extent', 'bounds', 'time_start', 'time_end', 'validity_start', 'validity_end',
+                 'phenomena', 'condition')
+
+    def __init__(self, gevent):
+        extent = _load_wkt(gevent.extent)
+        if extent.geom_type != 'Polygon':
+            raise ValueError('Extent is not a polygon: %s' % gevent.extent)
+        shapely.prepare(extent)
+        self.event = gevent
+        self.id_ = gevent.id_
+        self.extent = extent
+        self.bounds = extent.bounds
+        self.time_start, self.time_end = parse_time_interval(gevent.time)
+        self.validity_start, self.validity_end = parse_time_interval(gevent.validity)
+        self.phenomena = gevent.phenomena_names()
+        self.condition = compile_conditions(gevent.conditions)
+
+    def contains(self, x, y):
+        """
+        :param x, y: coordinates of points, numbers or arrays
+        :return: True (or boolean array) for the points located in the extent, boundary included
+        """
+        return shapely.intersects_xy(self.extent, x, y)
+
+    def aggregation(self, statistic='mean'):
+        """
+        Grid with cells of the size of the spatial granularity of the event
+        :param statistic: 'mean', 'max', 'min' or 'count'
+        :return: GridAggregation
+        """
+        return GridAggregation.from_granularity(self.event.granularity, (self.bounds[1] + self.bounds[3]) / 2,
+                                                statistic)
+
+    def active_interval(self):
+        """
+        Interval in which the event can be detected: the intersection of its time window and its validity
+        :return: (start, end) as datetime in UTC, without time zone. None when the intervals do not intersect
+        """
+        start = max(self.time_start, self.validity_start)
+        end = min(self.time_end, self.validity_end)
+        if start >= end:
+            return None
+        return start, end
+
+    def in_time(self, when=None):
+        """
+        :param when: datetime. Naive datetimes are taken as UTC, as the time window of the event. Defaults to now
+        :return: True when the time is within the detection time window of the event
+        """
+        if when is None:
+            when = datetime.datetime.now(datetime.timezone.utc)
+        when = as_utc(when).replace(tzinfo=None)
+        return self.time_start <= when <= self.time_end
+
+
+class ExtentIndex:
+    """
+    Spatial index (STRtree) over the extents of compiled events, answering which events contain a point in
+    logarithmic time. The tree is built again on the first query after events were added or removed.
+    A process-wide index of the active events is returned by get_extent_index()
+    """
+
+    def __init__(self, events=()):
+        self._events = {}  # event id: CompiledGEvent
+        self._lock = threading.Lock()
+        self._tree = None
+        self._order = []  # events in the order of the tree
+        for event in events:
+            self.add(event)
+
+    def __len__(self):
+        return len(self._events)
+
+    def add(self, event):
+        """
+        :param event: CompiledGEvent, or GEvent which is compiled
+        """
+        if not isinstance(event, CompiledGEvent):
+            event = event.compile()
+        with self._lock:
+            self._events[event.id_] = event
+            self._tree = None
+
+    def remove(self, event):
+        """
+        :param event: GEvent, CompiledGEvent or id of the event
+        """
+        with self._lock:
+            self._events.pop(getattr(event, 'id_', event), None)
+            self._tree = None
+
+    def events_at(self, x, y):
+        """
+        :param x, y: coordinates of a point
+        :return: list of the CompiledGEvents whose extent contains the point
+        """
+        tree, order = self._index()
+        if tree is None:
+            return []
+        return [order[i] for i in tree.query(shapely.Point(x, y), predicate='intersects').tolist()]
+
+    def route(self, x, y):
+        """
+        Find the events containing every point
+        :param x, y: arrays with the coordinates of the points
+        :return: dictionary of event id: array with the indices of the points located in the extent of the event
+        """
+        tree, order = self._index()
+        if tree is None or len(x) == 0:
+            return {event.id_: np.empty(0, dtype=np.intp) for event in order}
+        points, events = tree.query(shapely.points(np.asarray(x), np.asarray(y)), predicate='intersects')
+        points = points[np.argsort(events, kind='stable')]
+        splits = np.cumsum(np.bincount(events, minlength=len(order)))[:-1]
+        return {event.id_: event_points for event, event_points in zip(order, np.split(points, splits))}
+
+    def _index(self):
+        with self._lock:
+            if self._tree is None:
+                self._order = list(self._events.values())
+                self._tree = shapely.STRtree([event.extent for event in self._order]) if self._order else None
+            return self._tree, self._order
+
+
+_extent_index = ExtentIndex()
 
 
-def push_to_cep(datastream, receiver_url):
+def get_extent_index():
     """
-    Send data to a CEP receiver
+    Process-wide spatial index of the extents of the active events
+    :return: ExtentIndex
+    """
+    return _extent_index
+
+
+def push_to_cep(datastream, receiver_url, timeout=None):
+    """
+    Send data to a CEP receiver. The datastream is encoded once with the shared JSON codec (see json_codec) and
+    the bytes are sent as they are
     :param datastream: mapped datastreasm
-    :param receiver_url: URL endpoint
+    :param receiver_url: URL endpoint, or an in-process receiver (see local_cep.LocalCEP.receiver)
+    :param timeout: timeout in seconds, or (connect, read) timeouts. If None, the timeout of the HTTP client is used
     :return:
     """
     log.info('datastream | 100 | ' + datastream['event']['correlationData']['event_id'])
-    request = requests.post(receiver_url, json=datastream, verify=False)
+    payload = json_codec.dumps(datastream)
+    if not isinstance(receiver_url, str):
+        return receiver_url.send(payload)
+    kwargs = {} if timeout is None else {'timeout': timeout}
+    request = http_client.get_client().post(receiver_url, data=payload, verify=False,
+                                            headers={'Content-Type': 'application/json'}, **kwargs)
     log.info('cep response | 200 | ' + datastream['event']['correlationData']['event_id'])
     request.raise_for_status()
     return request.status_code
 
 
+def push_batch_to_cep(payload, receiver_url, size=None, timeout=None):
+    """
+    Send a batch of events to a CEP receiver in a single request. The JSON mapping of WSO2 receivers accepts
+    an array of events
+    :param payload: JSON array of mapped datastreams, already encoded as bytes
+    :param receiver_url: URL endpoint, or an in-process receiver (see local_cep.LocalCEP.receiver)
+    :param size: number of events in the batch. Only used for logging
+    :param timeout: timeout in seconds, or (connect, read) timeouts. If None, the timeout of the HTTP client is used
+    :return: status code of the response
+    """
+    log.info('batch | 100 | ' + str(size) + ' events')
+    if not isinstance(receiver_url, str):
+        return receiver_url.send(payload)
+    kwargs = {} if timeout is None else {'timeout': timeout}
+    request = http_client.get_client().post(receiver_url, data=payload, verify=False,
+                                            headers={'Content-Type': 'application/json'}, **kwargs)
+    log.info('cep response | 200 | batch of ' + str(size) + ' events')
+    request.raise_for_status()
+    return request.status_code
+
+
+def _observation_ids(things):
+    """ Ids of all the observations of a list of Things"""
+    return [observation['@iot.id'] for thing in things for datastream in thing['Datastreams']
+            for observation in datastream['Observations']]
+
+
+class _Receipt:
+    """
+    Observations of a page taken from a Buffer in incremental mode. They are confirmed in the Buffer (see
+    Buffer.confirm) once every event mapped from the page was delivered, so observations whose push failed are
+    fetched and pushed again
+    """
+
+    def __init__(self, buffer, observation_ids):
+        self.buffer = buffer
+        self.observation_ids = observation_ids
+        self._pending = 1  # released by close(), once all the events of the page were handed over
+        self._failed = False
+        self._lock = threading.Lock()
+
+    def add(self):
+        """ Count an event of the page, settled when its push completes"""
+        with self._lock:
+            self._pending += 1
+
+    def settle(self, delivered):
+        """
+        :param delivered: True when an event of the page was delivered
+        """
+        with self._lock:
+            self._pending -= 1
+            self._failed = self._failed or not delivered
+            confirm = self._pending == 0 and not self._failed
+        if confirm:
+            self.buffer.confirm(self.observation_ids)
+
+    def close(self):
+        """ All the events of the page were handed over"""
+        self.settle(True)
+
+
+def _settle(receipts, status):
+    """ Settle the receipts of the events of a batch, given the status of its post"""
+    delivered = not isinstance(status, Exception) and status != 'dropped'
+    for receipt in receipts:
+        receipt.settle(delivered)
+
+
+class EventBatcher:
+    """
+    Groups mapped datastreams into batches which are posted to a CEP receiver in a single request.
+    A batch is sent when it holds max_events events, when adding an event would exceed max_bytes,
+    or flush_interval seconds after its first event was added.
+    Attributes:
+        receiver: URL of a receiver in the processing engine
+        max_events: max number of events per request
+        max_bytes: max size of the request body in bytes
+        flush_interval: max time in seconds an event waits in a batch. None disables timed flushes
+        executor: executor used to post batches. If None, batches are posted by the calling thread
+        on_batch: callable(events, status) called after each post; status is the status code of the response
+        or the exception raised by the post
+        results: list of (events, status) for every batch sent
+        delivery: delivery.DeliveryQueue of the receiver, optional. If given, batches are queued for delivery
+        instead of posted, and their status is 'queued' or 'dropped'
+    """
+
+    def __init__(self, receiver_endpoint, max_events=100, max_bytes=512 * 1024, flush_interval=1.0, executor=None,
+                 on_batch=None, delivery=None):
+        self.receiver = receiver_endpoint
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.executor = executor
+        self.on_batch = on_batch
+        self.delivery = delivery
+        self.results = []
+        self._events = []  # events in the current batch, encoded as JSON
+        self._receipts = []  # _Receipt of every event in the current batch which has one
+        self._bytes = 2  # size of the current batch, including the brackets of the array
+        self._timer = None
+        self._futures = []
+        self._lock = threading.Lock()
+
+    def add(self, datastream, receipt=None):
+        """
+        Add a mapped datastream to the current batch, sending the batch when it is full
+        :param datastream: mapped datastream
+        :param receipt: optional _Receipt of the page of the datastream, settled when the batch is sent
+        """
+        self.add_encoded(json_codec.dumps(datastream), receipt)
+
+    def add_encoded(self, event, receipt=None):
+        """
+        Add an event already encoded as JSON to the current batch, sending the batch when it is full
+        :param event: mapped datastream as JSON bytes
+        :param receipt: optional _Receipt of the page of the event, settled when the batch is sent
+        """
+        with self._lock:
+            if self._events and (self._bytes + len(event) + 1 > self.max_bytes):
+                self._send(*self._take_batch())
+            self._events.append(event)
+            self._bytes += len(event) + 1
+            if receipt is not None:
+                receipt.add()
+                self._receipts.append(receipt)
+            if len(self._events) >= self.max_events:
+                self._send(*self._take_batch())
+            elif len(self._events) == 1 and self.flush_interval is not None:
+                self._timer = threading.Timer(self.flush_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        """ Send the current batch, if it is not empty"""
+        with self._lock:
+            if self._events:
+                self._send(*self._take_batch())
+
+    def join(self):
+        """
+        Flush the current batch and wait until all batches are sent
+        :return: list of (events, status) for every batch sent
+        """
+        self.flush()
+        with self._lock:
+            futures, self._futures = self._futures, []
+        concurrent.futures.wait(futures)
+        return self.results
+
+    def _take_batch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        events, self._events, self._bytes = self._events, [], 2
+        receipts, self._receipts = self._receipts, []
+        return events, receipts
+
+    def _send(self, events, receipts):
+        payload = b'[' + b','.join(events) + b']'
+        if self.delivery is not None:
+            # posted, retried and reported by the workers of the delivery queue
+            on_done = (lambda status: _settle(receipts, status)) if receipts else None
+            status = 'queued' if self.delivery.submit(payload, len(events), on_done) else 'dropped'
+            self.results.append((len(events), status))
+            if status == 'dropped':
+                _settle(receipts, status)
+        elif self.executor is None:
+            self._post(payload, len(events), receipts)
+        else:
+            self._futures.append(self.executor.submit(self._post, payload, len(events), receipts))
+
+    def _post(self, payload, size, receipts=()):
+        try:
+            status = push_batch_to_cep(payload, self.receiver, size)
+        except Exception as exc:
+            status = exc
+        _settle(receipts, status)
+        self.results.append((size, status))
+        if self.on_batch is not None:
+            self.on_batch(size, status)
+        return status
+
+
 class StreamGenerator:
     """Push a list of observations into a CEP receiver, using a thread pool
     Attributes:
         id: unique identifier
-        cep_reciever: URL of a receiver in the processing engine
-        observation_data: observation data as provided by the Buffer class.
-        update_frequency: frequency in milliseconds to send request. Default 5 seconds.
-        expiration: ISO formatted time at which the generator should expire.
+        cep_reciever: URL of a receiver in the processing engine, or an in-process receiver of a local_cep.LocalCEP
+        observation_data: observation data as provided by the Buffer class. Either a list of observations,
+        a Buffer (streamed with Buffer.iter_data() on every call to stream_to_cep when it was not prefetched),
+        an ObservationStore or an iterable of observations. Observations of a Buffer in incremental mode are
+        confirmed (see Buffer.confirm) once all the events of their page were delivered
+        update_frequency: time in seconds between pushes when the generator is scheduled. Default 5 seconds.
+        expiration: ISO formatted time in UTC at which the generator should expire, or datetime (ex. the end of
+        the active interval of a CompiledGEvent). Naive datetimes are taken as UTC
+        expiration_time: expiration as datetime in UTC, with time zone, parsed once
+        expired: threading.Event set when a scheduled generator reaches its expiration
+        batch_size: max number of events per request. If None, every event is posted in its own request
+        batch_bytes: max size in bytes of a batched request
+        flush_interval: max time in seconds an event waits for its batch to be sent
+        on_batch: callable(events, status) called after each batch is sent. See EventBatcher
+        batch_results: list of (events, status) for the batches sent by the last call to stream_to_cep
+        prefilter: CompiledCondition (see GEvent.prefilter). Observations which cannot match it are not pushed
+        aggregation: GridAggregation (see CompiledGEvent.aggregation). If given, observations are aggregated into
+        one event per grid cell before the prefilter is applied and the events are pushed
+        delivery: delivery.DeliveryQueue of the receiver, optional. If given, events are queued for delivery in
+        batches of batch_size events (one event per batch when batch_size is None), so pushes never block on a
+        slow receiver. Events are dropped when the queue is full
+        queue_size: max number of pages waiting between the fetch, map and push stages of stream_to_cep
+        phenomenon: name of the payload attribute holding the results, i.e. the phenomenon of the input stream of
+        the receiver. Defaults to the phenomenon of stream_definition
+        routes: dictionary of event id: (receiver endpoint, CompiledCondition or None, DeliveryQueue or None),
+        optional. If given, the observations are routed to the events whose extent contains them (see router),
+        filtered by the condition of each event, and pushed in batches of batch_size events to the receiver (or the
+        delivery queue) of the event, instead of receiver_endpoint. An observation is pushed once to a receiver
+        shared by several events (see SharedStreamRegistry). Used to push the observations of a
+        fetch_planner.FetchGroup
+        router: ExtentIndex of the events of the routes. Defaults to the process-wide index of the active events
+        (see get_extent_index)
+        pipeline_stats: items (pages), busy and waiting seconds and throughput (pages per busy second) of every
+        stage in the last call to stream_to_cep, and its elapsed seconds
     """
     stream_definition = {'name': 'geosmart.remote.test100', 'version': '1.0.0', 'nickName': 'streamTest', 'description': 'stream test', 'metaData': [{'name': 'observation_id', 'type': 'LONG'}, {'name': 'result_time', 'type': 'STRING'}, {'name': 'symbol', 'type': 'STRING'}], 'correlationData': [{'name': 'generator_id', 'type': 'STRING'}], 'payloadData': [{'name': 'Temperature', 'type': 'DOUBLE'}, {'name': 'x_coord', 'type': 'DOUBLE'}, {'name': 'y_coord', 'type': 'DOUBLE'}]}
         #  TODO:  remove dependency of the above stream definition, specially on the payloadData (phenomena name)
 
-    def __init__(self, observation_data, expiration_, receiver_endpoint, update_frequency=5, max_workers=1):
+    def __init__(self, observation_data, expiration_, receiver_endpoint, update_frequency=5, max_workers=1,
+                 batch_size=None, batch_bytes=512 * 1024, flush_interval=1.0, on_batch=None, prefilter=None,
+                 aggregation=None, delivery=None, queue_size=4, phenomenon=None, routes=None, router=None):
         self.observation_data = observation_data # a list of observations
         # self.cep_url = cep_receiver
         self.update_frequency = update_frequency # seconds
-        self.expiration = expiration_
+        self.set_expiration(expiration_)
         self._id = str(uuid.uuid4()) # id
         self.workers = max_workers
         # self.gevent_id = gevent_id
         self.running = True
         self.receiver = receiver_endpoint
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.flush_interval = flush_interval
+        self.on_batch = on_batch
+        self.batch_results = []
+        if phenomenon is not None:
+            self.stream_definition = dict(self.stream_definition, payloadData=[
+                dict(self.stream_definition['payloadData'][0], name=phenomenon)] +
+                self.stream_definition['payloadData'][1:])
+        self.mapper = cep.EventMapper(self.stream_definition)
+        self.prefilter = prefilter
+        self.aggregation = aggregation
+        self.delivery = delivery
+        self.queue_size = queue_size
+        self.routes = routes
+        self.router = router
+        self.pipeline_stats = {}
+        self.expired = threading.Event()
+        self._scheduler = None
+        self._tasks = []
+
+    def set_expiration(self, expiration_):
+        """
+        Change the expiration of the generator. A scheduled expiration (see schedule) is not changed
+        :param expiration_: ISO formatted time in UTC, or datetime. Naive datetimes are taken as UTC
+        """
+        if isinstance(expiration_, datetime.datetime):
+            self.expiration_time = as_utc(expiration_)
+            self.expiration = self.expiration_time.strftime("%Y-%m-%dT%H:%M:%SZ")
+        else:
+            self.expiration = expiration_
+            self.expiration_time = as_utc(datetime.datetime.strptime(expiration_, "%Y-%m-%dT%H:%M:%SZ"))
 
     def stream_to_cep(self, workers=None):
         """
@@ -452,45 +1220,338 @@ class StreamGenerator:
         :param workers: max number of threads to push data
         :return:
         """
-        # start session at Sensor API
-        # sensor_api = requests.Session()
-        # start session at CEP server
-        # cep_engine = requests.Session()
-        if datetime.datetime.now() < datetime.datetime.strptime(self.expiration, "%Y-%m-%dT%H:%M:%SZ"):
-            # retrieve data
-            # TODO: check for time stamp for avoiding sending redundant data
-
-            # map observations
-            mapped_observations = []
-            for d in self.observation_data:
-                data_unit = d['Datastreams']
-                location = d['Locations'][0]['location']
-                coords = get_xy_coord(location)
-
-                # format data
-                mapped_obs = cep.map_datatastream(self._id, data_unit, coords, self.stream_definition)
-                mapped_observations.append(mapped_obs)
+        if datetime.datetime.now(datetime.timezone.utc) < self.expiration_time:
+            # observations already pushed are dropped by Buffers in incremental mode
 
             # push data to cep server
             if workers is None:
                 workers = self.workers
 
+            # pages are fetched, mapped and pushed by the stages of a pipeline, see _run_pipeline
+            pages = self._observation_source()
+
+            if self.routes is not None:
+                self._stream_routes(pages, workers)
+                return True
+
+            if self.delivery is not None:
+                batcher = EventBatcher(self.delivery.receiver, self.batch_size or 1, self.batch_bytes, None,
+                                       delivery=self.delivery)
+                self._run_pipeline(pages, self._encode_page, batcher.add_encoded)
+                self.batch_results = batcher.join()
+                return True
+
+            if self.batch_size is not None:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                    batcher = EventBatcher(self.receiver, self.batch_size, self.batch_bytes, self.flush_interval,
+                                           executor, self.on_batch)
+                    self._run_pipeline(pages, self._encode_page, batcher.add_encoded)
+                    self.batch_results = batcher.join()
+                return True
+
+            # observations are submitted as they are mapped; the number of pending posts is bounded, so
+            # memory use does not grow with the number of observations
+            max_pending = 2 * workers
             with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
-                future_to_generator = {executor.submit(push_to_cep, data, self.receiver): data for data in mapped_observations}
-                for future in concurrent.futures.as_completed(future_to_generator):
-                    data = future_to_generator[future]
-                    try:
-                        response = future.result()
-                    except Exception as exc:
-                        print('Post request raised an exception for data: %s, %r' % (data, exc))
-                    else:
-                        print(response)
-                        pass
+                future_to_generator = {}
+
+                def push(mapped_obs, receipt):
+                    if receipt is not None:
+                        receipt.add()
+                    future_to_generator[executor.submit(push_to_cep, mapped_obs, self.receiver)] = (mapped_obs,
+                                                                                                    receipt)
+                    if len(future_to_generator) >= max_pending:
+                        done, _ = concurrent.futures.wait(future_to_generator,
+                                                          return_when=concurrent.futures.FIRST_COMPLETED)
+                        self._report_pushes(done, future_to_generator)
+                self._run_pipeline(pages, self._map_page, push)
+                self._report_pushes(future_to_generator.copy(), future_to_generator)
 
         else:
             print("EventStreamer has expired. Expiration: ", self.expiration)
         return True
 
+    def schedule(self, scheduler, workers=None):
+        """
+        Push observations every update_frequency seconds, starting now, until the expiration of the generator
+        :param scheduler: Scheduler running the pushes
+        :param workers: max number of threads to push data
+        :return: list of scheduled tasks
+        """
+        name = 'generator-' + self._id
+        expiration = self.expiration_time
+        self._scheduler = scheduler
+        self._tasks = [scheduler.schedule_periodic(name, self.update_frequency, lambda: self.stream_to_cep(workers),
+                                                   delay=0),
+                       scheduler.schedule_at(name + '-expiration', expiration, self.unschedule)]
+        return self._tasks
+
+    def unschedule(self):
+        """ Stop scheduled pushes and mark the generator as expired"""
+        if self._scheduler is not None:
+            for task in self._tasks:
+                self._scheduler.cancel(task)
+        self._tasks = []
+        self.running = False
+        self.expired.set()
+
+    def _observation_source(self):
+        """
+        Observation data to push, as an iterable of (page, receipt). Pages are ObservationStores or lists of
+        Things. Receipts confirm the observations of a page in their Buffer once they were pushed (see _Receipt),
+        and are None unless the data comes from a Buffer in incremental mode.
+        Observations are aggregated when the generator has an aggregation
+        """
+        data = self.observation_data
+        buffer = data if isinstance(data, Buffer) and data.incremental else None
+        if isinstance(data, Buffer):
+            if data.store is not None:
+                data = data.store
+            elif data.data is None:
+                data = data.iter_data()
+            else:
+                data = data.data
+
+        if self.aggregation is not None:
+            if not isinstance(data, ObservationStore):
+                data = ObservationStore.from_things(data)
+            receipt = _Receipt(buffer, data.observation_id.tolist()) if buffer is not None else None
+            return [(self.aggregation.apply(data), receipt)]
+
+        if isinstance(data, ObservationStore):
+            return [(data, _Receipt(buffer, data.observation_id.tolist()) if buffer is not None else None)]
+        return self._iter_pages(data, buffer)
+
+    @staticmethod
+    def _iter_pages(things, buffer=None, page_size=200):
+        """ Group Things into pages, with a receipt for the observations of every page when buffer is given"""
+        page = []
+        for thing in things:
+            page.append(thing)
+            if len(page) == page_size:
+                yield page, _Receipt(buffer, _observation_ids(page)) if buffer is not None else None
+                page = []
+        if page:
+            yield page, _Receipt(buffer, _observation_ids(page)) if buffer is not None else None
+
+    def _prefilter_page(self, page):
+        """ Drop the observations of a page which cannot match the prefilter"""
+        if self.prefilter is None:
+            return page
+        if isinstance(page, ObservationStore):
+            return self.prefilter.filter_store(page, self.mapper.phenomenon)
+        return self.prefilter.filter_things(page, self.mapper.phenomenon)
+
+    def _run_pipeline(self, pages, map_page, push):
+        """
+        Fetch, map and push pages of observations in three stages running concurrently: a page is mapped while
+        the next one is fetched from the Sensor API, and pushed while the next one is mapped. Statistics of the
+        stages are kept in pipeline_stats
+        :param pages: iterable of (page, receipt), see _observation_source
+        :param map_page: callable mapping a (page, receipt) into (list of events, receipt)
+        :param push: callable(event, receipt) sending an event
+        """
+        def push_page(mapped):
+            events, receipt = mapped
+            for event in events:
+                push(event, receipt)
+            if receipt is not None:
+                receipt.close()
+
+        pipeline = Pipeline([('map', lambda page: [map_page(page)]), ('push', push_page)], self.queue_size)
+        self.pipeline_stats = pipeline.run(pages)
+        self.pipeline_stats['elapsed'] = pipeline.elapsed
+
+    def _map_page(self, item):
+        """ Map a page of observations into the CEP format. Columnar data is converted column by column"""
+        page, receipt = item
+        page = self._prefilter_page(page)
+        if isinstance(page, ObservationStore):
+            return [cep.map_observation(self._id, observation_id, result_time, symbol, result, [x, y],
+                                        self.stream_definition)
+                    for observation_id, result_time, symbol, result, x, y in page.records()], receipt
+        return [self._map_observation(observation) for observation in page], receipt
+
+    def _encode_page(self, item):
+        """ Map a page of observations with the compiled mapper of the generator, as JSON bytes"""
+        page, receipt = item
+        page = self._prefilter_page(page)
+        if isinstance(page, ObservationStore):
+            return self.mapper.map_store(page, self._id), receipt
+        return self.mapper.map_things(page, self._id), receipt
+
+    def _stream_routes(self, pages, workers):
+        """ Push the observations of every page to the receivers of the events containing them, see routes"""
+        routes = dict(self.routes)  # events may be added or removed while the pages are pushed
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            batchers = {}  # receiver: EventBatcher
+            for receiver, condition, delivery in routes.values():
+                if receiver in batchers:
+                    continue
+                if delivery is not None:
+                    batchers[receiver] = EventBatcher(delivery.receiver, self.batch_size or 1, self.batch_bytes, None,
+                                                      delivery=delivery)
+                else:
+                    batchers[receiver] = EventBatcher(receiver, self.batch_size or 1, self.batch_bytes,
+                                                      self.flush_interval, executor, self.on_batch)
+
+            def push(routed, receipt):
+                receiver, event = routed
+                batchers[receiver].add_encoded(event, receipt)
+            self._run_pipeline(pages, lambda item: self._route_page(item, routes), push)
+            self.batch_results = [result for batcher in batchers.values() for result in batcher.join()]
+
+    def _route_page(self, item, routes):
+        """ Split a page of observations among the receivers of the events of the routes, as (receiver, event as
+        JSON bytes). Observations matching several events of the same receiver are pushed once"""
+        page, receipt = item
+        store = page if isinstance(page, ObservationStore) else ObservationStore.from_things(page)
+        router = self.router if self.router is not None else get_extent_index()
+        selected = {}  # receiver: boolean mask of the observations pushed to it
+        for event_id, rows in router.route(store.x, store.y).items():
+            route = routes.get(event_id)
+            if route is None or len(rows) == 0:
+                continue
+            receiver, condition, _ = route
+            if condition is not None:
+                rows = rows[condition.mask({self.mapper.phenomenon: store.result[rows]}, len(rows))]
+            mask = selected.get(receiver)
+            if mask is None:
+                mask = selected[receiver] = np.zeros(len(store), dtype=bool)
+            mask[rows] = True
+        events = []
+        for receiver, mask in selected.items():
+            events.extend((receiver, event) for event in self.mapper.map_store(store.select(mask), self._id))
+        return events, receipt
+
+    def _map_observation(self, observation):
+        """ Map a Thing with its latest observation into the CEP format"""
+        data_unit = observation['Datastreams']
+        location = observation['Locations'][0]['location']
+        coords = get_xy_coord(location)
+
+        # format data
+        return cep.map_datatastream(self._id, data_unit, coords, self.stream_definition)
+
+    @staticmethod
+    def _report_pushes(futures, future_to_generator):
+        """ Report the results of completed posts and forget them"""
+        for future in concurrent.futures.as_completed(futures):
+            data, receipt = future_to_generator.pop(future)
+            try:
+                response = future.result()
+            except Exception as exc:
+                print('Post request raised an exception for data: %s, %r' % (data, exc))
+                delivered = False
+            else:
+                print(response)
+                delivered = True
+            if receipt is not None:
+                receipt.settle(delivered)
+
+
+class SharedStreamRegistry:
+    """
+    Input streams and http receivers shared by all the events observing the same phenomenon.
+    Every phenomenon has one input stream and one receiver, so observations are pushed once whatever the number
+    of events using them. The registry counts the events using every shared file: a file is deployed by its first
+    user and removed by its last one.
+    Attributes:
+        root_url: root URL of the http receivers of the CEP server
+        version: version of the shared streams
+    """
+
+    version = '1.0.0'
+
+    def __init__(self, cep_config):
+        self.root_url = cep_config['root url']
+        self._lock = threading.Lock()
+        self._files = {}  # file path: {"digest": hash of the deployed content, "users": event ids, "lock": Lock}
+
+    @staticmethod
+    def key(phenomenon):
+        """ Alphanumeric key of a phenomenon, used in names of streams and receivers"""
+        return re.sub('[^0-9A-Za-z]', '', phenomenon)
+
+    def stream_name(self, phenomenon):
+        return 'geosmart.stream.in.shared.' + self.key(phenomenon)
+
+    def receiver_id(self, phenomenon):
+        return 'shared' + self.key(phenomenon)
+
+    def receiver_endpoint(self, phenomenon):
+        """
+        :param phenomenon: name of the phenomenon
+        :return: URL of the shared receiver, where observations of the phenomenon are pushed
+        """
+        return self.root_url + '/httpReceiver' + self.receiver_id(phenomenon)
+
+    def definitions(self, phenomenon, data_type):
+        """
+        Definitions of the shared input stream and receiver of a phenomenon
+        :param phenomenon: name of the phenomenon
+        :param data_type: CEP data type of the phenomenon. Ex. DOUBLE
+        :return: stream definition (JSON object), receiver definition (XML)
+        """
+        stream = cep.define_stream(self.stream_name(phenomenon), {"name": phenomenon, "data type": data_type},
+                                   self.version, description='')
+        receiver = cep.define_receiver(self.receiver_id(phenomenon), stream['name'], self.version)
+        return stream, receiver
+
+    def acquire(self, event_id, file_path, digest, upload):
+        """
+        Register an event as user of a shared file, deploying the file if it is not deployed yet
+        :param event_id: id of the event
+        :param file_path: path of the shared file in the CEP server
+        :param digest: hash of the content of the file
+        :param upload: callable without arguments deploying the file. Returns True on success
+        :return: True when the file is deployed
+        """
+        entry = self._entry(file_path)
+        with entry["lock"]:
+            if entry["digest"] != digest:
+                if entry["users"] - {event_id}:
+                    raise ValueError('Shared file is deployed with a different definition: %s' % file_path)
+                if not upload():
+                    return False
+                entry["digest"] = digest
+            entry["users"].add(event_id)
+        return True
+
+    def release(self, event_id, file_path, remove):
+        """
+        Unregister an event as user of a shared file, removing the file when no other event uses it
+        :param event_id: id of the event
+        :param file_path: path of the shared file in the CEP server
+        :param remove: callable without arguments removing the file. Returns True on success
+        :return: True when the event does not use the file anymore
+        """
+        entry = self._entry(file_path)
+        with entry["lock"]:
+            users = entry["users"] - {event_id}
+            if not users and entry["digest"] is not None:
+                if not remove():
+                    return False
+                entry["digest"] = None
+            entry["users"] = users
+        return True
+
+    def users(self, file_path):
+        """
+        :param file_path: path of a shared file in the CEP server
+        :return: set of ids of the events using the file
+        """
+        with self._lock:
+            entry = self._files.get(file_path)
+            return set(entry["users"]) if entry is not None else set()
+
+    def _entry(self, file_path):
+        with self._lock:
+            entry = self._files.get(file_path)
+            if entry is None:
+                entry = self._files[file_path] = {"digest": None, "users": set(), "lock": threading.Lock()}
+            return entry
+
 
 class EventHandler:
     """
@@ -498,65 +1559,90 @@ class EventHandler:
     Attributes:
     event: gevent object
     config: configuration details to access a CEP server.
+    deployer: cep.Deployer used for all the (un)deployments of the handler. If None, a deployer is created for
+    every (un)deployment, as defined in the configuration (see cep.get_deployer)
+    shared_streams: SharedStreamRegistry. If given, the event uses the shared input streams and receivers of its
+    phenomena instead of its own, and its execution plans select the events located in its extent
 
     """
 
-    def __init__(self, gevent, config_file):
+    # kind, directory parameter, file prefix, separator and extension of the configuration files
+    _artifact_layout = [("streams", 'stream subdir', 'stream-', '-', '.json'),
+                        ("receivers", 'receiver subdir', 'receiver-', '_', '.xml'),
+                        ("plans", 'plan subdir', 'plan-', '-', '.siddhiql'),
+                        ("publishers", 'publisher subdir', 'pub-', '-', '.xml')]
+
+    def __init__(self, gevent, config_file, deployer=None, shared_streams=None):
         self.event = gevent
         self.event_id = gevent.id_
         self.cep_config = config_file['geosmart.sys']['cep']
         self.handler_conf = config_file['geosmart.sys']['handler']
+        self.deployer = deployer
+        self.shared_streams = shared_streams
         # self.username = config['Geosmart.sys']['cep']['username']
         # self.receiver_name = 'httpReciever.' + gevent.id_
         # self.stream_name = 'stream.' + gevent.id_  # will be more at least two
         # self.detection_plan_name = 'plan.' + gevent.id_  # may be more than one
         # self.publisher = 'publisher.' + gevent.id_  # may be more than one
         self.deployed_files = {"streams": [], "receivers": [], "plans": [], "publishers": []}
+        self.deployed_artifacts = {}  # file path: hash of the content deployed in the CEP server
+        self.artifact_changes = {}  # files uploaded, unchanged and removed by the last deployment
         self.status = False
         self.file_count = 0
-
-    def deploy_cep_configuration(self, publisher_target):
-        """ Create and deploy configuration files in the CEP server.
-        Configuration files include definitions for streams, receivers, execution plans
-        and publisher
+        self.deployment_stats = {}  # handshakes and time per phase of the last (un)deployment
+        self.receiver_endpoints = []  # URLs of the http receivers of the event
+        self.deployment_latency = None  # seconds from the start of the deployment until all artifacts were live
+        self._deploy_start = None
+        self._shared_paths = set()  # paths of the shared files used by the event
+
+    def prepare_cep_configuration(self, publisher_target):
+        """ Create the definitions of the configuration files for the CEP server
         :param publisher_target: URL target to push event notifications
+        :return: dictionary with the lists of "streams" (JSON objects), "receivers", "plans" and "publishers",
+        and the list of "shared" (definition, file name) pairs, for definitions shared with other events
         """
         phenomena = self.event.phenomena_names() # list of names of phenomena to be detected
         print('phenomena: ', phenomena)
         streams_in = []
         receivers = []
+        receiver_endpoints = []
+        shared = []
         ind = 1
         # define receivers and associated event streams
         print('*** Preparing files for deployments...')
         for phenomenon in phenomena:
-            stream_name = 'geosmart.stream.in.' + self.event_id + '_' + str(ind)
-            version = '1.0.0'
-            phenomenon = {"name": phenomenon, "data type": self.event.phenomenon_json_type(phenomenon)}
-            s = cep.define_stream(stream_name, phenomenon, version, description='')
-            receiver_id = self.event_id + str(ind)
-            r = cep.define_receiver(receiver_id, stream_name, version)
+            if self.shared_streams is not None:
+                s, r = self.shared_streams.definitions(phenomenon, self.event.phenomenon_json_type(phenomenon))
+                receiver_endpoints.append(self.shared_streams.receiver_endpoint(phenomenon))
+                file_name = 'shared-' + self.shared_streams.key(phenomenon)
+                shared.extend([(s, file_name), (r, file_name)])
+            else:
+                stream_name = 'geosmart.stream.in.' + self.event_id + '_' + str(ind)
+                version = '1.0.0'
+                phenomenon = {"name": phenomenon, "data type": self.event.phenomenon_json_type(phenomenon)}
+                s = cep.define_stream(stream_name, phenomenon, version, description='')
+                receiver_id = self.event_id + str(ind)
+                r = cep.define_receiver(receiver_id, stream_name, version)
+                receiver_endpoints.append(self.cep_config['root url'] + '/httpReceiver' + receiver_id)
             receivers.append(r)
             streams_in.append(s)
             ind += 1
 
-        # define plans, output streams,
-        ind = 1
-        plans = [] # collect execution plans
-        streams_out = [] # collect streams linked to executions plans
-        conditions = self.event.conditions
-        condition = conditions.items().__iter__() # will iter over operators (keys)
-        for phenomenon in phenomena:
-            stream_name = 'geosmart.stream.out.' + self.event_id + '_' + str(ind) # create output stream
-            version = '1.0.0'
-            plan_name = 'geosmart.plan.' + self.event_id + str(ind)
-            phenomenon_ = {"name": phenomenon, "data type": self.event.phenomenon_json_type(phenomenon)}
-            so = cep.define_stream(stream_name, phenomenon_, version, description='') # define output stream
-            streams_out.append(so)
-            # query_filter = cep.cep_query(condition.__next__())
-            # print("stream out name ", so, '\n stream in name ', streams_in[ind-1])
-            p = cep.define_execution_plan(plan_name, [streams_in[ind-1]], so, condition.__next__(), description='')  # define execution plan and linked with in and out streams
-            plans.append(p)
-            ind += 1
+        # define a single execution plan for the whole condition tree, and its output stream. Composite events
+        # join the input streams inside a time window as long as the update frequency of the event
+        stream_name = 'geosmart.stream.out.' + self.event_id + '_1'
+        version = '1.0.0'
+        plan_name = 'geosmart.plan.' + self.event_id + '1'
+        phenomena_ = [{"name": phenomenon, "data type": self.event.phenomenon_json_type(phenomenon)}
+                      for phenomenon in phenomena]
+        so = cep.define_stream(stream_name, phenomena_ if len(phenomena_) > 1 else phenomena_[0], version,
+                               description='')
+        streams_out = [so]
+        # shared input streams carry the observations of all events, plans select the ones in the extent
+        extent = self.event.compile().extent if self.shared_streams is not None else None
+        window = str(max(1, int(round(self.event.update_frequency / 1000.0)))) + ' sec'
+        plans = [cep.define_execution_plan(plan_name, streams_in, so, self.event.conditions, description='',
+                                           extent=extent, window=window)]
 
         # define publisher
         publisher_name = 'pub-' + self.event_id
@@ -564,88 +1650,248 @@ class EventHandler:
         # print("output stream: ", streams_out)
         publisher = cep.define_event_publisher(publisher_name, streams_out[0]['name'], streams_out[0]['version'], 'http', publisher_target)
 
+        self.receiver_endpoints = receiver_endpoints
+        return {"streams": streams_in + streams_out, "receivers": receivers, "plans": plans, "publishers": [publisher],
+                "shared": shared}
 
-        # deploy streams
-        print('*** Deploying configuration files to CEP server...')
-        stream_dir = self.cep_config['home directory'] + self.cep_config['stream subdir']
-        for stream in (streams_in + streams_out):
-            s = json.dumps(stream)
-            # file_name = stream['name']
-            with tempfile.TemporaryFile('w+') as fo:
-                fo.write(s)
-                fo.seek(0)
-                fo_name = stream_dir + '/' + 'stream-' +self.event_id + '-' + str(self.file_count) + '.json'
-                cep.upload_to_cep(fo_name, fo, self.cep_config, self.handler_conf)
-                #todo: check for sucessful executions
-                self.deployed_files["streams"].append(fo_name)
-                self.file_count += 1
-        self.status = True
-
-
-        # deploy receivers
-        receiver_dir = self.cep_config['home directory'] + self.cep_config['receiver subdir']
-        for receiver in receivers:
-            r = receiver
+    def cep_artifacts(self, publisher_target):
+        """ Configuration files of the event and their paths in the CEP server. File names depend only on the
+        event id and the position of the definition, so a new version of the event replaces the files in place
+        :param publisher_target: URL target to push event notifications
+        :return: list of (kind, file path, content, hash of the content), in deployment order
+        """
+        configuration = self.prepare_cep_configuration(publisher_target)
+        shared = configuration.get("shared", [])
+        artifacts = []
+        for kind, subdir, prefix, separator, extension in self._artifact_layout:
+            directory = self.cep_config['home directory'] + self.cep_config[subdir]
+            for ind, definition in enumerate(configuration[kind]):
+                content = json.dumps(definition) if kind == 'streams' else definition
+                file_name = next((name for shared_definition, name in shared if shared_definition is definition),
+                                 None)
+                if file_name is None:
+                    file_path = directory + '/' + prefix + self.event_id + separator + str(ind) + extension
+                else:
+                    file_path = directory + '/' + prefix + file_name + extension
+                    self._shared_paths.add(file_path)
+                artifacts.append((kind, file_path, content, hashlib.sha256(content.encode('utf-8')).hexdigest()))
+        return artifacts
+
+    def deploy_cep_configuration(self, publisher_target, session=None):
+        """ Create and deploy configuration files in the CEP server.
+        Configuration files include definitions for streams, receivers, execution plans
+        and publisher. Files already deployed with the same content are not uploaded again, and files of a
+        previous version of the event which are no longer needed are removed
+        :param publisher_target: URL target to push event notifications
+        :param session: cep.Deployer to upload the files. If None, the deployer of the handler is used
+        :return: True when all the files are deployed
+        """
+        self._deploy_start = time.monotonic()
+        self.deployment_latency = None
+        artifacts = self.cep_artifacts(publisher_target)
+        changes = {"uploaded": 0, "unchanged": 0, "removed": 0, "failed": 0}
+
+        # one SSH connection for all files
+        own_session = session is None
+        if own_session:
+            session = self.new_deployer()
+
+        def upload(file_path, content):
             with tempfile.TemporaryFile('w+', encoding='UTF-8') as fo:
-                fo.write(r)
-                fo.seek(0)
-                fo_name = receiver_dir + '/' + 'receiver-' + self.event_id + '_' + str(self.file_count) + '.xml'
-                cep.upload_to_cep(fo_name, fo, self.cep_config, self.handler_conf)
-                self.deployed_files["receivers"].append(fo_name)
-                self.file_count += 1
-        self.status = True
-
-        #  deployed plans
-        plan_dir = self.cep_config['home directory'] + self.cep_config['plan subdir']
-        for plan in plans:
-            p = plan
-            with tempfile.TemporaryFile('w+') as fo:
-                fo.write(p)
+                fo.write(content)
                 fo.seek(0)
-                fo_name = plan_dir + '/' + 'plan-' + self.event_id + '-' + str(self.file_count) + '.siddhiql'
-                cep.upload_to_cep(fo_name, fo, self.cep_config, self.handler_conf)
-                self.deployed_files["plans"].append(fo_name)
-                self.file_count += 1
-
-        # deploy publisher:
-        pub_dir = self.cep_config['home directory'] + self.cep_config['publisher subdir']
-        with tempfile.TemporaryFile('w+') as pub:
-            pub.write(publisher)
-            pub.seek(0)
-            pub_name = pub_dir + '/pub-' + self.event_id + '-' + str(self.file_count) + '.xml'
-            cep.upload_to_cep(pub_name, pub, self.cep_config, self.handler_conf)
-            self.deployed_files["publishers"].append(pub_name)
-            self.file_count += 1
-
-        self.status = True # change status on successful deployment
-        print('*** Deployment is complete!')
+                uploaded = cep.upload_to_cep(file_path, fo, self.cep_config, self.handler_conf, session)
+            changes["uploaded" if uploaded else "failed"] += 1
+            return uploaded
+
+        try:
+            print('*** Deploying configuration files to CEP server...')
+            for kind, file_path, content, digest in artifacts:
+                if file_path in self._shared_paths:
+                    # deployed by the first event using it
+                    uploaded = changes["uploaded"]
+                    if self.shared_streams.acquire(self.event_id, file_path, digest,
+                                                   lambda: upload(file_path, content)):
+                        if changes["uploaded"] == uploaded:
+                            changes["unchanged"] += 1
+                        if file_path not in self.deployed_files[kind]:
+                            self.deployed_files[kind].append(file_path)
+                elif self.deployed_artifacts.get(file_path) == digest:
+                    changes["unchanged"] += 1
+                elif upload(file_path, content):
+                    self.deployed_artifacts[file_path] = digest
+                    if file_path not in self.deployed_files[kind]:
+                        self.deployed_files[kind].append(file_path)
+                else:
+                    self.deployed_artifacts.pop(file_path, None)  # content in the server is unknown
+
+            # files of a previous version of the event, removed in reverse order of deployment
+            required = set(file_path for _, file_path, _, _ in artifacts)
+            for kind, _, _, _, _ in reversed(self._artifact_layout):
+                for file_path in list(reversed(self.deployed_files[kind])):
+                    if file_path not in required:
+                        if self._remove_artifact(kind, file_path, session):
+                            changes["removed"] += 1
+                        else:
+                            changes["failed"] += 1
+        finally:
+            # released also when a shared file cannot be acquired or an upload raises
+            if own_session:
+                self._release_deployer(session)
+        self.file_count = sum(len(files) for files in self.deployed_files.values())
+        self.artifact_changes = changes
+        self.status = changes["failed"] == 0  # change status on successful deployment
+        print('*** Deployment is complete! %s' % changes)
         return self.status
 
-    def undeploy_cep_configuration(self):
-        """ Delete configurations files from CEP server"""
+    def update_event(self, gevent, publisher_target, session=None):
+        """ Replace the event of the handler by a new version of it, and deploy only the configuration files
+        that changed. Ex. when only a threshold changed, only the execution plan is uploaded
+        :param gevent: new version of the GEvent. It must have the id of the event of the handler, which gives
+        the names of the files
+        :param publisher_target: URL target to push event notifications
+        :param session: cep.Deployer to upload the files. If None, the deployer of the handler is used
+        :return: True when all the files are deployed
+        """
+        if gevent.id_ != self.event_id:
+            raise ValueError('The new version of the event must have the id %s, not %s' % (self.event_id, gevent.id_))
+        self.event = gevent
+        return self.deploy_cep_configuration(publisher_target, session)
+
+    def wait_until_ready(self, timeout=60, initial_delay=0.25, max_delay=5, session=None):
+        """ Wait until the CEP server has picked up the deployed files.
+        The configuration directories are listed through SFTP until they contain all the deployed files, then the
+        http receivers are polled until they are live (any response other than 404 or 5xx). Polling backs off
+        exponentially from initial_delay to max_delay. A session of the handler that fails a listing is released and
+        opened again on the next poll; a session given by the caller is kept open.
+        :param timeout: maximum time to wait, in seconds
+        :param initial_delay: seconds between the first polls
+        :param max_delay: maximum seconds between polls
+        :param session: cep.Deployer to list the directories. If None, the deployer of the handler is used
+        :return: True when all the artifacts are live, False on timeout. The time since the start of the deployment
+        is recorded in deployment_latency
+        """
+        deadline = time.monotonic() + timeout
+        own_session = session is None
+        sessions = [session]
 
-        print(str(self.file_count + 1), ' Files will be removed from CEP server')
-        print('*** Execution in progress...')
+        def files_deployed(argument=None):
+            if sessions[0] is None:
+                sessions[0] = self.new_deployer()
+            try:
+                return self._files_deployed(sessions[0])
+            except Exception as e:
+                log.warning('Listing of the CEP directories failed: %s' % e)
+                if own_session:
+                    self._release_deployer(sessions[0])
+                    sessions[0] = None
+                return False
 
         try:
-            for stream in self.deployed_files['streams']:
-                cep.remove_from_cep(stream, self.cep_config, self.handler_conf)
+            ready = self._poll(files_deployed, None, deadline, initial_delay, max_delay) and \
+                self._poll(self._receivers_live, None, deadline, initial_delay, max_delay)
+        finally:
+            if own_session and sessions[0] is not None:
+                self._release_deployer(sessions[0])
+        if ready:
+            if self._deploy_start is not None:
+                self.deployment_latency = time.monotonic() - self._deploy_start
+            log.info('CEP configuration of %s is live after %s seconds' % (self.event_id, self.deployment_latency))
+        else:
+            log.warning('CEP configuration of %s was not live after %s seconds' % (self.event_id, timeout))
+        return ready
+
+    @staticmethod
+    def _poll(check, argument, deadline, delay, max_delay):
+        while True:
+            if check(argument):
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, max_delay)
+
+    def _files_deployed(self, session):
+        """ True when every deployed file is present in its directory of the CEP server. Errors of the listing
+        are raised"""
+        directories = {}
+        for files in self.deployed_files.values():
+            for file_path in files:
+                directory, _, name = file_path.rpartition('/')
+                directories.setdefault(directory, set()).add(name)
+        for directory, names in directories.items():
+            if not names.issubset(session.listdir(directory)):
+                return False
+        return True
 
-            for receiver in self.deployed_files['receivers']:
-                cep.remove_from_cep(receiver, self.cep_config, self.handler_conf)
+    def _receivers_live(self, argument=None):
+        """ True when every http receiver of the event answers. Undeployed receivers answer with 404"""
+        client = http_client.get_client()
+        for endpoint in self.receiver_endpoints:
+            try:
+                r = client.get(endpoint, verify=False, timeout=5)
+            except requests.exceptions.RequestException:
+                return False
+            if r.status_code == 404 or r.status_code >= 500:
+                return False
+        return True
 
-            for plan in self.deployed_files['plans']:
-                cep.remove_from_cep(plan, self.cep_config, self.handler_conf)
+    def undeploy_cep_configuration(self, session=None):
+        """ Delete configurations files from CEP server
+        :param session: cep.Deployer to remove the files. If None, the deployer of the handler is used
+        """
 
-            for publisher in self.deployed_files['publishers']:
-                cep.remove_from_cep(publisher, self.cep_config, self.handler_conf)
+        print(str(self.file_count), ' Files will be removed from CEP server')
+        print('*** Execution in progress...')
+
+        own_session = session is None
+        if own_session:
+            session = self.new_deployer()
+        try:
+            for kind, _, _, _, _ in self._artifact_layout:
+                for file_path in list(self.deployed_files[kind]):
+                    self._remove_artifact(kind, file_path, session)
         except:
             return self.status
         else:
-            self.status = False # return status to initial state
-            print('**Undeploy complete!')
+            if not any(self.deployed_files.values()):
+                self.status = False # return status to initial state
+                print('**Undeploy complete!')
+        finally:
+            if own_session:
+                self._release_deployer(session)
+            self.file_count = sum(len(files) for files in self.deployed_files.values())
         return self.status
 
+    def _remove_artifact(self, kind, file_path, session):
+        def remove():
+            return cep.remove_from_cep(file_path, self.cep_config, self.handler_conf, session)
+
+        if file_path in self._shared_paths:
+            # removed by the last event using it
+            removed = self.shared_streams.release(self.event_id, file_path, remove)
+        else:
+            removed = remove()
+        if not removed:
+            return False
+        self.deployed_artifacts.pop(file_path, None)
+        self.deployed_files[kind].remove(file_path)
+        return True
+
+    def new_deployer(self):
+        """
+        :return: the deployer of the handler, or a new deployer as defined in the configuration
+        """
+        if self.deployer is not None:
+            return self.deployer
+        return cep.get_deployer(self.cep_config, self.handler_conf)
+
+    def _release_deployer(self, deployer):
+        if deployer is not self.deployer:
+            deployer.close()
+        self.deployment_stats = deployer.stats()
+
     # def create_stream_generators(self, api_url):
     #     """Create generators using the StramGenerator class"""
     #
@@ -663,3 +1909,139 @@ class EventHandler:
         # stopt generator
         # remove deployed files
 
+
+class _SessionPool:
+    """
+    Deployers lent to the workers of a DeploymentOrchestrator, one worker at a time. The deployer of a handler is
+    the only one in its pool and is not closed; other pools create up to max_sessions deployers from the
+    configuration of the handler, when they are needed
+    """
+
+    def __init__(self, handler, max_sessions):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._created = []
+        self._owned = handler.deployer is None
+        if self._owned:
+            self._new = lambda: cep.get_deployer(handler.cep_config, handler.handler_conf)
+            self._max_sessions = max_sessions
+        else:
+            self._used = [handler.deployer]
+            self._queue.put(handler.deployer)
+
+    def borrow(self):
+        if self._owned:
+            with self._lock:
+                if self._queue.empty() and len(self._created) < self._max_sessions:
+                    self._created.append(self._new())
+                    return self._created[-1]
+        return self._queue.get()
+
+    def give_back(self, session):
+        self._queue.put(session)
+
+    def close(self):
+        """
+        Close the deployers created by the pool
+        :return: list of the deployers used
+        """
+        if not self._owned:
+            return self._used
+        for session in self._created:
+            session.close()
+        return self._created
+
+
+class DeploymentOrchestrator:
+    """
+    Deploys and undeploys the CEP configurations of many events at once.
+    Every event is deployed by a single worker, in the order required by the CEP (streams, then receivers and
+    plans, then publishers), while the files of different events are uploaded concurrently. Workers borrow
+    deployers (SFTP sessions) from a bounded pool, so at most max_sessions connections are open to the CEP server.
+    Handlers with their own deployer (see EventHandler) are deployed with it, one at a time per deployer.
+    Attributes:
+        max_sessions: maximum number of concurrent deployers, i.e. SFTP sessions (and workers)
+        results: dictionary of event id: deployment status of the last run. None when the run raised an exception
+        stats: handshakes, files and time per phase of all the sessions of the last run, and its wall time
+    """
+
+    def __init__(self, max_sessions=4):
+        self.max_sessions = max_sessions
+        self.results = {}
+        self.stats = {}
+
+    def deploy(self, handlers, publisher_target):
+        """
+        Deploy the CEP configuration of every handler
+        :param handlers: list of EventHandler
+        :param publisher_target: URL target to push event notifications
+        :return: dictionary of event id: deployment status
+        """
+        return self._run(handlers, lambda handler, session: handler.deploy_cep_configuration(publisher_target,
+                                                                                            session))
+
+    def undeploy(self, handlers):
+        """
+        Delete the CEP configuration files of every handler
+        :param handlers: list of EventHandler
+        :return: dictionary of event id: deployment status (False once the files were removed)
+        """
+        return self._run(handlers, lambda handler, session: handler.undeploy_cep_configuration(session))
+
+    def _run(self, handlers, operation):
+        self.results = {}
+        if not handlers:
+            self.stats = {}
+            return self.results
+        workers = min(self.max_sessions, len(handlers))
+        pools = {}  # key of the deployer of a handler: _SessionPool
+        for handler in handlers:
+            key = self._pool_key(handler)
+            if key not in pools:
+                pools[key] = _SessionPool(handler, workers)
+
+        def work(handler):
+            pool = pools[self._pool_key(handler)]
+            session = pool.borrow()
+            try:
+                return operation(handler, session)
+            finally:
+                pool.give_back(session)
+
+        start = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(work, handler): handler for handler in handlers}
+            for future in concurrent.futures.as_completed(futures):
+                handler = futures[future]
+                try:
+                    self.results[handler.event_id] = future.result()
+                except Exception as e:
+                    print('*** Deployment of event %s failed: %s' % (handler.event_id, e))
+                    self.results[handler.event_id] = None
+        wall_time = time.perf_counter() - start
+
+        sessions = []
+        for pool in pools.values():
+            sessions.extend(pool.close())
+        self.stats = self._merge_stats([session.stats() for session in sessions])
+        self.stats["sessions"] = len(sessions)
+        self.stats["wall time"] = wall_time
+        return self.results
+
+    @staticmethod
+    def _pool_key(handler):
+        """ Handlers with their own deployer use it; the others share deployers created from their configuration"""
+        if handler.deployer is not None:
+            return 'deployer', id(handler.deployer)
+        return 'config', json.dumps([handler.cep_config, handler.handler_conf], sort_keys=True)
+
+    @staticmethod
+    def _merge_stats(stats):
+        merged = {"handshakes": 0, "files": {}, "timings": {}}
+        for stat in stats:
+            merged["handshakes"] += stat["handshakes"]
+            for key, value in stat["files"].items():
+                merged["files"][key] = merged["files"].get(key, 0) + value
+            for key, value in stat["timings"].items():
+                merged["timings"][key] = merged["timings"].get(key, 0.0) + value
+        return merged
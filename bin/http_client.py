@@ -0,0 +1,146 @@
+"""
+Project: Formalizer. Pooled HTTP client shared by the Sensor API requests and the CEP receivers
+License: MIT
+"""
+
+import threading
+import weakref
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class HttpClient:
+    """
+    Thread-safe HTTP client keeping pools of keep-alive connections.
+    Every thread gets its own requests.Session, but all sessions share the same connection pools,
+    so a connection opened by one thread can be reused by any other. Sessions are only referenced by their
+    thread, and released when it exits (ex. the workers of a ThreadPoolExecutor); connections stay in the pools.
+    Attributes:
+        pool_connections: number of host pools to keep (one pool per host)
+        pool_maxsize: max number of connections kept alive per host
+        pool_block: if True, a request waits for a free connection instead of opening more than pool_maxsize
+        connections to the same host
+        keep_alive: if False, every connection is closed after its request
+        timeout: default timeout in seconds for all requests. None waits forever
+    """
+
+    def __init__(self, pool_connections=10, pool_maxsize=10, pool_block=False, keep_alive=True, timeout=None):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.keep_alive = keep_alive
+        self.timeout = timeout
+        self._adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, pool_block=pool_block)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._sessions = weakref.WeakSet()  # sessions of the threads alive, for close()
+
+    def session(self):
+        """
+        Session of the calling thread
+        :return: requests.Session using the shared connection pools
+        """
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('http://', self._adapter)
+            session.mount('https://', self._adapter)
+            if not self.keep_alive:
+                session.headers['Connection'] = 'close'
+            self._local.session = session
+            with self._lock:
+                self._sessions.add(session)
+        return session
+
+    def request(self, method, url, **kwargs):
+        """
+        Send a request using a pooled connection. Takes the same arguments as requests.request()
+        :return: requests.Response
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session().request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        """
+        Connection reuse across all host pools currently kept by the client
+        :return: dictionary with the number of requests, connections opened and the fraction of requests
+        served by a reused connection, per host and in total, and the number of sessions of live threads
+        """
+        pools = self._adapter.poolmanager.pools
+        hosts = {}
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:  # pool evicted in the meantime
+                continue
+            # the same host may have several pools, e.g. with and without certificate verification
+            host = hosts.setdefault('%s://%s:%s' % (pool.scheme, pool.host, pool.port),
+                                    {"requests": 0, "connections": 0})
+            host["requests"] += pool.num_requests
+            host["connections"] += pool.num_connections
+
+        total_requests = sum(h["requests"] for h in hosts.values())
+        total_connections = sum(h["connections"] for h in hosts.values())
+        for h in hosts.values():
+            h["reuse ratio"] = _reuse_ratio(h["requests"], h["connections"])
+        with self._lock:
+            sessions = len(self._sessions)
+        return {"requests": total_requests, "connections": total_connections,
+                "reuse ratio": _reuse_ratio(total_requests, total_connections), "hosts": hosts,
+                "sessions": sessions}
+
+    def close(self):
+        """ Close all sessions and the connections in the pools"""
+        with self._lock:
+            for session in self._sessions:
+                session.close()
+            self._sessions = weakref.WeakSet()  # sessions of the threads alive, for close()
+        self._adapter.close()
+        self._local = threading.local()
+
+
+def _reuse_ratio(requests_, connections):
+    if requests_ == 0:
+        return 0.0
+    return max(requests_ - connections, 0) / requests_
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def configure(http_conf):
+    """
+    Replace the shared client with one using the given settings
+    :param http_conf: parameters of the HTTP client, as defined in the "http" section of the config.json file
+    :return: the new shared client
+    """
+    global _client
+    client = HttpClient(pool_connections=http_conf.get("pool connections", 10),
+                        pool_maxsize=http_conf.get("pool maxsize", 10),
+                        pool_block=http_conf.get("pool block", False),
+                        keep_alive=http_conf.get("keep alive", True),
+                        timeout=http_conf.get("timeout"))
+    with _client_lock:
+        old_client = _client
+        _client = client
+    if old_client is not None:
+        old_client.close()
+    return client
+
+
+def get_client():
+    """
+    Shared HTTP client, created with default settings on first use
+    :return: HttpClient
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = HttpClient()
+        return _client
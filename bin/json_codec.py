@@ -0,0 +1,123 @@
+"""
+Project: Formalizer. Pluggable JSON encoder and decoder working on bytes, for the push and receive paths.
+Uses orjson when it is installed and the json module of the standard library otherwise
+License: MIT
+"""
+
+import json
+import math
+import threading
+
+try:
+    import orjson
+except ImportError:  # optional dependency
+    orjson = None
+
+
+class StdlibCodec:
+    """ JSON codec of the standard library. Output is compact, without spaces after separators. NaN and infinity
+    are encoded as null, as done by orjson"""
+
+    name = 'stdlib'
+    # json.dumps builds a new encoder for every call with non default arguments
+    _encoder = json.JSONEncoder(separators=(',', ':'), allow_nan=False)
+
+    @staticmethod
+    def dumps(obj):
+        """
+        :param obj: JSON serializable object
+        :return: JSON encoded as UTF-8 bytes
+        """
+        try:
+            return StdlibCodec._encoder.encode(obj).encode('utf-8')
+        except ValueError:  # NaN or infinity, ex. non numeric results stored as NaN
+            return StdlibCodec._encoder.encode(_finite(obj)).encode('utf-8')
+
+    @staticmethod
+    def loads(data):
+        """
+        :param data: JSON as bytes, bytearray, memoryview or str
+        :return: decoded object
+        """
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return json.loads(data)
+
+
+def _finite(obj):
+    """ Copy of an object where NaN and infinite floats are replaced by None"""
+    if isinstance(obj, float):
+        return obj if math.isfinite(obj) else None
+    if isinstance(obj, dict):
+        return {key: _finite(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_finite(value) for value in obj]
+    return obj
+
+
+class OrjsonCodec:
+    """ orjson codec. NaN and infinity are encoded as null, as they are not valid JSON"""
+
+    name = 'orjson'
+
+    @staticmethod
+    def dumps(obj):
+        return orjson.dumps(obj)
+
+    @staticmethod
+    def loads(data):
+        return orjson.loads(data)
+
+
+codecs = {'stdlib': StdlibCodec}
+if orjson is not None:
+    codecs['orjson'] = OrjsonCodec
+
+_codec = None
+_codec_lock = threading.Lock()
+
+
+def configure(name='auto'):
+    """
+    Select the codec used by dumps() and loads()
+    :param name: 'orjson', 'stdlib' or 'auto' (orjson when it is installed)
+    :return: the selected codec
+    """
+    global _codec
+    if name == 'auto':
+        name = 'orjson' if 'orjson' in codecs else 'stdlib'
+    try:
+        codec = codecs[name]
+    except KeyError:
+        raise ValueError('JSON codec is not available: %s' % name)
+    with _codec_lock:
+        _codec = codec
+    return codec
+
+
+def get_codec():
+    """
+    Shared codec, selected with configure('auto') on first use
+    :return: StdlibCodec or OrjsonCodec
+    """
+    if _codec is None:
+        return configure()
+    return _codec
+
+
+def dumps(obj):
+    """
+    Encode an object with the shared codec
+    :param obj: JSON serializable object
+    :return: JSON encoded as UTF-8 bytes
+    """
+    return get_codec().dumps(obj)
+
+
+def loads(data):
+    """
+    Decode JSON with the shared codec
+    :param data: JSON as bytes or str
+    :return: decoded object
+    """
+    return get_codec().loads(data)
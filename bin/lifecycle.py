@@ -0,0 +1,284 @@
+"""
+Project: Formalizer. Activation of events during the interval in which they can be detected.
+Polling of the Sensor API, pushing to the CEP and CEP configurations only exist while the time window and the
+validity of an event are both open. Active events observing the same phenomenon share their polling and pushing
+License: MIT
+"""
+
+import datetime
+import threading
+import traceback
+from bin import gevent
+from bin.delivery import DeliveryQueue
+from bin.fetch_planner import FetchPlanner
+
+
+def _utc(time_):
+    """ Naive datetime in UTC (as parsed from event definitions) to a datetime with time zone"""
+    return time_.replace(tzinfo=datetime.timezone.utc)
+
+
+class EventRuntime:
+    """
+    Resources of the active events: the CEP configuration of every event and, for every phenomenon observed by the
+    active events, a Buffer polling the Sensor API over the cover of their extents (see fetch_planner.FetchPlanner)
+    and a StreamGenerator routing the observations to the receivers of the events whose extent contains them.
+    The load on the Sensor API grows with the number of distinct sensors and not with the number of events
+    Attributes:
+        config: content of the config.json file
+        sensor_api_root: root url to the Sensor API
+        publisher_target: URL target to push event notifications
+        update_interval: seconds between updates of the buffers
+        push_interval: seconds between pushes of the generators. Buffers are not updated in the background: every
+        push streams the pages of the Sensor API through the pipeline of the generator, so the next page is fetched
+        while the previous one is mapped and pushed, and pushes happen every max(update_interval, push_interval)
+        seconds
+        ready_timeout: max seconds to wait for the CEP configuration to be live
+        shared_streams: SharedStreamRegistry, optional. See EventHandler
+        delivery_conf: parameters of the delivery queues, as in the "delivery" section of the config.json file.
+        If given, observations are pushed through a DeliveryQueue per receiver endpoint, shared by the events
+        using the receiver (see SharedStreamRegistry), so a receiver has one queue and one circuit breaker
+        extent_index: ExtentIndex of the active events, routing the observations. Defaults to the process-wide
+        index, where LifecycleManager registers the active events (see gevent.get_extent_index)
+        planner: FetchPlanner of the active events
+    """
+
+    def __init__(self, config, sensor_api_root, publisher_target, update_interval=10, push_interval=5,
+                 ready_timeout=60, shared_streams=None, delivery_conf=None, extent_index=None):
+        self.config = config
+        self.sensor_api_root = sensor_api_root
+        self.publisher_target = publisher_target
+        self.update_interval = update_interval
+        self.push_interval = push_interval
+        self.ready_timeout = ready_timeout
+        self.shared_streams = shared_streams
+        self.delivery_conf = delivery_conf
+        self.extent_index = extent_index if extent_index is not None else gevent.get_extent_index()
+        self.planner = FetchPlanner(sensor_api_root)
+        self._streams = {}  # phenomenon: dictionary with the buffer, generator and push task of the phenomenon
+        self._deliveries = {}  # receiver endpoint: [DeliveryQueue, number of active events using it]
+        self._lock = threading.Lock()
+
+    def activate(self, event, scheduler, until):
+        """
+        Deploy the CEP configuration of an event and route the observations of its phenomena to its receivers
+        :param event: CompiledGEvent
+        :param scheduler: Scheduler running the updates and pushes
+        :param until: end of the active interval, datetime in UTC
+        :return: dictionary with the handler of the event and its receiver endpoints, one per phenomenon
+        """
+        handler = gevent.EventHandler(event.event, self.config, shared_streams=self.shared_streams)
+        handler.deploy_cep_configuration(self.publisher_target)
+        handler.wait_until_ready(self.ready_timeout)
+        receivers = []
+        with self._lock:
+            self.planner.add(event.event)
+            self._update_streams(scheduler, until)
+            # receivers are defined in the order of the phenomena, see EventHandler.prepare_cep_configuration
+            for phenomenon, receiver in zip(event.phenomena, handler.receiver_endpoints):
+                delivery = None
+                if self.delivery_conf is not None:
+                    entry = self._deliveries.get(receiver)
+                    if entry is None:
+                        entry = self._deliveries[receiver] = [DeliveryQueue.from_config(receiver,
+                                                                                        self.delivery_conf), 0]
+                    entry[1] += 1
+                    delivery = entry[0]
+                receivers.append(receiver)
+                self._streams[phenomenon]["generator"].routes[event.id_] = (receiver, event.condition, delivery)
+            self._start_streams(scheduler)
+        return {"handler": handler, "receivers": receivers}
+
+    def deactivate(self, event, scheduler, resources):
+        """
+        Stop routing observations to an event, and remove its CEP configuration. The buffer and generator of a
+        phenomenon are stopped when no active event observes it
+        :param event: CompiledGEvent
+        :param scheduler: Scheduler running the updates and pushes
+        :param resources: as returned by activate()
+        """
+        unused = []  # delivery queues of the receivers without active events
+        with self._lock:
+            for phenomenon in event.phenomena:
+                stream = self._streams.get(phenomenon)
+                if stream is not None:
+                    stream["generator"].routes.pop(event.id_, None)
+            self.planner.remove(event.id_)
+            self._update_streams(scheduler)
+            for receiver in resources["receivers"]:
+                entry = self._deliveries.get(receiver)
+                if entry is not None:
+                    entry[1] -= 1
+                    if entry[1] == 0:
+                        unused.append(self._deliveries.pop(receiver)[0])
+        for delivery in unused:
+            delivery.close(self.ready_timeout)
+        resources["handler"].undeploy_cep_configuration()
+
+    def deliveries(self):
+        """
+        :return: dictionary of receiver endpoint: DeliveryQueue of the receivers of the active events
+        """
+        with self._lock:
+            return {receiver: entry[0] for receiver, entry in self._deliveries.items()}
+
+    def streams(self):
+        """
+        :return: dictionary of phenomenon: (Buffer, StreamGenerator) of the phenomena of the active events
+        """
+        with self._lock:
+            return {phenomenon: (stream["buffer"], stream["generator"]) for phenomenon, stream in self._streams.items()}
+
+    def _update_streams(self, scheduler, until=None):
+        """ Follow the groups of the planner: start the streams of new phenomena, update the requests of the
+        others, and stop the streams of the phenomena without events"""
+        groups = self.planner.groups()
+        for phenomenon in list(self._streams):
+            if phenomenon not in groups:
+                stream = self._streams.pop(phenomenon)
+                if stream["task"] is not None:
+                    scheduler.cancel(stream["task"])
+                stream["generator"].unschedule()
+        for phenomenon, group in groups.items():
+            stream = self._streams.get(phenomenon)
+            if stream is None:
+                # without updates, the generator reads the buffer with iter_data() (see StreamGenerator)
+                buffer = gevent.Buffer(group.requests, self.update_interval, prefetch=False, incremental=True)
+                generator = gevent.StreamGenerator(buffer, until, None, self.push_interval, phenomenon=phenomenon,
+                                                   routes={}, router=self.extent_index)
+                self._streams[phenomenon] = {"buffer": buffer, "generator": generator, "task": None}
+                continue
+            if stream["buffer"].request != group.requests:  # the cover of the group changed
+                stream["buffer"].set_request(group.requests)
+            if until is not None and gevent.as_utc(until) > stream["generator"].expiration_time:
+                stream["generator"].set_expiration(until)
+
+    def _start_streams(self, scheduler):
+        """ Schedule the pushes of new streams, once they have routes. Observations pushed without routes would be
+        confirmed in their buffer without reaching any event"""
+        for phenomenon, stream in self._streams.items():
+            if stream["task"] is None:
+                stream["task"] = scheduler.schedule_periodic('stream-%s-%d' % (phenomenon, id(self)),
+                                                             max(self.update_interval, self.push_interval),
+                                                             stream["generator"].stream_to_cep,
+                                                             delay=0)
+
+
+class LifecycleManager:
+    """
+    Activates every event at the start of the interval in which it can be detected (the intersection of its time
+    window and validity) and deactivates it at the end, using a Scheduler. Events whose interval is already over,
+    or empty, are never activated. Active events are registered in a spatial index of their extents
+    Attributes:
+        scheduler: Scheduler running the activations and deactivations
+        runtime: object with activate(event, scheduler, until) and deactivate(event, scheduler, resources)
+        methods. See EventRuntime
+        extent_index: ExtentIndex of the active events. Defaults to the process-wide index (see
+        gevent.get_extent_index)
+        states: dictionary of event id: 'scheduled', 'active', 'expired' or 'failed'
+    """
+
+    def __init__(self, scheduler, runtime, extent_index=None):
+        self.scheduler = scheduler
+        self.runtime = runtime
+        self.extent_index = extent_index if extent_index is not None else gevent.get_extent_index()
+        self.states = {}
+        self.events = {}  # event id: CompiledGEvent
+        self._resources = {}  # event id: resources of the active events
+        self._lock = threading.Lock()
+
+    def add(self, event, now=None):
+        """
+        Manage the lifecycle of an event
+        :param event: GEvent or CompiledGEvent
+        :param now: current time, datetime with time zone. Defaults to now
+        :return: state of the event
+        """
+        if not isinstance(event, gevent.CompiledGEvent):
+            event = event.compile()
+        if now is None:
+            now = datetime.datetime.now(datetime.timezone.utc)
+        interval = event.active_interval()
+        with self._lock:
+            self.events[event.id_] = event
+            if interval is None or _utc(interval[1]) <= now:
+                self.states[event.id_] = 'expired'
+                return 'expired'
+            self.states[event.id_] = 'scheduled'
+        start, end = _utc(interval[0]), _utc(interval[1])
+        if start <= now:
+            self._activate(event.id_, end)
+        else:
+            self.scheduler.schedule_at('activate-' + event.id_, start, lambda: self._activate(event.id_, end))
+        self.scheduler.schedule_at('deactivate-' + event.id_, end, lambda: self._deactivate(event.id_, 'expired'))
+        return self.states[event.id_]
+
+    def remove(self, event):
+        """
+        Stop managing an event, deactivating it if it is active
+        :param event: GEvent, CompiledGEvent or id of the event
+        """
+        event_id = getattr(event, 'id_', event)
+        self.scheduler.cancel('activate-' + event_id)
+        self.scheduler.cancel('deactivate-' + event_id)
+        self._deactivate(event_id, None)
+        with self._lock:
+            self.events.pop(event_id, None)
+            self.states.pop(event_id, None)
+
+    def active(self):
+        """
+        :return: list of the ids of the active events
+        """
+        with self._lock:
+            return [event_id for event_id, state in self.states.items() if state == 'active']
+
+    def stats(self):
+        """
+        :return: dictionary of state: number of events
+        """
+        counts = {'scheduled': 0, 'active': 0, 'expired': 0, 'failed': 0}
+        with self._lock:
+            for state in self.states.values():
+                counts[state] += 1
+        return counts
+
+    def _activate(self, event_id, end):
+        with self._lock:
+            event = self.events.get(event_id)
+            if event is None or self.states.get(event_id) != 'scheduled':
+                return
+            self.states[event_id] = 'active'
+        # registered before the activation, so the observations pushed from the start are routed to the event
+        self.extent_index.add(event)
+        try:
+            resources = self.runtime.activate(event, self.scheduler, end)
+        except Exception:
+            print('*** Activation of event %s failed' % event_id)
+            traceback.print_exc()
+            self.extent_index.remove(event_id)
+            with self._lock:
+                self.states[event_id] = 'failed'
+            return
+        with self._lock:
+            still_active = self.states.get(event_id) == 'active'
+            if still_active:
+                self._resources[event_id] = resources
+        if not still_active:  # the interval ended, or the event was removed, during the activation
+            self.extent_index.remove(event_id)
+            self.runtime.deactivate(event, self.scheduler, resources)
+
+    def _deactivate(self, event_id, state):
+        with self._lock:
+            event = self.events.get(event_id)
+            resources = self._resources.pop(event_id, None)
+            if event_id in self.states and state is not None:
+                self.states[event_id] = state
+        if resources is None:
+            return
+        self.extent_index.remove(event_id)
+        try:
+            self.runtime.deactivate(event, self.scheduler, resources)
+        except Exception:
+            print('*** Deactivation of event %s failed' % event_id)
+            traceback.print_exc()
@@ -0,0 +1,524 @@
+"""
+Project: Formalizer. Embedded event processor for the CEP configuration files generated by the cep module.
+Runs the filter and join queries of execution plans in-process, as a fallback for the WSO2 server and as a deterministic
+stand-in for throughput tests without network access
+License: MIT
+"""
+
+import collections
+import json
+import re
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+import numpy as np
+from bin import http_client
+from bin import json_codec
+from bin.observation_store import _as_float
+from bin.prefilter import compile_conditions
+
+_numeric_types = {'double', 'float', 'int', 'long'}
+
+_token = re.compile(r"\s*(?:(>=|<=|==|!=|>|<|\(|\)|,)|(-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?)|'([^']*)'|\"([^\"]*)\"|"
+                    r"([A-Za-z_][A-Za-z0-9_]*(?:[.:][A-Za-z_][A-Za-z0-9_]*)?))")
+_plan_name = re.compile(r"@Plan:name\('([^']+)'\)")
+_stream = re.compile(r"@(Import|Export)\('([^']+)'\)\s*define\s+stream\s+(\w+)\s*\(([^)]*)\)")
+_filter = r"\[((?:[^\]']|'[^']*')*)\]"  # brackets in quoted strings, ex. GeoJSON, do not close a filter
+_query = re.compile(r"from\s+(\w+)\s*(?:" + _filter + r")?\s*select\s+(.*?)\s+insert\s+into\s+(\w+)", re.DOTALL)
+_join_side = r"(\w+)\s*(?:" + _filter + r")?\s*#window\.time\(([^)]*)\)\s+as\s+(\w+)"
+_join_query = re.compile(r"from\s+" + _join_side + r"\s+(?:(full|left|right)\s+outer\s+)?join\s+" + _join_side +
+                         r"\s*(?:on\s+(.*?))?\s*select\s+(.*?)\s+insert\s+into\s+(\w+)", re.DOTALL)
+_functions = ('geo:within',)  # functions of Siddhi extensions, evaluated by the pre-filter
+_time_units = {'ms': 0.001, 'millisec': 0.001, 'millisecond': 0.001, 'milliseconds': 0.001, 'sec': 1, 'second': 1,
+               'seconds': 1, 'min': 60, 'minute': 60, 'minutes': 60, 'hour': 3600, 'hours': 3600, 'day': 86400,
+               'days': 86400}
+
+
+def _tokenize(expression):
+    tokens = []
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = _token.match(expression, position)
+        if match is None or match.end() == position:
+            raise ValueError('Filter expression is not supported: %s' % expression)
+        operator, number, quoted, double_quoted, name = match.groups()
+        if operator is not None:
+            tokens.append(('op', operator))
+        elif number is not None:
+            tokens.append(('value', float(number) if ('.' in number or 'e' in number.lower()) else int(number)))
+        elif quoted is not None or double_quoted is not None:
+            tokens.append(('value', quoted if quoted is not None else double_quoted))
+        elif name.lower() in ('and', 'or', 'not'):
+            tokens.append(('op', name.lower()))
+        elif name.lower() in ('true', 'false'):
+            tokens.append(('value', name.lower() == 'true'))
+        else:
+            tokens.append(('var', name))
+        position = match.end()
+    return tokens
+
+
+def filter_to_json_logic(expression):
+    """
+    Translates a Siddhi filter expression into JsonLogic.
+    Supports comparisons (>, >=, <, <=, ==, !=) and geo:within(x, y, '<GeoJSON geometry>'), combined with and, or,
+    not and parenthesis
+    :param expression: filter expression. Ex. Temperature > 25 and not (Luminosity < 3)
+    :return: JsonLogic statement
+    """
+    tokens = _tokenize(expression)
+    position = [0]
+
+    def peek():
+        return tokens[position[0]] if position[0] < len(tokens) else (None, None)
+
+    def take():
+        token = peek()
+        position[0] += 1
+        return token
+
+    def operand():
+        kind, value = take()
+        if kind == 'var':
+            return {"var": value}
+        elif kind == 'value':
+            return value
+        raise ValueError('Filter expression is not supported: %s' % expression)
+
+    def primary():
+        if peek() == ('op', '('):
+            take()
+            statement = or_()
+            if take() != ('op', ')'):
+                raise ValueError('Unbalanced parenthesis in filter expression: %s' % expression)
+            return statement
+        if peek()[0] == 'var' and peek()[1] in _functions and position[0] + 1 < len(tokens) and \
+                tokens[position[0] + 1] == ('op', '('):
+            function = take()[1]
+            take()
+            arguments = [operand()]
+            while peek() == ('op', ','):
+                take()
+                arguments.append(operand())
+            if take() != ('op', ')'):
+                raise ValueError('Unbalanced parenthesis in filter expression: %s' % expression)
+            return {function: arguments}
+        left = operand()
+        kind, operator = take()
+        if kind != 'op' or operator not in ('>', '>=', '<', '<=', '==', '!='):
+            raise ValueError('Filter expression is not supported: %s' % expression)
+        return {operator: [left, operand()]}
+
+    def not_():
+        if peek() == ('op', 'not'):
+            take()
+            return {"!": not_()}
+        return primary()
+
+    def and_():
+        statements = [not_()]
+        while peek() == ('op', 'and'):
+            take()
+            statements.append(not_())
+        return statements[0] if len(statements) == 1 else {"and": statements}
+
+    def or_():
+        statements = [and_()]
+        while peek() == ('op', 'or'):
+            take()
+            statements.append(and_())
+        return statements[0] if len(statements) == 1 else {"or": statements}
+
+    statement = or_()
+    if position[0] != len(tokens):
+        raise ValueError('Filter expression is not supported: %s' % expression)
+    return statement
+
+
+def _attributes(definition):
+    """ (name, type) pairs of a mapped stream definition. Ex. 'meta_observation_id long, temperature double'"""
+    attributes = []
+    for attribute in definition.split(','):
+        name, type_ = attribute.split()
+        attributes.append((name, type_.lower()))
+    return attributes
+
+
+def _flatten(event):
+    """ Converts an event in CEP default JSON format into attributes, as seen by execution plans"""
+    event = event['event']
+    attributes = {}
+    for name, value in event.get('metaData', {}).items():
+        attributes['meta_' + name] = value
+    for name, value in event.get('correlationData', {}).items():
+        attributes['correlation_' + name] = value
+    attributes.update(event.get('payloadData', {}))
+    return attributes
+
+
+def _window_seconds(length):
+    """ Length of a time window in seconds. Ex. '1 min', '30 sec'"""
+    try:
+        value, unit = length.split()
+        return float(value) * _time_units[unit.lower()]
+    except (ValueError, KeyError):
+        raise ValueError('Window length is not supported: %s' % length)
+
+
+def _select(condition, events, types):
+    """ Events matching a compiled condition. Attributes of inner streams have no declared type, they are numeric
+    when all their values are numbers"""
+    columns = {}
+    for name in condition.variables:
+        values = [event.get(name) for event in events]
+        type_ = types.get(name)
+        if type_ in _numeric_types or (type_ is None and
+                                       all(value is None or isinstance(value, (int, float)) for value in values)):
+            columns[name] = np.array([_as_float(value) for value in values], dtype=np.float64)
+        else:
+            columns[name] = np.array(values, dtype=object)
+    mask = condition.mask(columns, len(events))
+    return [event for event, keep in zip(events, mask.tolist()) if keep]
+
+
+def _split_arguments(text):
+    """ Items of a comma separated list, ignoring the commas inside parentheses and quoted strings"""
+    items, depth, start, quoted = [], 0, 0, False
+    for position, character in enumerate(text):
+        if character == "'":
+            quoted = not quoted
+        elif quoted:
+            continue
+        elif character == '(':
+            depth += 1
+        elif character == ')':
+            depth -= 1
+        elif character == ',' and depth == 0:
+            items.append(text[start:position].strip())
+            start = position + 1
+    items.append(text[start:].strip())
+    return items
+
+
+class _Query:
+    """ Filter query of an execution plan: from <input> [<filter>] select <attributes> insert into <output>"""
+
+    def __init__(self, input_alias, expression, selection, output_alias):
+        self.input_alias = input_alias
+        self.inputs = (input_alias,)
+        self.output_alias = output_alias
+        self.condition = compile_conditions(filter_to_json_logic(expression)) if expression else None
+        selection = selection.strip()
+        self.selection = None if selection == '*' else [name.strip() for name in selection.split(',')]
+
+    def run(self, alias, events, types):
+        """
+        :param alias: alias of the stream of the events
+        :param events: list of events, as attributes
+        :param types: dictionary of alias: {attribute: type} of the plan
+        :return: list of events inserted into the output stream
+        """
+        if self.condition is not None:
+            events = _select(self.condition, events, types.get(alias, {}))
+        if self.selection is not None:
+            events = [{name: event.get(name) for name in self.selection} for event in events]
+        return events
+
+
+class _JoinQuery:
+    """
+    Join of two streams of an execution plan, each kept in a time window:
+    from <input>[<filter>]#window.time(<length>) as <a> join <input>[<filter>]#window.time(<length>) as <b>
+    on <condition> select <a or b>.<attribute> as <attribute>, ... insert into <output>.
+    Every event arriving to one side is joined with the events in the window of the other side. In outer joins
+    (full, left or right outer join), an event of an outer side without a match is inserted alone, and the
+    attributes of the other side are null. Selected attributes may be coalesce(<a>.<attribute>, <b>.<attribute>)
+    """
+
+    def __init__(self, left_input, left_filter, left_window, left_alias, outer, right_input, right_filter,
+                 right_window, right_alias, expression, selection, output_alias):
+        self.sides = [(left_alias, left_input), (right_alias, right_input)]
+        self.outer = {left_alias: outer in ('full', 'left'), right_alias: outer in ('full', 'right')}
+        self.inputs = (left_input, right_input)
+        self.output_alias = output_alias
+        self.filters = {alias: compile_conditions(filter_to_json_logic(filter_)) if filter_ else None
+                        for alias, filter_ in ((left_alias, left_filter), (right_alias, right_filter))}
+        self.lengths = {left_alias: _window_seconds(left_window), right_alias: _window_seconds(right_window)}
+        self.windows = {left_alias: collections.deque(), right_alias: collections.deque()}  # (arrival, event)
+        self.condition = compile_conditions(filter_to_json_logic(expression)) if expression else None
+        self.selection = []  # (qualified attributes, name). The first one which is not null is selected
+        for item in _split_arguments(selection):
+            source, _, name = item.partition(' as ')
+            source = source.strip()
+            function = re.match(r"coalesce\s*\((.*)\)$", source, re.DOTALL)
+            sources = _split_arguments(function.group(1)) if function else [source]
+            self.selection.append((sources, (name or source.split('.')[-1]).strip()))
+
+    def run(self, alias, events, types, now=None):
+        """
+        :param alias: alias of the stream of the events
+        :param events: list of events, as attributes
+        :param types: dictionary of alias: {attribute: type} of the plan
+        :param now: arrival time of the events, in seconds (time.monotonic)
+        :return: list of joined events inserted into the output stream
+        """
+        now = time.monotonic() if now is None else now
+        for window_alias, window in self.windows.items():
+            while window and window[0][0] < now - self.lengths[window_alias]:
+                window.popleft()
+
+        joined = []
+        for side, (side_alias, input_alias) in enumerate(self.sides):
+            if input_alias != alias:
+                continue
+            arrived = events
+            if self.filters[side_alias] is not None:
+                arrived = _select(self.filters[side_alias], arrived, types.get(alias, {}))
+            other_alias, other_input = self.sides[1 - side]
+            others = [event for _, event in self.windows[other_alias]]
+            pairs = []
+            for number, event in enumerate(arrived):
+                for other in others:
+                    pair = {side_alias + '.' + name: value for name, value in event.items()}
+                    pair.update((other_alias + '.' + name, value) for name, value in other.items())
+                    pair[None] = number  # arrived event of the pair
+                    pairs.append(pair)
+            if pairs and self.condition is not None:
+                qualified = {side_alias + '.' + name: type_ for name, type_ in types.get(alias, {}).items()}
+                qualified.update((other_alias + '.' + name, type_)
+                                 for name, type_ in types.get(other_input, {}).items())
+                pairs = _select(self.condition, pairs, qualified)
+            if self.outer[side_alias]:
+                matched = {pair[None] for pair in pairs}
+                pairs.extend({side_alias + '.' + name: value for name, value in event.items()}
+                             for number, event in enumerate(arrived) if number not in matched)
+            for pair in pairs:
+                joined.append({name: next((pair[source] for source in sources if pair.get(source) is not None),
+                                          None) for sources, name in self.selection})
+            self.windows[side_alias].extend((now, event) for event in arrived)
+        return joined
+
+
+class _Plan:
+    """ Execution plan: imported and exported streams by alias, and filter and join queries"""
+
+    def __init__(self, plan):
+        name = _plan_name.search(plan)
+        if name is None:
+            raise ValueError('Execution plan has no name')
+        self.name = name.group(1)
+        self.imports = {}  # alias: stream id
+        self.exports = {}  # alias: stream id
+        self.types = {}  # alias: {attribute: type}
+        for kind, stream_id, alias, definition in _stream.findall(plan):
+            (self.imports if kind == 'Import' else self.exports)[alias] = stream_id
+            self.types[alias] = dict(_attributes(definition))
+        self.queries = [_JoinQuery(*query) for query in _join_query.findall(plan)]
+        self.queries += [_Query(*query) for query in _query.findall(_join_query.sub('', plan))]
+        if not self.queries:
+            raise ValueError('Execution plan %s has no queries' % self.name)
+
+
+class LocalReceiver:
+    """
+    In-process receiver of a LocalCEP. Can be used as receiver endpoint of a StreamGenerator
+    Attributes:
+        engine: LocalCEP
+        name: name of the receiver. Ex. httpReceiver<id>
+    """
+
+    def __init__(self, engine, name):
+        self.engine = engine
+        self.name = name
+
+    def send(self, payload):
+        """
+        Send events to the receiver
+        :param payload: event or list of events in CEP default JSON format, as objects or encoded as JSON
+        :return: 200, as the status code of a HTTP receiver
+        """
+        self.engine.send(self.name, payload)
+        return 200
+
+
+class LocalCEP:
+    """
+    Embedded event processor for the stream, receiver, execution plan and publisher definitions produced by
+    cep.define_stream, cep.define_receiver, cep.define_execution_plan and cep.define_event_publisher.
+    Execution plans are limited to filter queries and joins in time windows (see cep.cep_query and
+    cep.cep_join_query). Events are processed in batches.
+    Attributes:
+        streams: deployed stream definitions by stream id (name:version)
+        receivers: stream id by receiver name
+        plans: deployed execution plans by name
+        publishers: (stream id, type, target URL) by publisher name
+        notify: optional callable(publisher name, list of events) called for every publication
+        ui_events: last events published by 'ui' publishers
+        stats: number of events received, matched by every plan and published by every publisher
+    """
+
+    def __init__(self, notify=None, ui_buffer=1000):
+        self.streams = {}
+        self.receivers = {}
+        self.plans = {}
+        self.publishers = {}
+        self.notify = notify
+        self.ui_events = collections.deque(maxlen=ui_buffer)
+        self.stats = {"received": 0, "matched": collections.Counter(), "published": collections.Counter()}
+        self._lock = threading.RLock()
+
+    def deploy(self, kind, definition):
+        """
+        Deploy a configuration file
+        :param kind: one of "streams", "receivers", "plans" or "publishers", as in EventHandler.deployed_files
+        :param definition: content of the configuration file. Stream definitions can be JSON objects
+        :return: name of the deployed artifact
+        """
+        deploy = {"streams": self.deploy_stream, "receivers": self.deploy_receiver, "plans": self.deploy_plan,
+                  "publishers": self.deploy_publisher}
+        try:
+            return deploy[kind](definition)
+        except KeyError:
+            raise ValueError('Type of configuration file is not valid: %s' % kind)
+
+    def deploy_configuration(self, configuration):
+        """
+        Deploy all configuration files of an event, as prepared by EventHandler.prepare_cep_configuration
+        :param configuration: dictionary with the lists of "streams", "receivers", "plans" and "publishers"
+        :return: dictionary with the names of the deployed artifacts
+        """
+        deployed = {}
+        for kind in ("streams", "receivers", "plans", "publishers"):
+            deployed[kind] = [self.deploy(kind, definition) for definition in configuration[kind]]
+        return deployed
+
+    def deploy_stream(self, definition):
+        if isinstance(definition, (str, bytes)):
+            definition = json.loads(definition)
+        stream_id = definition['name'] + ':' + definition['version']
+        with self._lock:
+            self.streams[stream_id] = definition
+        return stream_id
+
+    def deploy_receiver(self, definition):
+        root = ElementTree.fromstring(definition)
+        to = root.find('{http://wso2.org/carbon/eventreceiver}to')
+        with self._lock:
+            self.receivers[root.get('name')] = to.get('streamName') + ':' + to.get('version')
+        return root.get('name')
+
+    def deploy_plan(self, definition):
+        plan = _Plan(definition)
+        with self._lock:
+            self.plans[plan.name] = plan
+        return plan.name
+
+    def deploy_publisher(self, definition):
+        namespace = '{http://wso2.org/carbon/eventpublisher}'
+        root = ElementTree.fromstring(definition.strip())
+        from_ = root.find(namespace + 'from')
+        to = root.find(namespace + 'to')
+        target_url = None
+        for property_ in to.findall(namespace + 'property'):
+            if property_.get('name') == 'http.url':
+                target_url = property_.text
+        with self._lock:
+            self.publishers[root.get('name')] = (from_.get('streamName') + ':' + from_.get('version'),
+                                                 to.get('eventAdapterType'), target_url)
+        return root.get('name')
+
+    def undeploy(self, kind, name):
+        """
+        Remove a deployed artifact
+        :param kind: one of "streams", "receivers", "plans" or "publishers"
+        :param name: name of the artifact, as returned by deploy()
+        """
+        with self._lock:
+            getattr(self, kind).pop(name, None)
+
+    def receiver(self, name):
+        """
+        :param name: name of a deployed receiver. Ex. httpReceiver<id>
+        :return: LocalReceiver
+        """
+        return LocalReceiver(self, name)
+
+    def send(self, receiver_name, payload):
+        """
+        Process a batch of events received by a receiver
+        :param receiver_name: name of a deployed receiver
+        :param payload: event or list of events in CEP default JSON format, as objects or encoded as JSON
+        :return: number of events published
+        """
+        if isinstance(payload, (str, bytes)):
+            payload = json_codec.loads(payload)
+        if isinstance(payload, dict):
+            payload = [payload]
+
+        publications = []
+        with self._lock:
+            try:
+                stream_id = self.receivers[receiver_name]
+            except KeyError:
+                raise LookupError('Receiver is not deployed: %s' % receiver_name)
+            self.stats["received"] += len(payload)
+            self._route(stream_id, [_flatten(event) for event in payload], publications)
+
+        published = 0
+        for publisher_name, type_, target_url, events in publications:
+            self._publish(publisher_name, type_, target_url, events)
+            published += len(events)
+        return published
+
+    def _route(self, stream_id, events, publications):
+        """ Deliver events of a stream to the execution plans importing it and to its publishers"""
+        if not events:
+            return
+        for plan in self.plans.values():
+            for alias, imported_id in plan.imports.items():
+                if imported_id == stream_id:
+                    self._run_plan(plan, alias, events, publications)
+        for publisher_name, (published_id, type_, target_url) in self.publishers.items():
+            if published_id == stream_id:
+                publications.append((publisher_name, type_, target_url, self._unflatten(stream_id, events)))
+
+    def _run_plan(self, plan, alias, events, publications):
+        for query in plan.queries:
+            if alias not in query.inputs:
+                continue
+            matches = query.run(alias, events, plan.types)
+            self.stats["matched"][plan.name] += len(matches)
+            if query.output_alias in plan.exports:
+                self._route(plan.exports[query.output_alias], matches, publications)
+            else:  # inner stream of the plan
+                self._run_plan(plan, query.output_alias, matches, publications)
+
+    def _unflatten(self, stream_id, events):
+        """ Converts attributes into events in CEP default JSON format, following a stream definition"""
+        definition = self.streams.get(stream_id)
+        if definition is None:
+            return [{"event": {"payloadData": event}} for event in events]
+        unflattened = []
+        for event in events:
+            unflattened.append({"event": {
+                "metaData": {a['name']: event.get('meta_' + a['name']) for a in definition['metaData']},
+                "correlationData": {a['name']: event.get('correlation_' + a['name'])
+                                    for a in definition['correlationData']},
+                "payloadData": {a['name']: event.get(a['name']) for a in definition['payloadData']}}})
+        return unflattened
+
+    def _publish(self, publisher_name, type_, target_url, events):
+        self.stats["published"][publisher_name] += len(events)
+        if self.notify is not None:
+            self.notify(publisher_name, events)
+        if type_ == 'ui':
+            self.ui_events.extend(events)
+        elif type_ == 'http' and target_url:
+            # the JSON mapping of WSO2 publishers posts one event per request
+            for event in events:
+                try:
+                    http_client.get_client().post(target_url, data=json_codec.dumps(event),
+                                                  headers={'Content-Type': 'application/json'})
+                except Exception as exc:
+                    print('Publisher %s raised an exception: %r' % (publisher_name, exc))
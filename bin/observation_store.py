@@ -0,0 +1,325 @@
+"""
+Project: Formalizer. Columnar storage of the latest observations collected from a SensorThings API
+License: MIT
+"""
+
+import array
+import datetime
+import math
+import numpy as np
+
+
+METERS_PER_DEGREE = 111320.0  # length of a degree of latitude, and of longitude at the equator
+
+
+def _epoch_ms(iso_time):
+    """
+    Converts an ISO 8601 time into milliseconds since epoch, UTC. For time intervals the end of the interval is used
+    :param iso_time: ISO 8601 string. Ex. 2018-01-10T10:00:00.000Z
+    :return: int
+    """
+    ind = iso_time.find('/')
+    if ind != -1:
+        iso_time = iso_time[ind + 1:]
+    time_ = datetime.datetime.fromisoformat(iso_time.replace('Z', '+00:00'))
+    if time_.tzinfo is None:
+        time_ = time_.replace(tzinfo=datetime.timezone.utc)
+    return int(time_.timestamp() * 1000)
+
+
+def _as_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+class ObservationStore:
+    """
+    Latest observations of a set of Things, stored as contiguous arrays (one row per Datastream).
+    Attributes:
+        thing_id: Thing @iot.id, int64. Ids which are not integers (SensorThings also allows strings) are stored
+        in an object column
+        datastream_id: Datastream @iot.id, int64 or object as thing_id. -1 when the Sensor API did not return it
+        observation_id: Observation @iot.id, int64 or object as thing_id
+        result_time: resultTime of the observation, datetime64[ms] in UTC
+        result: result of the observation, float64. NaN for results which are not numeric
+        x, y: coordinates of the location of the Thing, float64
+        unit: index of the unit of measurement in symbols, int32
+        symbols: interned unit symbols
+    """
+
+    columns = ('thing_id', 'datastream_id', 'observation_id', 'result_time', 'result', 'x', 'y', 'unit')
+
+    def __init__(self, thing_id, datastream_id, observation_id, result_time, result, x, y, unit, symbols):
+        self.thing_id = thing_id
+        self.datastream_id = datastream_id
+        self.observation_id = observation_id
+        self.result_time = result_time
+        self.result = result
+        self.x = x
+        self.y = y
+        self.unit = unit
+        self.symbols = symbols
+
+    @classmethod
+    def empty(cls):
+        return cls.from_things([])
+
+    @classmethod
+    def from_things(cls, things):
+        """
+        Build a store in a single pass over Things as returned by an observations request
+        (see gevent.prepare_observations_request). Only the latest observation of every Datastream is kept
+        :param things: iterable of Things with their Datastreams, Observations and Locations
+        :return: ObservationStore
+        """
+        builder = ObservationStoreBuilder()
+        append = builder.append
+        for thing in things:
+            coords = thing['Locations'][0]['location']['coordinates']
+            for datastream in thing['Datastreams']:
+                if not datastream['Observations']:
+                    continue
+                observation = datastream['Observations'][0]
+                append(thing['@iot.id'], datastream.get('@iot.id', -1), observation['@iot.id'],
+                       observation.get('resultTime') or observation['phenomenonTime'], observation['result'],
+                       coords[0], coords[1], datastream['unitOfMeasurement']['symbol'])
+        return builder.build()
+
+    @classmethod
+    def concat(cls, stores):
+        """
+        Join several stores, ex. the pages of a response
+        :param stores: list of ObservationStore
+        :return: ObservationStore
+        """
+        if not stores:
+            return cls.empty()
+        symbols = []
+        codes = {}
+        units = []
+        for store in stores:
+            mapping = []
+            for symbol in store.symbols:
+                if symbol not in codes:
+                    codes[symbol] = len(symbols)
+                    symbols.append(symbol)
+                mapping.append(codes[symbol])
+            units.append(np.array(mapping, dtype=np.int32)[store.unit] if len(store) else store.unit)
+        return cls(*[np.concatenate([getattr(store, column) for store in stores]) for column in cls.columns[:-1]],
+                   np.concatenate(units).astype(np.int32), symbols)
+
+    def __len__(self):
+        return len(self.observation_id)
+
+    @property
+    def nbytes(self):
+        """ Memory used by the arrays, in bytes"""
+        return sum(getattr(self, column).nbytes for column in self.columns)
+
+    def select(self, rows):
+        """
+        Subset of the store
+        :param rows: boolean mask or array of row indices
+        :return: ObservationStore sharing the unit symbols
+        """
+        return ObservationStore(*[getattr(self, column)[rows] for column in self.columns], symbols=self.symbols)
+
+    def result_time_iso(self):
+        """
+        :return: array of result times as ISO 8601 strings with milliseconds. Ex. 2018-01-10T10:00:00.000Z
+        """
+        return np.datetime_as_string(self.result_time, unit='ms', timezone='UTC')
+
+    def records(self):
+        """
+        Rows of the store converted into Python values, for mapping into events
+        :return: generator of (observation_id, result_time, symbol, result, x, y). result is None when not numeric
+        """
+        symbols = self.symbols
+        for observation_id, result_time, unit, result, x, y in zip(self.observation_id.tolist(),
+                                                                   self.result_time_iso().tolist(),
+                                                                   self.unit.tolist(), self.result.tolist(),
+                                                                   self.x.tolist(), self.y.tolist()):
+            yield observation_id, result_time, symbols[unit], (None if result != result else result), x, y
+
+
+def _id_column(values):
+    """ int64 array backed by an array of ids, or object array of a list of ids"""
+    if isinstance(values, array.array):
+        return np.frombuffer(values, dtype=np.int64)
+    return np.array(values, dtype=object)
+
+
+class ObservationStoreBuilder:
+    """
+    Accumulates observations, one row at a time, into the compact arrays of an ObservationStore.
+    Unit symbols are interned. An id column falls back to a list of Python objects on the first id which is not
+    an integer
+    """
+
+    def __init__(self):
+        self.thing_id = array.array('q')
+        self.datastream_id = array.array('q')
+        self.observation_id = array.array('q')
+        self.result_time = array.array('q')
+        self.result = array.array('d')
+        self.x = array.array('d')
+        self.y = array.array('d')
+        self.unit = array.array('i')
+        self.symbols = []
+        self._symbol_codes = {}
+
+    def append(self, thing_id, datastream_id, observation_id, result_time, result, x, y, symbol):
+        """
+        Add an observation
+        :param thing_id: Thing @iot.id
+        :param datastream_id: Datastream @iot.id, -1 if unknown
+        :param observation_id: Observation @iot.id
+        :param result_time: ISO 8601 time. Ex. 2018-01-10T10:00:00.000Z
+        :param result: result of the observation. Results which are not numeric are stored as NaN
+        :param x, y: coordinates of the location of the Thing
+        :param symbol: symbol of the unit of measurement
+        """
+        code = self._symbol_codes.get(symbol)
+        if code is None:
+            code = self._symbol_codes[symbol] = len(self.symbols)
+            self.symbols.append(symbol)
+        try:
+            self.thing_id.append(thing_id)
+        except TypeError:  # not an integer, ex. a string id
+            self._objects('thing_id').append(thing_id)
+        try:
+            self.datastream_id.append(datastream_id)
+        except TypeError:
+            self._objects('datastream_id').append(datastream_id)
+        try:
+            self.observation_id.append(observation_id)
+        except TypeError:
+            self._objects('observation_id').append(observation_id)
+        self.result_time.append(_epoch_ms(result_time))
+        self.result.append(_as_float(result))
+        self.x.append(x)
+        self.y.append(y)
+        self.unit.append(code)
+
+    def _objects(self, name):
+        """ Converts an id column into a list of Python objects
+        :param name: name of the column
+        :return: the list
+        """
+        column = getattr(self, name)
+        if isinstance(column, array.array):
+            column = list(column)
+            setattr(self, name, column)
+        return column
+
+    def __len__(self):
+        return len(self.observation_id)
+
+    def build(self):
+        """
+        :return: ObservationStore backed by the arrays of the builder
+        """
+        return ObservationStore(_id_column(self.thing_id), _id_column(self.datastream_id),
+                                _id_column(self.observation_id),
+                                np.frombuffer(self.result_time, dtype=np.int64).view('datetime64[ms]'),
+                                np.frombuffer(self.result, dtype=np.float64), np.frombuffer(self.x, dtype=np.float64),
+                                np.frombuffer(self.y, dtype=np.float64), np.frombuffer(self.unit, dtype=np.int32),
+                                self.symbols)
+
+
+def granularity_to_degrees(distance, units, latitude=0.0):
+    """
+    Converts the spatial granularity of an event into the size of a grid cell in degrees
+    :param distance: size of the cells. Ex. 100
+    :param units: 'm', 'km' or 'deg'
+    :param latitude: latitude of the area, in degrees. Degrees of longitude get shorter towards the poles
+    :return: (size along x (longitude), size along y (latitude)) in degrees
+    """
+    units = units.lower()
+    if units in ('deg', 'degree', 'degrees'):
+        return float(distance), float(distance)
+    factors = {'m': 1.0, 'km': 1000.0}
+    if units not in factors:
+        raise ValueError('Units of granularity are not supported: %s' % units)
+    meters = distance * factors[units]
+    return (meters / (METERS_PER_DEGREE * max(math.cos(math.radians(latitude)), 1e-6)),
+            meters / METERS_PER_DEGREE)
+
+
+class GridAggregation:
+    """
+    Snaps observations to a regular grid and aggregates them into one observation per cell and unit of measurement,
+    located at the centre of the cell. Results which are not numeric are ignored.
+    Attributes:
+        cell_x, cell_y: size of the cells in degrees
+        statistic: 'mean', 'max', 'min' or 'count' of the results in a cell
+        origin: (x, y) of a corner of the grid
+    """
+
+    statistics = ('mean', 'max', 'min', 'count')
+
+    def __init__(self, cell_x, cell_y, statistic='mean', origin=(0.0, 0.0)):
+        if statistic not in self.statistics:
+            raise ValueError('Statistic is not supported: %s' % statistic)
+        if cell_x <= 0 or cell_y <= 0:
+            raise ValueError('Size of the cells must be positive')
+        self.cell_x = cell_x
+        self.cell_y = cell_y
+        self.statistic = statistic
+        self.origin = origin
+
+    @classmethod
+    def from_granularity(cls, granularity, latitude=0.0, statistic='mean'):
+        """
+        :param granularity: spatial granularity of an event. Ex. {"distance": 100, "units": "m"}
+        :param latitude: latitude of the area, in degrees
+        :param statistic: 'mean', 'max', 'min' or 'count'
+        :return: GridAggregation
+        """
+        cell_x, cell_y = granularity_to_degrees(granularity["distance"], granularity["units"], latitude)
+        return cls(cell_x, cell_y, statistic)
+
+    def apply(self, store):
+        """
+        Aggregate the observations of a store
+        :param store: ObservationStore
+        :return: ObservationStore with one row per cell and unit. Thing and Datastream ids are -1, the observation
+        id and result time are those of the latest observation in the cell
+        """
+        if len(store) == 0:
+            return store
+        column = np.floor((store.x - self.origin[0]) / self.cell_x).astype(np.int64)
+        row = np.floor((store.y - self.origin[1]) / self.cell_y).astype(np.int64)
+        cells, inverse = np.unique(np.stack([column, row, store.unit.astype(np.int64)], axis=1), axis=0,
+                                   return_inverse=True)
+        inverse = inverse.ravel()
+        size = len(cells)
+
+        valid = ~np.isnan(store.result)
+        counts = np.bincount(inverse, weights=valid, minlength=size)
+        if self.statistic == 'count':
+            result = counts
+        elif self.statistic == 'mean':
+            sums = np.bincount(inverse[valid], weights=store.result[valid], minlength=size)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                result = sums / counts
+        else:
+            function, initial = (np.fmax, -np.inf) if self.statistic == 'max' else (np.fmin, np.inf)
+            result = np.full(size, initial)
+            function.at(result, inverse, store.result)
+            result[counts == 0] = np.nan
+
+        # id of the latest observation of every cell: last row of the cell, sorted by result time
+        order = np.lexsort((store.result_time.view(np.int64), inverse))
+        observation_id = store.observation_id[order[np.flatnonzero(np.diff(inverse[order], append=size))]]
+        result_time = np.full(size, np.iinfo(np.int64).min, dtype=np.int64)
+        np.maximum.at(result_time, inverse, store.result_time.view(np.int64))
+        missing = -np.ones(size, dtype=np.int64)
+        return ObservationStore(missing, missing.copy(), observation_id, result_time.view('datetime64[ms]'),
+                                result.astype(np.float64),
+                                self.origin[0] + (cells[:, 0] + 0.5) * self.cell_x,
+                                self.origin[1] + (cells[:, 1] + 0.5) * self.cell_y,
+                                cells[:, 2].astype(np.int32), store.symbols)
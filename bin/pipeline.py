@@ -0,0 +1,174 @@
+"""
+Project: Formalizer. Stages running concurrently and connected by bounded queues, so that fetching, mapping and
+pushing observations overlap and the time of a cycle approaches the time of the slowest stage
+License: MIT
+"""
+
+import queue
+import threading
+import time
+
+_end = object()  # marks the end of the items of a stage
+
+
+class StageStats:
+    """
+    Work done by a stage of a Pipeline
+    Attributes:
+        name: name of the stage
+        items: number of items processed (for the source, items produced)
+        outputs: number of items passed to the next stage
+        busy: seconds spent processing items (for the source, producing them)
+        waiting: seconds spent waiting for items from the previous stage or for room in the next queue
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.outputs = 0
+        self.busy = 0.0
+        self.waiting = 0.0
+
+    @property
+    def throughput(self):
+        """ Items processed per second of busy time. The slowest stage has the lowest throughput"""
+        return self.items / self.busy if self.busy > 0 else float('inf') if self.items else 0.0
+
+    def as_dict(self):
+        return {"items": self.items, "outputs": self.outputs, "busy": self.busy, "waiting": self.waiting,
+                "throughput": self.throughput}
+
+
+class Pipeline:
+    """
+    Runs a source and a chain of stages, each in its own thread. Every stage is a callable taking an item of the
+    previous stage and returning an iterable of items for the next stage (the results of the last stage are
+    discarded). Queues between stages are bounded, so a slow stage holds back the ones before it instead of
+    accumulating items in memory. When a stage raises an exception the pipeline stops and run() raises it.
+    Attributes:
+        stages: list of (name, callable)
+        queue_size: max number of items waiting between two stages
+        stats: StageStats of the source and of every stage, by name, for the last run
+        elapsed: duration in seconds of the last run
+    """
+
+    def __init__(self, stages, queue_size=4, source_name='fetch'):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.source_name = source_name
+        self.stats = {}
+        self.elapsed = 0.0
+
+    def run(self, source):
+        """
+        Consume a source through the stages
+        :param source: iterable of items for the first stage, ex. pages of observations fetched lazily
+        :return: dictionary of stage name: statistics (see StageStats.as_dict)
+        """
+        names = [self.source_name] + [name for name, _ in self.stages]
+        self.stats = {name: StageStats(name) for name in names}
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        stop = threading.Event()
+        errors = []
+        start = time.monotonic()
+
+        threads = [threading.Thread(target=self._produce, args=(source, queues[0], stop, errors),
+                                    name='pipeline-' + self.source_name, daemon=True)]
+        for position, (name, function) in enumerate(self.stages):
+            output = queues[position + 1] if position + 1 < len(queues) else None
+            threads.append(threading.Thread(target=self._consume,
+                                            args=(name, function, queues[position], output, stop, errors),
+                                            name='pipeline-' + name, daemon=True))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.elapsed = time.monotonic() - start
+
+        if errors:
+            raise errors[0]
+        return {name: stats.as_dict() for name, stats in self.stats.items()}
+
+    def _produce(self, source, output, stop, errors):
+        stats = self.stats[self.source_name]
+        try:
+            iterator = iter(source)
+            while not stop.is_set():
+                started = time.monotonic()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    stats.busy += time.monotonic() - started
+                stats.items += 1
+                if not self._put(output, item, stop, stats):
+                    return
+                stats.outputs += 1
+        except Exception as exc:
+            errors.append(exc)
+            stop.set()
+        self._put(output, _end, stop, stats)
+
+    def _consume(self, name, function, input_, output, stop, errors):
+        stats = self.stats[name]
+        while True:
+            started = time.monotonic()
+            item = self._get(input_, stop)
+            stats.waiting += time.monotonic() - started
+            if item is _end or stop.is_set():
+                break
+            started = time.monotonic()
+            try:
+                results = function(item)
+                results = () if results is None else list(results)
+            except Exception as exc:
+                errors.append(exc)
+                stop.set()
+                break
+            finally:
+                stats.busy += time.monotonic() - started
+            stats.items += 1
+            if output is None:
+                continue
+            for result in results:
+                if not self._put(output, result, stop, stats):
+                    return
+                stats.outputs += 1
+        if output is not None:
+            self._put(output, _end, stop, stats)
+
+    @staticmethod
+    def _put(queue_, item, stop, stats):
+        """ Put an item in a queue, giving up when the pipeline stops. The end marker is always delivered"""
+        started = time.monotonic()
+        try:
+            while True:
+                try:
+                    queue_.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    if stop.is_set():
+                        if item is _end:  # make room for the marker, the items are not needed anymore
+                            _drain(queue_)
+                            continue
+                        return False
+        finally:
+            stats.waiting += time.monotonic() - started
+
+    @staticmethod
+    def _get(queue_, stop):
+        while True:
+            try:
+                return queue_.get(timeout=0.1)
+            except queue.Empty:
+                if stop.is_set():
+                    return _end
+
+
+def _drain(queue_):
+    while True:
+        try:
+            queue_.get_nowait()
+        except queue.Empty:
+            return
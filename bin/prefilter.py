@@ -0,0 +1,203 @@
+"""
+Project: Formalizer. Vectorized pre-filter compiled from the JsonLogic conditions of a GEvent.
+Used to drop observations which cannot match a GEvent before they are pushed to the CEP
+License: MIT
+"""
+
+import numpy as np
+import shapely
+from bin.observation_store import _as_float
+
+_comparisons = {'>': np.greater, '>=': np.greater_equal, '<': np.less, '<=': np.less_equal,
+                '==': np.equal, '===': np.equal, '!=': np.not_equal, '!==': np.not_equal}
+
+
+class CompiledCondition:
+    """
+    JsonLogic conditions compiled into a vectorized predicate over columns of observations.
+    Besides comparisons, geo:within tests if the points given by two variables are located in a GeoJSON geometry,
+    as the function of the geo extension of Siddhi (see cep.cep_query).
+    Variables that are not provided (for example a second phenomenon of a composite event), and comparisons
+    that cannot be evaluated on the columns (ex. a string constant and numeric results), are unknown: they may be
+    true or false, also when negated, so the predicate selects every observation which can still match the conditions.
+    Attributes:
+        conditions: JsonLogic conditions, ex. {">": ["Temperature", 25]}
+        variables: names of the variables (phenomena) used in the conditions
+    """
+
+    def __init__(self, conditions):
+        self.conditions = conditions
+        self.variables = []
+        self._evaluate = self._compile(conditions)
+
+    def mask(self, columns, size):
+        """
+        Evaluate the conditions
+        :param columns: dictionary of variable name: numpy array of values
+        :param size: number of observations
+        :return: boolean array, True for the observations which can match
+        """
+        mask = self._evaluate(columns)[0]
+        if mask is None:
+            return np.ones(size, dtype=bool)
+        return np.broadcast_to(mask, (size,))
+
+    def filter_store(self, store, phenomenon):
+        """
+        Select the observations of a store which can match
+        :param store: ObservationStore
+        :param phenomenon: name of the variable holding the results of the store
+        :return: ObservationStore
+        """
+        return store.select(self.mask({phenomenon: store.result}, len(store)))
+
+    def filter_things(self, things, phenomenon):
+        """
+        Select the Things whose latest observation can match
+        :param things: list of Things as returned by the Sensor API
+        :param phenomenon: name of the variable holding the results of the observations
+        :return: list of Things
+        """
+        results = np.array([_as_float(thing['Datastreams'][0]['Observations'][0]['result']) for thing in things],
+                           dtype=np.float64)
+        mask = self.mask({phenomenon: results}, len(things))
+        return [thing for thing, keep in zip(things, mask.tolist()) if keep]
+
+    def _compile(self, conditions):
+        # every compiled statement returns (may be true, may be false): boolean arrays, or None when the result is
+        # unknown for every observation. Negating a statement swaps them, so unknowns are kept under '!'
+        if not isinstance(conditions, dict) or len(conditions) != 1:
+            raise ValueError('Condition is not a valid JsonLogic statement: %s' % conditions)
+        operator, arguments = next(iter(conditions.items()))
+
+        if operator in ('and', 'or'):
+            return self._compile_logical(operator, [self._compile(argument) for argument in arguments])
+        elif operator in ('!', 'not'):
+            if isinstance(arguments, list):
+                arguments = arguments[0]
+            inner = self._compile(arguments)
+
+            def not_(columns):
+                may_be_true, may_be_false = inner(columns)
+                return may_be_false, may_be_true
+            return not_
+        elif operator in _comparisons:
+            return self._compile_comparison(_comparisons[operator], arguments)
+        elif operator == 'geo:within':
+            return self._compile_within(arguments)
+        raise ValueError('JsonLogic operator is not supported: %s' % operator)
+
+    @staticmethod
+    def _compile_logical(operator, parts):
+        def and_(columns):
+            results = [part(columns) for part in parts]
+            return _all([true for true, _ in results]), _any([false for _, false in results])
+
+        def or_(columns):
+            results = [part(columns) for part in parts]
+            return _any([true for true, _ in results]), _all([false for _, false in results])
+        return and_ if operator == 'and' else or_
+
+    def _compile_comparison(self, function, arguments):
+        operands = []
+        for position, argument in enumerate(arguments):
+            # the repo format names the phenomenon as the first argument, ex. [">", ["Temperature", 25]]
+            if isinstance(argument, dict) and 'var' in argument:
+                operands.append(('var', argument['var']))
+            elif isinstance(argument, str) and position == 0:
+                operands.append(('var', argument))
+            else:
+                operands.append(('value', argument))
+        for kind, name in operands:
+            if kind == 'var' and name not in self.variables:
+                self.variables.append(name)
+
+        def compare(columns):
+            values = []
+            for kind, operand in operands:
+                if kind == 'value':
+                    values.append(operand)
+                elif operand in columns:
+                    values.append(columns[operand])
+                else:
+                    return None, None
+            mask = _compare(function, values[0], values[1])
+            if mask is None:
+                return None, None
+            return mask, ~mask
+        return compare
+
+
+    def _compile_within(self, arguments):
+        # arguments: x and y variables, and a GeoJSON geometry
+        names = [argument['var'] if isinstance(argument, dict) else argument for argument in arguments[:2]]
+        geometry = shapely.from_geojson(arguments[2])
+        shapely.prepare(geometry)
+        for name in names:
+            if name not in self.variables:
+                self.variables.append(name)
+
+        def within(columns):
+            if names[0] not in columns or names[1] not in columns:
+                return None, None
+            mask = shapely.contains_xy(geometry, columns[names[0]], columns[names[1]])
+            return mask, ~mask
+        return within
+
+
+def _all(masks):
+    """ Conjunction of masks, None (unknown) masks are ignored"""
+    result = None
+    for mask in masks:
+        if mask is not None:
+            result = mask if result is None else result & mask
+    return result
+
+
+def _any(masks):
+    """ Disjunction of masks, None (unknown) when any of them is unknown"""
+    result = None
+    for mask in masks:
+        if mask is None:
+            return None
+        result = mask if result is None else result | mask
+    return result
+
+
+def _is_numeric(value):
+    if isinstance(value, np.ndarray):
+        return value.dtype.kind in 'biuf'
+    return isinstance(value, (bool, int, float, np.number))
+
+
+def _compare(function, left, right):
+    """
+    Compare two operands, arrays of values or constants
+    :return: boolean array, or None when the comparison cannot be evaluated on the columns. Ex. a string
+    constant and a column of float results, where string results were stored as NaN
+    """
+    numeric = _is_numeric(left) and _is_numeric(right)
+    objects = any(isinstance(value, np.ndarray) and value.dtype == object for value in (left, right))
+    if numeric:
+        with np.errstate(invalid='ignore'):
+            return np.asarray(function(left, right), dtype=bool)
+    if not objects:
+        return None
+    # values of any type, compared one by one. Values which cannot be compared do not match
+    left, right = np.broadcast_arrays(np.asarray(left, dtype=object), np.asarray(right, dtype=object))
+    mask = np.zeros(left.shape, dtype=bool)
+    for position, (a, b) in enumerate(zip(left.tolist(), right.tolist())):
+        try:
+            mask[position] = bool(function(a, b))
+        except TypeError:
+            pass
+    return mask
+
+
+def compile_conditions(conditions):
+    """
+    Compile JsonLogic conditions into a vectorized predicate
+    :param conditions: JsonLogic conditions, as in the attributive properties of an event definition
+    :return: CompiledCondition
+    """
+    return CompiledCondition(conditions)
@@ -0,0 +1,271 @@
+"""
+Project: Formalizer. Timing wheel scheduler for buffer refreshes, stream generator ticks and expirations
+License: MIT
+"""
+
+import asyncio
+import concurrent.futures
+import datetime
+import math
+import threading
+import time
+import traceback
+
+
+class ScheduledTask:
+    """
+    A callback scheduled in a Scheduler
+    Attributes:
+        name: name of the task, used for reporting
+        callback: callable without arguments. In asyncio mode it can also be a coroutine function
+        interval: period in seconds. None for tasks that run once
+        deadline: next time (time.monotonic()) at which the task should run
+        runs: number of times the task has run
+        missed: number of deadlines skipped because the task was still running or the scheduler was late
+        failures: number of runs that raised an exception
+        last_lag, max_lag, total_lag: delay in seconds between the deadline and the actual start of a run
+        cancelled: True after the task was cancelled or, for one-off tasks, after it run
+    """
+
+    def __init__(self, name, callback, interval, deadline):
+        self.name = name
+        self.callback = callback
+        self.interval = interval
+        self.deadline = deadline
+        self.runs = 0
+        self.missed = 0
+        self.failures = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+        self.cancelled = False
+        self.running = False
+
+    def stats(self):
+        """
+        :return: dictionary with the counters of the task
+        """
+        return {"runs": self.runs, "missed": self.missed, "failures": self.failures,
+                "last lag": self.last_lag, "max lag": self.max_lag,
+                "mean lag": self.total_lag / self.runs if self.runs else 0.0}
+
+
+class Scheduler:
+    """
+    Hashed timing wheel driving many periodic and one-off tasks with a fixed number of threads, or on a
+    single asyncio loop (see run_async).
+    Deadlines of periodic tasks are computed from the previous deadline, not from the end of the previous run,
+    so they do not drift. A deadline reached while the previous run of the task is still going on is counted
+    as missed and skipped.
+    Attributes:
+        tick: resolution of the wheel in seconds
+        wheel_size: number of slots of the wheel
+        workers: number of threads running the callbacks
+    """
+
+    def __init__(self, tick=0.1, wheel_size=512, workers=4):
+        self.tick = tick
+        self.wheel_size = wheel_size
+        self.workers = workers
+        self.tasks = {}  # name: task
+        self._slots = [[] for _ in range(wheel_size)]
+        self._lock = threading.Lock()
+        self._origin = time.monotonic()
+        self._ticks = 0  # ticks processed since origin
+        self._stop = threading.Event()
+        self._driver = None
+        self._executor = None
+
+    def schedule_periodic(self, name, interval, callback, delay=None):
+        """
+        Run a callback every interval seconds
+        :param name: unique name of the task
+        :param interval: period in seconds
+        :param callback: callable without arguments
+        :param delay: seconds until the first run. Defaults to interval
+        :return: ScheduledTask
+        """
+        if interval <= 0:
+            raise ValueError('Interval must be positive. Interval: %s' % interval)
+        if delay is None:
+            delay = interval
+        return self._add(ScheduledTask(name, callback, interval, time.monotonic() + delay))
+
+    def schedule_after(self, name, delay, callback):
+        """
+        Run a callback once, after a delay
+        :param name: unique name of the task
+        :param delay: seconds until the run
+        :param callback: callable without arguments
+        :return: ScheduledTask
+        """
+        return self._add(ScheduledTask(name, callback, None, time.monotonic() + max(delay, 0)))
+
+    def schedule_at(self, name, when, callback):
+        """
+        Run a callback once, at a given time
+        :param name: unique name of the task
+        :param when: datetime. Naive datetimes are compared with datetime.datetime.now()
+        :param callback: callable without arguments
+        :return: ScheduledTask
+        """
+        now = datetime.datetime.now(when.tzinfo)
+        return self.schedule_after(name, (when - now).total_seconds(), callback)
+
+    def cancel(self, task):
+        """
+        Cancel a task. A run in progress is not interrupted
+        :param task: ScheduledTask or name of the task
+        """
+        with self._lock:
+            if isinstance(task, str):
+                task = self.tasks.get(task)
+            if task is None:
+                return
+            task.cancelled = True
+            if self.tasks.get(task.name) is task:
+                del self.tasks[task.name]
+
+    def stats(self):
+        """
+        :return: dictionary of task name: counters of the task
+        """
+        with self._lock:
+            tasks = list(self.tasks.values())
+        return {task.name: task.stats() for task in tasks}
+
+    def start(self):
+        """ Start the driver thread and the thread pool running the callbacks"""
+        if self._driver is not None:
+            return
+        self._stop.clear()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        self._driver = threading.Thread(target=self._drive, name='scheduler', daemon=True)
+        self._driver.start()
+
+    def stop(self, wait=True):
+        """
+        Stop the scheduler. Scheduled tasks are kept
+        :param wait: wait for running callbacks to finish
+        """
+        self._stop.set()
+        if self._driver is not None:
+            self._driver.join()
+            self._driver = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+    async def run_async(self):
+        """
+        Drive the wheel on the running asyncio loop until stop() is called. Coroutine functions are run as tasks
+        on the loop, other callables in the default executor of the loop
+        """
+        loop = asyncio.get_running_loop()
+        self._stop.clear()
+        while not self._stop.is_set():
+            await asyncio.sleep(max(self._next_tick_time() - time.monotonic(), 0))
+            for task, deadline in self._advance():
+                if asyncio.iscoroutinefunction(task.callback):
+                    loop.create_task(self._run_async(task, deadline))
+                else:
+                    loop.run_in_executor(None, self._run, task, deadline)
+
+    def _add(self, task):
+        with self._lock:
+            if task.name in self.tasks:
+                raise ValueError('A task with the same name is already scheduled: %s' % task.name)
+            self.tasks[task.name] = task
+            self._insert(task)
+        return task
+
+    def _insert(self, task):
+        # a task is placed in the slot of the first tick at or after its deadline, and never in a slot already passed
+        tick = max(math.ceil((task.deadline - self._origin) / self.tick), self._ticks + 1)
+        self._slots[tick % self.wheel_size].append(task)
+
+    def _next_tick_time(self):
+        return self._origin + (self._ticks + 1) * self.tick
+
+    def _advance(self):
+        """
+        Process all the ticks passed since the last call
+        :return: list of (task, deadline) for the tasks that are due
+        """
+        due = []
+        now = time.monotonic()
+        with self._lock:
+            while self._next_tick_time() <= now:
+                self._ticks += 1
+                slot = self._slots[self._ticks % self.wheel_size]
+                if not slot:
+                    continue
+                remaining = []
+                for task in slot:
+                    if task.cancelled:
+                        continue
+                    if task.deadline > now:  # deadline in a later turn of the wheel
+                        remaining.append(task)
+                        continue
+                    if task.running:
+                        task.missed += 1
+                    else:
+                        task.running = True
+                        due.append((task, task.deadline))
+                    self._reschedule(task, now)
+                self._slots[self._ticks % self.wheel_size] = remaining
+        return due
+
+    def _reschedule(self, task, now):
+        if task.interval is None:
+            task.cancelled = True
+            if self.tasks.get(task.name) is task:
+                del self.tasks[task.name]
+            return
+        task.deadline += task.interval
+        if task.deadline <= now:  # skip the periods that are already over
+            skipped = math.ceil((now - task.deadline) / task.interval)
+            task.missed += skipped
+            task.deadline += skipped * task.interval
+        self._insert(task)
+
+    def _drive(self):
+        while not self._stop.wait(max(self._next_tick_time() - time.monotonic(), 0)):
+            for task, deadline in self._advance():
+                self._executor.submit(self._run, task, deadline)
+
+    @staticmethod
+    def _start_run(task, deadline):
+        lag = max(time.monotonic() - deadline, 0.0)
+        task.last_lag = lag
+        task.total_lag += lag
+        task.max_lag = max(task.max_lag, lag)
+
+    @staticmethod
+    def _end_run(task, failed):
+        task.runs += 1
+        if failed:
+            task.failures += 1
+        task.running = False
+
+    def _run(self, task, deadline):
+        self._start_run(task, deadline)
+        failed = False
+        try:
+            task.callback()
+        except Exception:
+            failed = True
+            print('*** Scheduled task %s raised an exception' % task.name)
+            traceback.print_exc()
+        self._end_run(task, failed)
+
+    async def _run_async(self, task, deadline):
+        self._start_run(task, deadline)
+        failed = False
+        try:
+            await task.callback()
+        except Exception:
+            failed = True
+            print('*** Scheduled task %s raised an exception' % task.name)
+            traceback.print_exc()
+        self._end_run(task, failed)
@@ -0,0 +1,134 @@
+"""
+Project: Formalizer. Incremental parsing of SensorThings responses into an ObservationStore.
+The body of a response to an observations request (see gevent.prepare_observations_request) is parsed with the
+shared JSON codec and converted. In low memory mode, it is read as a stream of ijson events, and only the fields used
+by the mapper are kept, without building the tree of the whole page in memory. The stream is about four times slower
+than orjson (tests/parser_benchmark.py), for a fraction of the peak memory
+License: MIT
+"""
+
+import re
+from bin import json_codec
+from bin.observation_store import ObservationStore, ObservationStoreBuilder
+
+try:
+    import ijson
+except ImportError:  # optional dependency
+    ijson = None
+
+
+class _NextLinkReader:
+    """
+    File-like wrapper passing the body of a response to the parser, and finding the top level @iot.nextLink in the
+    chunks read. Links of expanded collections are named <collection>@iot.nextLink and are not matched
+    Attributes:
+        next_link: URL of the next page, None until it is found
+    """
+
+    _key = b'"@iot.nextLink"'
+    _link = re.compile(rb'"@iot\.nextLink"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.next_link = None
+        self._tail = b''
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        if data and self.next_link is None:
+            window = self._tail + data
+            start = window.find(self._key)
+            if start == -1:
+                self._tail = window[-len(self._key):]
+            else:
+                match = self._link.match(window, start)
+                if match is None:  # the link continues in the next chunk
+                    self._tail = window[start:]
+                else:
+                    self.next_link = json_codec.loads(b'"' + match.group(1) + b'"')
+        return data
+
+
+_thing = 'value.item'
+_datastream = 'value.item.Datastreams.item'
+_observation = 'value.item.Datastreams.item.Observations.item'
+_location = 'value.item.Locations.item'
+_coordinate = 'value.item.Locations.item.location.coordinates.item'
+_observation_fields = {_observation + '.@iot.id': '@iot.id', _observation + '.resultTime': 'resultTime',
+                       _observation + '.phenomenonTime': 'phenomenonTime', _observation + '.result': 'result'}
+_prefixes = frozenset([_thing, _datastream, _observation, _location, _coordinate, 'value.item.@iot.id',
+                       'value.item.Datastreams.item.@iot.id', 'value.item.Datastreams.item.unitOfMeasurement.symbol']
+                      + list(_observation_fields))
+
+
+def _parse_events(events, builder):
+    """
+    Append the latest observation of every Datastream of a page of Things to a builder, from the prefix events of
+    ijson.parse. Only the fields of the store are kept: every other value is skipped as it is read
+    :param events: iterable of (prefix, event, value)
+    :param builder: ObservationStoreBuilder
+    """
+    append = builder.append
+    thing_id, rows, coords, locations = None, [], [], 0
+    datastream_id, symbol, observation, observations = -1, None, None, 0
+    for prefix, event, value in events:
+        if prefix not in _prefixes:  # most of the events
+            continue
+        if event == 'start_map':
+            if prefix == _thing:
+                thing_id, rows, coords, locations = None, [], [], 0
+            elif prefix == _datastream:
+                datastream_id, symbol, observation, observations = -1, None, None, 0
+            elif prefix == _observation:
+                observations += 1
+                if observations == 1:  # the latest one, as requested by prepare_observations_request
+                    observation = {}
+            elif prefix == _location:
+                locations += 1
+            elif observations == 1 and prefix in _observation_fields:
+                observation['result'] = None  # result which is not a number, stored as NaN
+        elif event == 'end_map':
+            if prefix == _datastream and observation is not None:
+                rows.append((datastream_id, observation, symbol))
+            elif prefix == _thing:
+                # locations may come after the datastreams
+                for datastream_id_, observation_, symbol_ in rows:
+                    append(thing_id, datastream_id_, observation_['@iot.id'],
+                           observation_.get('resultTime') or observation_['phenomenonTime'],
+                           observation_.get('result'), coords[0], coords[1], symbol_)
+        elif prefix == _coordinate:
+            if locations == 1:
+                coords.append(value)
+        elif prefix in _observation_fields:
+            # arrays are stored as NaN, as their value is None. Keys of a result which is an object are skipped
+            if observations == 1 and event != 'map_key':
+                observation[_observation_fields[prefix]] = value
+        elif prefix == 'value.item.@iot.id':
+            thing_id = value
+        elif prefix == 'value.item.Datastreams.item.@iot.id':
+            datastream_id = value
+        elif prefix == 'value.item.Datastreams.item.unitOfMeasurement.symbol':
+            symbol = value
+
+
+def parse_things_page(stream, buffer_size=16 * 1024, low_memory=False):
+    """
+    Parse a page of Things, as returned by an observations request, into the ids, result time, result, unit symbol
+    and coordinates of the latest observation of every Datastream. By default, the body is decoded as a whole with
+    the shared JSON codec, which is the fastest with orjson.
+    In low memory mode, the body is read as a stream of ijson prefix events, without decoding Things into
+    dictionaries, and memory use is bounded by the buffer size and the observations of a Thing, instead of the size
+    of the page. Parsing is slower
+    :param stream: file-like object with the body of the response, read in binary mode. Ex. response.raw
+    :param buffer_size: size in bytes of the chunks read from the stream, in low memory mode
+    :param low_memory: if True, parse the body incrementally with ijson, when it is installed
+    :return: (ObservationStore, URL of the next page or None)
+    """
+    if not low_memory or ijson is None:
+        page = json_codec.loads(stream.read())
+        return ObservationStore.from_things(page['value']), page.get('@iot.nextLink')
+
+    reader = _NextLinkReader(stream)
+    builder = ObservationStoreBuilder()
+    _parse_events(ijson.parse(reader, buf_size=buffer_size, use_float=True), builder)
+    return builder.build(), reader.next_link
@@ -2,10 +2,10 @@
 import cep
 import json
 import gevent
+import http_client
+import scheduler
 import socket
-import concurrent.futures
 import datetime
-import time
 
 start = datetime.datetime.now()
 print('process started at: ', start)
@@ -19,6 +19,7 @@ conf_f = './config.json'
 with open(conf_f) as c:
     cf = c.read()
     conf = json.loads(cf)
+http_client.configure(conf["geosmart.sys"]["http"])
 
 # 3. Open event definition file
 e_def = '../tests/event_def_test.json'
@@ -48,53 +49,38 @@ publisher_target = 'http://' + socket.gethostbyname(socket.gethostname()) + ':80
 start_deploy = datetime.datetime.now()
 print('deploying cep files at: ', start_deploy - start)
 handler.deploy_cep_configuration(publisher_target)
-delay = 10
-print('.....Waiting for deployment %s seconds....' % delay)
-time.sleep(delay) # (seconds) induce delay, to allow CEP server to deploy files
+handler.wait_until_ready(timeout=60)  # poll the CEP server until the deployed files are live
 
 
 # 8. find receiver endpoint:
-name = handler.deployed_files["receivers"][0]
-print('raw name ', name)
-pos = name.find('receiver-')
-name = name[pos + 9:]
-pos2 = name.find('_')
-name = name[:pos2]
-# print(name)
-re = conf["geosmart.sys"]["cep"]["root url"] + '/' + 'httpReceiver' + name
-re = re + '1'
+re = handler.receiver_endpoints[0]
 print('data will be send to: ', re)
 
-# 9. create stream generators
-# print(e.extent)
-stream_ids = gevent.find_datastreams(data.url, e.extent, e.phenomena_names()[0])
-
+# 9. create observations buffer and stream generator
 # name must match name in Sensor API
-expiration = '2018-12-31T10:00:00Z'
-generators = []
-for s in stream_ids:
-    g = gevent.StreamGenerator(s, expiration, re)
-    generators.append(g)
+data_request = gevent.prepare_observations_request(data.url, e.extent, e.phenomena_names()[0])
+data_buffer = gevent.Buffer(data_request, update_interval=10)
 
-# 10 Starts stream using a thread per generator:
+run_time = 40  # seconds
+expiration = (datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=run_time)).strftime(
+    "%Y-%m-%dT%H:%M:%SZ")
+g = gevent.StreamGenerator(data_buffer, expiration, re, update_frequency=5, max_workers=10)
 
-print('streaming started at: ', datetime.datetime.now() - start)
-with concurrent.futures.ThreadPoolExecutor(max_workers=len(generators)) as executor:
-    future_to_generator = {executor.submit(g.start_streaming()): g for g in generators}
-    for future in concurrent.futures.as_completed(future_to_generator):
-        generator = future_to_generator[future]
-        try:
-            data = future.done()
-        except Exception as exc:
-            print('%r generated an exception: %s' % (generator,exc))
-        else:
-            print('%s was started' % generator)
+# 10 Refresh the buffer and push data using a scheduler, until the generator expires:
 
-# time  script will keep running
-time.sleep(40)
+print('streaming started at: ', datetime.datetime.now() - start)
+tasks = scheduler.Scheduler(workers=4)
+data_buffer.auto_update(tasks)
+g.schedule(tasks)
+tasks.start()
+g.expired.wait()
+data_buffer.auto_update(tasks, 'stop')
+print('scheduler: ', tasks.stats())
+tasks.stop()
 
 
 # 11 Undelploy configuration files
 handler.undeploy_cep_configuration()
 
+print('connection reuse: ', http_client.get_client().stats())
 print('process has finish')
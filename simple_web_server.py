@@ -18,7 +18,7 @@ Send a POST request::
 from http.server import BaseHTTPRequestHandler, HTTPServer
 import socket
 import logging
-import json
+from bin import json_codec
 
 log = logging.getLogger('web_server')
 log.setLevel(logging.INFO)
@@ -47,7 +47,7 @@ class S(BaseHTTPRequestHandler):
         # Doesn't do anything with posted data
         content_length = int(self.headers['Content-Length'])  # <--- Gets the size of data
         post_data = self.rfile.read(content_length)  # <--- Gets the data itself
-        content = json.loads(str(post_data, 'utf8'))
+        content = json_codec.loads(post_data)
 
         streamer_id = content['event']['correlationData']['event_id']
         log.info('Notification | 300 | ' + streamer_id)
@@ -0,0 +1,47 @@
+"""
+Cost of encoding and decoding CEP events with the JSON codecs available in json_codec
+
+Events are mapped with cep.map_datatastream, as pushed by StreamGenerator one at a time, and encoded one by one
+and as batches (the JSON arrays posted by EventBatcher). Decoding is measured on the encoded batches, as done by the
+local CEP and the notification web servers. No network access is required.
+"""
+
+import json
+import timeit
+from bin import cep
+from bin import gevent
+from bin import json_codec
+
+# config:
+no_sensors = 2000
+batch_size = 100
+repeat = 5
+
+events = []
+for i in range(no_sensors):
+    datastreams = [{"@iot.id": 1000 + i, "unitOfMeasurement": {"symbol": "degC"},
+                    "Observations": [{"@iot.id": 100000 + i, "phenomenonTime": "2018-01-10T10:00:00.000Z",
+                                      "resultTime": "2018-01-10T10:00:00.000Z", "result": 15 + (i % 200) / 10}]}]
+    events.append(cep.map_datatastream('benchmark', datastreams, [-3.80 + i * 1e-5, 43.45 + i * 1e-5],
+                                       gevent.StreamGenerator.stream_definition))
+batches = [events[i:i + batch_size] for i in range(0, no_sensors, batch_size)]
+
+
+def requests_default(event):
+    # what requests.post(json=...) does
+    return json.dumps(event, allow_nan=False).encode('utf-8')
+
+
+print('events: ', no_sensors, ' batch size: ', batch_size)
+print('codecs: ', ', '.join(json_codec.codecs))
+print('%-32s %8.2f us/event' % ('json.dumps (requests json=)',
+                                min(timeit.repeat(lambda: [requests_default(e) for e in events], number=1,
+                                                  repeat=repeat)) / no_sensors * 1e6))
+for name, codec in json_codec.codecs.items():
+    single = min(timeit.repeat(lambda: [codec.dumps(e) for e in events], number=1, repeat=repeat))
+    batched = min(timeit.repeat(lambda: [codec.dumps(b) for b in batches], number=1, repeat=repeat))
+    encoded = [codec.dumps(b) for b in batches]
+    decoded = min(timeit.repeat(lambda: [codec.loads(b) for b in encoded], number=1, repeat=repeat))
+    print('%-32s %8.2f us/event' % (name + ' dumps', single / no_sensors * 1e6))
+    print('%-32s %8.2f us/event' % (name + ' dumps (batches)', batched / no_sensors * 1e6))
+    print('%-32s %8.2f us/event' % (name + ' loads (batches)', decoded / no_sensors * 1e6))
@@ -0,0 +1,56 @@
+"""
+Per-event cost of mapping observations into CEP events
+
+Compares cep.map_datatastream (one observation at a time, followed by JSON serialization as done by requests)
+with the compiled cep.EventMapper, on Things as returned by the Sensor API and on a columnar ObservationStore.
+No network access is required.
+"""
+
+import json
+import timeit
+from bin import cep
+from bin import gevent
+from bin.observation_store import ObservationStore
+
+# config:
+no_sensors = 2000
+repeat = 5
+
+things = []
+for i in range(no_sensors):
+    things.append({"@iot.id": i, "name": "thing " + str(i),
+                   "Datastreams": [{"@iot.id": 1000 + i, "unitOfMeasurement": {"symbol": "degC"},
+                                    "Observations": [{"@iot.id": 100000 + i,
+                                                      "phenomenonTime": "2018-01-10T10:00:00.000Z",
+                                                      "resultTime": "2018-01-10T10:00:00.000Z",
+                                                      "result": 15 + (i % 200) / 10}]}],
+                   "Locations": [{"location": {"type": "Point",
+                                               "coordinates": [-3.80 + i * 1e-5, 43.45 + i * 1e-5]}}]})
+
+stream_definition = gevent.StreamGenerator.stream_definition
+generator_id = 'benchmark'
+store = ObservationStore.from_things(things)
+mapper = cep.EventMapper(stream_definition)
+
+
+def current_mapping():
+    for thing in things:
+        coords = gevent.get_xy_coord(thing['Locations'][0]['location'])
+        event = cep.map_datatastream(generator_id, thing['Datastreams'], coords, stream_definition)
+        json.dumps(event).encode('utf-8')
+
+
+def compiled_things():
+    mapper.map_things(things, generator_id)
+
+
+def compiled_store():
+    mapper.map_store(store, generator_id)
+
+
+print('sensors: ', no_sensors)
+for name, function in [('map_datatastream + json.dumps', current_mapping),
+                       ('EventMapper.map_things', compiled_things),
+                       ('EventMapper.map_store', compiled_store)]:
+    best = min(timeit.repeat(function, number=1, repeat=repeat))
+    print('%-32s %8.2f us/event' % (name, best / no_sensors * 1e6))
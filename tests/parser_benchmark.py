@@ -0,0 +1,77 @@
+"""
+Parse time and peak memory per page of an observations request
+
+Compares parsing the whole response (as done by request.json()) followed by ObservationStore.from_things, with
+stream_parser.parse_things_page: on the shared JSON codec (default), and in low memory mode, incremental with the
+prefix events of ijson, which only keeps the fields of the store. Pages are generated with the fields expanded by
+gevent.prepare_observations_request.
+No network access is required.
+"""
+
+import io
+import json
+import timeit
+import tracemalloc
+from bin import json_codec
+from bin import stream_parser
+from bin.observation_store import ObservationStore
+
+# config:
+page_size = 200
+repeat = 5
+
+things = []
+for i in range(page_size):
+    things.append({"@iot.id": i, "name": "thing " + str(i),
+                   "Datastreams": [{"@iot.id": 1000 + i,
+                                    "@iot.selfLink": "http://localhost:8080/v1.0/Datastreams(" + str(1000 + i) + ")",
+                                    "unitOfMeasurement": {"name": "degree Celsius", "symbol": "degC",
+                                                          "definition": "http://unitsofmeasure.org/ucum.html#para-30"},
+                                    "Observations@iot.navigationLink": "http://localhost:8080/v1.0/Datastreams(" +
+                                                                       str(1000 + i) + ")/Observations",
+                                    "Observations": [{"@iot.id": 100000 + i,
+                                                      "@iot.selfLink": "http://localhost:8080/v1.0/Observations(" +
+                                                                       str(100000 + i) + ")",
+                                                      "phenomenonTime": "2018-01-10T10:00:00.000Z",
+                                                      "resultTime": "2018-01-10T10:00:00.000Z",
+                                                      "result": 15 + (i % 200) / 10,
+                                                      "parameters": {"battery": 87, "signal": -71}}]}],
+                   "Locations": [{"location": {"type": "Point", "coordinates": [-3.80 + i * 1e-5, 43.45 + i * 1e-5]},
+                                  "HistoricalLocations@iot.navigationLink": "http://localhost:8080/v1.0/Locations(" +
+                                                                            str(i) + ")/HistoricalLocations",
+                                  "HistoricalLocations": [{"@iot.id": 500 + i, "time": "2018-01-01T00:00:00.000Z"}]}]})
+body = json.dumps({"@iot.count": 10 * page_size, "value": things,
+                   "@iot.nextLink": "http://localhost:8080/v1.0/Things?$top=200&$skip=200"}).encode('utf-8')
+
+
+def full_parse():
+    # what request.json() does: decode the body into text, then parse it as a whole
+    return ObservationStore.from_things(json.loads(body.decode('utf-8'))['value'])
+
+
+def incremental_parse():
+    return stream_parser.parse_things_page(io.BytesIO(body), low_memory=True)[0]
+
+
+def codec_parse():
+    return stream_parser.parse_things_page(io.BytesIO(body))[0]
+
+
+def peak_memory(function):
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+print('things per page: ', page_size, ' body: ', len(body) // 1024, 'KiB')
+functions = [('request.json() + from_things', full_parse),
+             ('parse_things_page, ' + json_codec.get_codec().name, codec_parse)]
+if stream_parser.ijson is None:
+    print('ijson is not installed: the incremental parser is not available')
+else:
+    functions.append(('parse_things_page, low memory', incremental_parse))
+for name, function in functions:
+    best = min(timeit.repeat(function, number=1, repeat=repeat))
+    print('%-32s %8.2f ms/page %8.1f KiB peak' % (name, best * 1e3, peak_memory(function) / 1024))
@@ -10,6 +10,7 @@ Endpoint: HTTP server with 100 threads
 
 import json
 from bin import gevent
+from bin import http_client
 import socket
 import concurrent.futures
 import time
@@ -48,6 +49,7 @@ conf_f = '../bin/config.json'
 with open(conf_f) as c:
     cf = c.read()
     conf = json.loads(cf)
+http_client.configure(conf["geosmart.sys"]["http"])
 
 log.info('start intantiation')
 
@@ -81,22 +83,14 @@ log.info('end instantiation')
 
 log.info('start cep config deployment')
 handler.deploy_cep_configuration(publisher_target)
-delay = 10
-print('.....Waiting for deployment %s seconds....' % delay)
-time.sleep(delay) # (seconds) induce delay, to allow CEP server to deploy files
+handler.wait_until_ready(timeout=60)  # poll the CEP server until the deployed files are live
 
 log.info('End cep config deployment')
+log.info('Deployment session: %s', str(handler.deployment_stats))
+log.info('Deployment latency (s): %s', str(handler.deployment_latency))
 
 # 8. find receiver endpoint:
-name = handler.deployed_files["receivers"][0]
-
-pos = name.find('receiver-')
-name = name[pos + 9:]
-pos2 = name.find('_')
-name = name[:pos2]
-# print(name)
-re = conf["geosmart.sys"]["cep"]["root url"] + '/' + 'httpReceiver' + name
-re = re + '1'
+re = handler.receiver_endpoints[0]
 # print('data will be send to: ', re)
 
 # 9. Crate observations buffer
@@ -126,6 +120,7 @@ g.stream_to_cep(workers=threads)
 e_end = time.time()
 
 log.info("Total data push time (s):" + str(e_end - s_start))
+log.info("HTTP connection reuse: %s", str(http_client.get_client().stats()))
 
 print('buffer size: ', data_buffer.size, ' ET streaming time: ', (e_end - s_start))
 
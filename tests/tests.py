@@ -1,12 +1,31 @@
 
 import unittest
+from unittest import mock
 
 import json
+import requests
 from bin import gevent as ge
 from bin import cep
+from bin import scheduler
+from bin.observation_store import ObservationStore, GridAggregation, granularity_to_degrees
+from bin.prefilter import compile_conditions
+from bin import local_cep
+from bin.fetch_planner import FetchPlanner
+from bin.lifecycle import LifecycleManager, EventRuntime
+from bin.delivery import DeliveryQueue, CircuitBreaker
+from bin.pipeline import Pipeline
+from bin import json_codec
+from bin import stream_parser
+from bin import http_client
+import concurrent.futures
+import gc
+import io
 import os
+import re
 import copy
+import numpy as np
 import tempfile
+import threading
 import  time
 
 file_dir = os.path.dirname(__file__)
@@ -22,6 +41,20 @@ with open(conf_file) as ffile:
 
 reciever_url = 'http://localhost:9763/endpoints/httpReceiver001'
 
+# Things as returned by a request prepared with prepare_observations_request()
+things_test = [
+    {"@iot.id": 1, "name": "thing 1",
+     "Datastreams": [{"@iot.id": 11, "unitOfMeasurement": {"symbol": "degC"},
+                      "Observations": [{"@iot.id": 101, "phenomenonTime": "2018-01-10T10:00:00.000Z",
+                                        "resultTime": "2018-01-10T10:00:00.000Z", "result": 21.5}]}],
+     "Locations": [{"location": {"type": "Point", "coordinates": [-3.80, 43.45]}}]},
+    {"@iot.id": 2, "name": "thing 2",
+     "Datastreams": [{"@iot.id": 12, "unitOfMeasurement": {"symbol": "degC"},
+                      "Observations": [{"@iot.id": 102, "phenomenonTime": "2018-01-10T10:05:00.000Z",
+                                        "resultTime": "2018-01-10T10:05:00.000Z", "result": 27.0}]}],
+     "Locations": [{"location": {"type": "Point", "coordinates": [-3.79, 43.46]}}]}
+]
+
 stream_def_test= {
   "name": "geosmart.remote.test100",
   "version": "1.0.0",
@@ -63,6 +96,82 @@ stream_def_test= {
   ]
 }
 
+class ClosingDeployer(cep.LocalDeployer):
+    """ LocalDeployer counting how many times it is closed"""
+    def __init__(self, cep_conf, home_directory=None):
+        cep.LocalDeployer.__init__(self, cep_conf, home_directory)
+        self.closed = 0
+
+    def close(self):
+        self.closed += 1
+
+
+def make_things(number):
+    """ Things with one Temperature observation each, located in the extent of the test event"""
+    return [{"@iot.id": i, "name": "thing " + str(i),
+             "Datastreams": [{"@iot.id": 1000 + i, "unitOfMeasurement": {"symbol": "degC"},
+                              "Observations": [{"@iot.id": 100000 + i, "phenomenonTime": "2018-01-10T10:00:00.000Z",
+                                                "resultTime": "2018-01-10T10:00:00.000Z", "result": 20 + i % 10}]}],
+             "Locations": [{"location": {"type": "Point", "coordinates": [-3.80 + (i % 100) * 1e-4, 43.45]}}]}
+            for i in range(number)]
+
+
+class FakeResponse:
+    """ Response of FakeSensorApi"""
+    def __init__(self, body):
+        self.status_code = 200
+        self.body = body
+        self.raw = io.BytesIO(json.dumps(body).encode('utf-8'))
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeSensorApi:
+    """ In-process Sensor API serving pages of Things with $top, $skip and $count. Used as the shared http client
+    inside a with statement"""
+    def __init__(self, things, max_top=None):
+        self.things = things
+        self.max_top = max_top  # page size of the server, when it serves less than $top
+        self.requests = []
+
+    def get(self, url, **kwargs):
+        self.requests.append(url)
+        top = int(re.search(r'[?&]\$top=(\d+)', url).group(1))
+        if self.max_top is not None:
+            top = min(top, self.max_top)
+        skip = re.search(r'[?&]\$skip=(\d+)', url)
+        skip = int(skip.group(1)) if skip else 0
+        body = {"value": self.things[skip:skip + top]}
+        if '$count=true' in url:
+            body["@iot.count"] = len(self.things)
+        if skip + top < len(self.things):
+            base = re.sub(r'&\$(skip|count)=\w+', '', url)
+            body["@iot.nextLink"] = base + '&$skip=' + str(skip + top)
+        return FakeResponse(body)
+
+    def __enter__(self):
+        self._client, http_client._client = http_client._client, self
+        return self
+
+    def __exit__(self, *exc):
+        http_client._client = self._client
+
+
+def make_cep_home(home):
+    """ Hot directories of a CEP server in a local directory"""
+    cep_cof = conf["geosmart.sys"]["cep"]
+    for subdir in ('stream subdir', 'receiver subdir', 'plan subdir', 'publisher subdir'):
+        os.makedirs(home + cep_cof[subdir])
+    return cep_cof
+
+
 class TestGevent(unittest.TestCase):
 
     def test_Gevent(self):
@@ -74,6 +183,46 @@ class TestGevent(unittest.TestCase):
         names = event.phenomena_names()
         self.assertEqual(names, ['Temperature'], 'Function phenomena_names() failed to produce the right output')
 
+    def test_phenomena_names_nested(self):
+        nested = copy.deepcopy(definition)
+        nested['properties']['attributive']['conditions'] = {"or": [{"and": [{">": ["Temperature", 25]}, {"<": ["Luminosity", 3]}]}, {"!": {"==": ["Wind", "N"]}}]}
+        event = ge.GEvent(nested)
+        self.assertEqual(event.phenomena_names(), ['Temperature', 'Luminosity', 'Wind'])
+        self.assertEqual(event.phenomenon_json_type('Luminosity'), 'DOUBLE')
+        self.assertEqual(event.phenomenon_json_type('Wind'), 'STRING')
+
+    def test_compiled_gevent(self):
+        event = ge.GEvent(definition)
+        compiled = event.compile()
+        self.assertIs(event.compile(), compiled)
+        self.assertEqual(compiled.phenomena, ['Temperature'])
+        self.assertTrue(compiled.contains(-3.80, 43.45))
+        self.assertFalse(compiled.contains(-3.70, 43.45))
+        self.assertTrue(compiled.in_time(ge.datetime.datetime(2016, 1, 1)))
+        self.assertFalse(compiled.in_time(ge.datetime.datetime(2019, 1, 1)))
+        # the time window is in UTC
+        ahead = ge.datetime.timezone(ge.datetime.timedelta(hours=14))
+        end = compiled.time_end.replace(tzinfo=ge.datetime.timezone.utc)
+        self.assertFalse(compiled.in_time((end + ge.datetime.timedelta(minutes=1)).astimezone(ahead)))
+        with self.assertRaises(AttributeError):
+            compiled.other = 1  # __slots__
+
+    def test_extent_index(self):
+        events = []
+        for x in range(10):
+            new_definition = copy.deepcopy(definition)
+            new_definition['properties']['spatial']['extent'] = \
+                "POLYGON((%d 0, %d 0, %d 1, %d 1, %d 0))" % (x, x + 1, x + 1, x, x)
+            events.append(ge.GEvent(new_definition))
+        index = ge.ExtentIndex(events)
+        self.assertEqual([event.id_ for event in index.events_at(3.5, 0.5)], [events[3].id_])
+        self.assertEqual(set(event.id_ for event in index.events_at(3, 0.5)), {events[2].id_, events[3].id_})
+        routed = index.route([0.5, 9.5, 20], [0.5, 0.5, 0.5])
+        self.assertEqual(routed[events[0].id_].tolist(), [0])
+        self.assertEqual(routed[events[9].id_].tolist(), [1])
+        index.remove(events[0])
+        self.assertEqual(index.events_at(0.5, 0.5), [])
+
     def test_EventHandler(self):
         gevent = ge.GEvent(definition)
         handler = ge.EventHandler(gevent, conf)
@@ -88,11 +237,196 @@ class TestGevent(unittest.TestCase):
         # undeploy = handler.undeploy_cep_configuration()
         # self.assertFalse(undeploy, 'undeploy_cep_configuration() failed to remove files')
 
+    def test_incremental_redeploy(self):
+        with tempfile.TemporaryDirectory() as home:
+            cep_cof = make_cep_home(home)
+            handler = ge.EventHandler(ge.GEvent(definition), conf, cep.LocalDeployer(cep_cof, home))
+            self.assertTrue(handler.deploy_cep_configuration('http://localhost:80'))
+            self.assertEqual(handler.artifact_changes['uploaded'], 5)
+
+            # identical files are not uploaded again
+            self.assertTrue(handler.deploy_cep_configuration('http://localhost:80'))
+            self.assertEqual(handler.artifact_changes['uploaded'], 0)
+            self.assertEqual(handler.artifact_changes['unchanged'], 5)
+
+            # a new threshold changes only the execution plan
+            new_definition = copy.deepcopy(definition)
+            new_definition['properties']['attributive']['conditions'] = {'>': ['Temperature', 30]}
+            new_event = ge.GEvent(new_definition)
+            self.assertRaises(ValueError, handler.update_event, new_event, 'http://localhost:80')
+            new_event.id_ = handler.event_id
+            self.assertTrue(handler.update_event(new_event, 'http://localhost:80'))
+            self.assertEqual(handler.artifact_changes['uploaded'], 1)
+            self.assertEqual(len(handler.receiver_endpoints), len(new_event.phenomena_names()))
+            plan = handler.deployed_files['plans'][0]
+            with open(handler.deployer.local_path(plan)) as fo:
+                self.assertIn('30', fo.read())
+
+            self.assertFalse(handler.undeploy_cep_configuration())
+            self.assertEqual(handler.deployed_artifacts, {})
+
+    def test_shared_streams(self):
+        with tempfile.TemporaryDirectory() as home:
+            cep_cof = make_cep_home(home)
+            registry = ge.SharedStreamRegistry(cep_cof)
+            handlers = []
+            for threshold in (20, 30):
+                new_definition = copy.deepcopy(definition)
+                new_definition['properties']['attributive']['conditions'] = {'>': ['Temperature', threshold]}
+                handler = ge.EventHandler(ge.GEvent(new_definition), conf, cep.LocalDeployer(cep_cof, home), registry)
+                self.assertTrue(handler.deploy_cep_configuration('http://localhost:80'))
+                handlers.append(handler)
+
+            receiver = handlers[0].deployed_files['receivers'][0]
+            self.assertEqual(handlers[1].deployed_files['receivers'], [receiver])
+            self.assertEqual(handlers[0].receiver_endpoints, handlers[1].receiver_endpoints)
+            self.assertEqual(registry.users(receiver), {handlers[0].event_id, handlers[1].event_id})
+            self.assertEqual(os.listdir(home + cep_cof['receiver subdir']), ['receiver-shared-Temperature.xml'])
+
+            # shared files are removed by the last event using them
+            self.assertFalse(handlers[0].undeploy_cep_configuration())
+            self.assertEqual(registry.users(receiver), {handlers[1].event_id})
+            self.assertEqual(os.listdir(home + cep_cof['receiver subdir']), ['receiver-shared-Temperature.xml'])
+            self.assertFalse(handlers[1].undeploy_cep_configuration())
+            self.assertEqual(os.listdir(home + cep_cof['receiver subdir']), [])
+
+    def test_deployer_released_on_error(self):
+        with tempfile.TemporaryDirectory() as home:
+            cep_cof = make_cep_home(home)
+            registry = ge.SharedStreamRegistry(cep_cof)
+            first = ge.EventHandler(ge.GEvent(definition), conf, cep.LocalDeployer(cep_cof, home), registry)
+            self.assertTrue(first.deploy_cep_configuration('http://localhost:80'))
+
+            # the shared Temperature stream is deployed as DOUBLE, a STRING definition cannot acquire it
+            new_definition = copy.deepcopy(definition)
+            new_definition['properties']['attributive']['conditions'] = {'==': ['Temperature', 'high']}
+            second = ge.EventHandler(ge.GEvent(new_definition), conf, shared_streams=registry)
+            deployer = ClosingDeployer(cep_cof, home)
+            second.new_deployer = lambda: deployer
+            with self.assertRaises(ValueError):
+                second.deploy_cep_configuration('http://localhost:80')
+            self.assertEqual(deployer.closed, 1)
+
+    def test_orchestrated_deployers(self):
+        # handlers of two CEP servers, each with its own deployer
+        with tempfile.TemporaryDirectory() as first_home, tempfile.TemporaryDirectory() as second_home:
+            handlers = []
+            for home in (first_home, second_home):
+                cep_cof = make_cep_home(home)
+                deployer = ClosingDeployer(cep_cof, home)
+                for threshold in (20, 30):
+                    new_definition = copy.deepcopy(definition)
+                    new_definition['properties']['attributive']['conditions'] = {'>': ['Temperature', threshold]}
+                    handlers.append(ge.EventHandler(ge.GEvent(new_definition), conf, deployer))
+            orchestrator = ge.DeploymentOrchestrator(max_sessions=4)
+            results = orchestrator.deploy(handlers, 'http://localhost:80')
+            self.assertEqual(results, {handler.event_id: True for handler in handlers})
+            self.assertEqual(orchestrator.stats['sessions'], 2)
+            for home, deployed in ((first_home, handlers[:2]), (second_home, handlers[2:])):
+                plans = sorted(os.listdir(home + conf["geosmart.sys"]["cep"]['plan subdir']))
+                self.assertEqual(plans, sorted(os.path.basename(handler.deployed_files['plans'][0])
+                                               for handler in deployed))
+
+            results = orchestrator.undeploy(handlers)
+            self.assertEqual(results, {handler.event_id: False for handler in handlers})
+            for home in (first_home, second_home):
+                self.assertEqual(os.listdir(home + conf["geosmart.sys"]["cep"]['plan subdir']), [])
+            # the deployers belong to the handlers
+            self.assertEqual(handlers[0].deployer.closed, 0)
+
+    def test_wait_until_ready(self):
+        class ReceiverProbe:
+            """ Http client answering the receivers with the given status codes, then with the last one"""
+            def __init__(self, *statuses):
+                self.statuses = list(statuses)
+                self.requests = []
+
+            def get(self, url, **kwargs):
+                self.requests.append(url)
+                response = FakeResponse({})
+                response.status_code = self.statuses.pop(0) if len(self.statuses) > 1 else self.statuses[0]
+                return response
+
+        with tempfile.TemporaryDirectory() as home:
+            handler = ge.EventHandler(ge.GEvent(definition), conf, cep.LocalDeployer(make_cep_home(home), home))
+            self.assertTrue(handler.deploy_cep_configuration('http://localhost:80'))
+            client = http_client._client
+            try:
+                http_client._client = probe = ReceiverProbe(404, 503, 405)
+                self.assertTrue(handler.wait_until_ready(timeout=5, initial_delay=0.01))
+                self.assertEqual(len(probe.requests), 3, 'Receivers are polled until they are live')
+                self.assertEqual(set(probe.requests), set(handler.receiver_endpoints))
+                self.assertIsNotNone(handler.deployment_latency)
+
+                http_client._client = probe = ReceiverProbe(503)
+                self.assertFalse(handler.wait_until_ready(timeout=0.1, initial_delay=0.01, max_delay=0.02))
+                self.assertGreater(len(probe.requests), 1)
+
+                # a file not picked up yet: the receivers are not polled
+                plan = handler.deployed_files['plans'][0]
+                os.remove(home + plan[len(conf["geosmart.sys"]["cep"]['home directory']):])
+                http_client._client = probe = ReceiverProbe(200)
+                self.assertFalse(handler.wait_until_ready(timeout=0.1, initial_delay=0.01))
+                self.assertEqual(probe.requests, [])
+            finally:
+                http_client._client = client
+
+    def test_wait_until_ready_listing_fails(self):
+        class FlakyDeployer(ClosingDeployer):
+            """ Deployer whose first listings fail"""
+            def __init__(self, cep_conf, home_directory, failures):
+                ClosingDeployer.__init__(self, cep_conf, home_directory)
+                self.failures = failures
+
+            def listdir(self, path):
+                if self.failures:
+                    self.failures -= 1
+                    raise OSError('connection lost')
+                return cep.LocalDeployer.listdir(self, path)
+
+        with tempfile.TemporaryDirectory() as home:
+            cep_cof = make_cep_home(home)
+            handler = ge.EventHandler(ge.GEvent(definition), conf, cep.LocalDeployer(cep_cof, home))
+            self.assertTrue(handler.deploy_cep_configuration('http://localhost:80'))
+            handler.receiver_endpoints = []
+
+            # the session of the caller is kept open after a failed listing
+            session = FlakyDeployer(cep_cof, home, 1)
+            self.assertTrue(handler.wait_until_ready(timeout=5, initial_delay=0.01, session=session))
+            self.assertEqual(session.closed, 0)
+
+            # the sessions of the handler are released, and a new one is opened on the next poll
+            sessions = []
+
+            def new_deployer():
+                sessions.append(FlakyDeployer(cep_cof, home, 1 if not sessions else 0))
+                return sessions[-1]
+            handler.new_deployer = new_deployer
+            self.assertTrue(handler.wait_until_ready(timeout=5, initial_delay=0.01))
+            self.assertEqual([s.closed for s in sessions], [1, 1])
+            self.assertEqual(handler.deployment_stats, sessions[-1].stats())
+
     def test_StreamGenerator(self):
         expiration = '2018-01-31T10:00:00Z'
         g = ge.StreamGenerator('http://130.89.217.201:8080/SensorThingsServer/v1.0/Datastreams(4)', expiration, receiver_endpoint=reciever_url)
         self.assertIsInstance(g, ge.StreamGenerator, 'Failed to instantiate StreamGenerator')
 
+    def test_expiration_in_utc(self):
+        receiver = TestDelivery.Receiver(failures=0)
+        ahead = ge.datetime.timezone(ge.datetime.timedelta(hours=14))
+        # expired one minute ago, while its local time is ahead of the local time of the host
+        expired = ge.datetime.datetime.now(ahead) - ge.datetime.timedelta(minutes=1)
+        generator = ge.StreamGenerator(list(things_test), expired, receiver, batch_size=100)
+        self.assertEqual(generator.expiration_time.utcoffset(), ge.datetime.timedelta(0))
+        generator.stream_to_cep()
+        self.assertEqual(receiver.received, [])
+
+        generator = ge.StreamGenerator(list(things_test), expired + ge.datetime.timedelta(minutes=2), receiver,
+                                       batch_size=100, phenomenon='Luminosity')
+        generator.stream_to_cep()
+        self.assertEqual([event['event']['payloadData']['Luminosity'] for event in json.loads(receiver.received[0])],
+                         [thing['Datastreams'][0]['Observations'][0]['result'] for thing in things_test])
+
     def test_collect_observations(self):
         api_root = 'http://130.89.217.201:8080/frost-server/v1.0'
         extent = 'POLYGON((-3.8469736283051370 43.4414847853464039, -3.8469736283051370 43.4863448420050389,  -3.7663235810882401 43.4863448420050389, -3.7663235810882401 43.4414847853464039, -3.8469736283051370 43.4414847853464039))'
@@ -101,6 +435,60 @@ class TestGevent(unittest.TestCase):
         # print(prepared_request)
         obs = ge.collect_observations(prepared_request)
 
+    def test_collect_observations_parallel(self):
+        api_root = 'http://130.89.217.201:8080/frost-server/v1.0'
+        extent = 'POLYGON((-3.8469736283051370 43.4414847853464039, -3.8469736283051370 43.4863448420050389,  -3.7663235810882401 43.4863448420050389, -3.7663235810882401 43.4414847853464039, -3.8469736283051370 43.4414847853464039))'
+        phenomenon = 'Luminosity'
+        prepared_request = ge.prepare_observations_request(api_root, extent, phenomenon, page_size=20)
+        sequential = ge.collect_observations(prepared_request)
+        parallel = ge.collect_observations(prepared_request, parallel=True, workers=4)
+        self.assertEqual([t['@iot.id'] for t in sequential], [t['@iot.id'] for t in parallel], 'Parallel pagination changed the order of Things')
+
+    def test_fetch_pages_offsets(self):
+        things = [{"@iot.id": i} for i in range(1050)]
+        requested = []
+
+        class Response:
+            def __init__(self, body):
+                self.status_code = 200
+                self.body = body
+
+            def json(self):
+                return self.body
+
+            def raise_for_status(self):
+                pass
+
+        def request(session, method, url, **kwargs):
+            # Sensor API serving at most 200 Things per page, and the first pages last
+            requested.append(url)
+            top = min(int(re.search(r'[?&]\$top=(\d+)', url).group(1)), 200)
+            skip = re.search(r'[?&]\$skip=(\d+)', url)
+            skip = int(skip.group(1)) if skip else 0
+            time.sleep((len(things) - skip) / 20000 if skip else 0)
+            body = {"value": things[skip:skip + top]}
+            if '$count=true' in url:
+                body["@iot.count"] = len(things)
+            if skip + top < len(things):
+                body["@iot.nextLink"] = re.sub(r'&\$(skip|count)=\w+', '', url) + '&$skip=' + str(skip + top)
+            return Response(body)
+
+        request_uri = 'http://localhost:8080/v1.0/Things?$top=1000'
+        with mock.patch.object(requests.Session, 'request', request):
+            pages = ge.fetch_pages_parallel(request_uri, workers=4)
+            self.assertEqual(requested[0], request_uri + '&$count=true')
+            self.assertEqual(sorted(requested[1:]), sorted(request_uri + '&$skip=' + str(skip)
+                                                           for skip in (200, 400, 600, 800, 1000)),
+                             'Offsets follow the page size served, not $top')
+            self.assertEqual([len(page) for page in pages], [200, 200, 200, 200, 200, 50])
+            self.assertEqual([thing['@iot.id'] for page in pages for thing in page], list(range(1050)),
+                             'Pages are in the order served by the API')
+
+            del things[150:], requested[:]
+            pages = ge.fetch_pages_parallel(request_uri)
+            self.assertEqual(len(requested), 1, 'A single page is requested once')
+            self.assertEqual([len(page) for page in pages], [150])
+
 
     def test_ObservationsBuffer(self):
         api_root = 'http://130.89.217.201:8080/frost-server/v1.0'
@@ -178,12 +566,817 @@ class TesCep(unittest.TestCase):
         remove_cep = cep.remove_from_cep(stream_dir, cep_cof, handler_cof)
         self.assertTrue(remove_cep, 'Stream file was not removed from the CEP server')
 
+    def test_local_deployer(self):
+        with tempfile.TemporaryDirectory() as home:
+            cep_cof = dict(conf["geosmart.sys"]["cep"])
+            os.makedirs(home + cep_cof["stream subdir"])
+            deployer = cep.LocalDeployer(cep_cof, home)
+            file_path = cep_cof['home directory'] + cep_cof["stream subdir"] + '/geosmart.remote.test_1.0.0.json'
+            with tempfile.TemporaryFile('w+') as fo:
+                fo.write(json.dumps(stream_def_test))
+                fo.seek(0)
+                self.assertTrue(deployer.put(fo, file_path), 'Stream file was not created')
+            self.assertEqual(deployer.listdir(cep_cof['home directory'] + cep_cof["stream subdir"]),
+                             ['geosmart.remote.test_1.0.0.json'])
+            with open(deployer.local_path(file_path)) as fo:
+                self.assertEqual(json.load(fo), stream_def_test)
+            self.assertTrue(deployer.remove(file_path), 'Stream file was not removed')
+            self.assertFalse(deployer.remove(file_path))
+            self.assertEqual(deployer.stats()["files"], {"upload": 1, "remove": 1})
+
+    def test_sftp_session_reuse(self):
+        class FakeTransport:
+            """ SSH connection to an in-memory SFTP server"""
+            opened = []
+
+            def __init__(self, address):
+                self.active = True
+                FakeTransport.opened.append(self)
+
+            def is_active(self):
+                return self.active
+
+            def connect(self, username=None, pkey=None):
+                pass
+
+            def close(self):
+                self.active = False
+
+        class FakeSftp:
+            files = {}
+
+            def putfo(self, file_object, file_path):
+                FakeSftp.files[file_path] = file_object.read()
+
+            def remove(self, file_path):
+                del FakeSftp.files[file_path]
+
+            def close(self):
+                pass
+
+        keys = []
+        cep_cof = conf["geosmart.sys"]["cep"]
+        stream_dir = cep_cof['home directory'] + cep_cof["stream subdir"]
+        with mock.patch.object(cep.paramiko, 'Transport', FakeTransport), \
+                mock.patch.object(cep.paramiko.SFTPClient, 'from_transport', lambda transport: FakeSftp()), \
+                mock.patch.object(cep.paramiko.RSAKey, 'from_private_key_file',
+                                  lambda *args: keys.append(args) or 'key'), \
+                mock.patch.object(cep, '_log_to_file', lambda log_file: None):
+            with cep.get_deployer(cep_cof, conf["geosmart.sys"]["handler"]) as deployer:
+                for number in range(3):
+                    self.assertTrue(cep.upload_to_cep(stream_dir + '/stream_%d.json' % number,
+                                                      io.StringIO('{}'), cep_cof, None, session=deployer))
+                self.assertTrue(cep.remove_from_cep(stream_dir + '/stream_0.json', cep_cof, None, session=deployer))
+                self.assertEqual(deployer.handshakes, 1, 'One SSH handshake for all the files of a deployment')
+                FakeTransport.opened[-1].active = False  # connection lost
+                self.assertTrue(deployer.put(io.StringIO('{}'), stream_dir + '/stream_3.json'))
+                stats = deployer.stats()
+            self.assertFalse(FakeTransport.opened[-1].active, 'The connection is closed with the deployer')
+        self.assertEqual(stats["handshakes"], 2, 'A lost connection is opened again')
+        self.assertEqual(len(keys), 1, 'The private key is loaded once')
+        self.assertEqual(stats["files"], {"upload": 4, "remove": 1})
+        self.assertEqual(sorted(FakeSftp.files), [stream_dir + '/stream_%d.json' % number for number in (1, 2, 3)])
+
+    def test_event_mapper(self):
+        mapper = cep.EventMapper(stream_def_test)
+        expected = [cep.map_datatastream('g1', thing['Datastreams'], thing['Locations'][0]['location']['coordinates'], stream_def_test) for thing in things_test]
+        for event in expected:
+            event['event']['correlationData']['event_id'] = 'g1'
+        from_things = [json.loads(e) for e in mapper.map_things(things_test, 'g1')]
+        from_store = [json.loads(e) for e in mapper.map_store(ObservationStore.from_things(things_test), 'g1')]
+        self.assertEqual(expected, from_things, 'EventMapper.map_things() does not match map_datatastream()')
+        self.assertEqual(expected, from_store, 'EventMapper.map_store() does not match map_datatastream()')
+        self.assertEqual(json.loads(mapper.encode_batch(mapper.map_things(things_test, 'g1'))), expected)
+
+    def test_event_mapper_invalid_numbers(self):
+        mapper = cep.EventMapper(stream_def_test)
+        things = copy.deepcopy(things_test)
+        things[0]['Datastreams'][0]['Observations'][0]['@iot.id'] = 'obs-1'
+        things[0]['Locations'][0]['location']['coordinates'] = [float('nan'), float('inf')]
+        for events in (mapper.map_things(things, 'g1'), mapper.map_store(ObservationStore.from_things(things), 'g1')):
+            batch = json.loads(mapper.encode_batch(events))  # valid JSON
+            self.assertEqual(batch[0]['event']['metaData']['observation_id'], 'obs-1')
+            self.assertEqual((batch[0]['event']['payloadData']['x_coord'], batch[0]['event']['payloadData']['y_coord']),
+                             (None, None))
+            self.assertEqual(batch[1]['event']['payloadData']['x_coord'], -3.79)
+
     def test_cep_query(self):
         test_query = 'from inputs [Temperature > -1000] select * insert into outputs'
         condition = definition['properties']['attributive']['conditions'].items().__iter__()
         query = cep.cep_query(condition.__next__(), 'inputs', 'outputs')
         self.assertMultiLineEqual(query, test_query, 'Query does not have the right format')
 
+    def test_condition_to_siddhi(self):
+        conditions = {"or": [{"and": [{">": ["Temperature", 25]}, {"<": ["Luminosity", 3]}]}, {"!": {"==": ["Wind", "N"]}}]}
+        expression = cep.condition_to_siddhi(conditions, {"Temperature": "e1.Temperature"})
+        self.assertEqual(expression, "(e1.Temperature > 25 and Luminosity < 3) or not (Wind == 'N')")
+
+class TestObservationStore(unittest.TestCase):
+
+    def test_from_things(self):
+        store = ObservationStore.from_things(things_test)
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.observation_id.tolist(), [101, 102])
+        self.assertEqual(store.symbols, ['degC'], 'Unit symbols should be interned')
+        self.assertEqual(list(store.records())[1], (102, '2018-01-10T10:05:00.000Z', 'degC', 27.0, -3.79, 43.46))
+
+    def test_select(self):
+        store = ObservationStore.from_things(things_test)
+        hot = store.select(store.result > 25)
+        self.assertEqual(hot.thing_id.tolist(), [2])
+
+    def test_string_ids(self):
+        things = copy.deepcopy(things_test)
+        things[0].update({"@iot.id": "thing-1"})
+        things[0]['Datastreams'][0].update({"@iot.id": "ds-1"})
+        things[0]['Datastreams'][0]['Observations'][0].update({"@iot.id": "obs-1"})
+        store = ObservationStore.from_things(things)
+        self.assertEqual(store.thing_id.tolist(), ["thing-1", 2])
+        self.assertEqual(store.datastream_id.tolist(), ["ds-1", 12])
+        self.assertEqual(store.observation_id.tolist(), ["obs-1", 102])
+        self.assertEqual(store.select(store.result < 25).observation_id.tolist(), ["obs-1"])
+        self.assertEqual(list(store.records())[0][0], "obs-1")
+        joined = ObservationStore.concat([ObservationStore.from_things(things_test), store])
+        self.assertEqual(joined.observation_id.tolist(), [101, 102, "obs-1", 102])
+        latest = GridAggregation(1.0, 1.0, 'max').apply(store)
+        self.assertEqual(latest.observation_id.tolist(), [102], 'Id of the latest observation of the cell')
+
+        ijson = stream_parser.ijson
+        try:
+            for parser in {ijson, None}:
+                stream_parser.ijson = parser
+                parsed = stream_parser.parse_things_page(io.BytesIO(json.dumps({"value": things}).encode()),
+                                                         low_memory=True)[0]
+                self.assertEqual(parsed.observation_id.tolist(), ["obs-1", 102])
+        finally:
+            stream_parser.ijson = ijson
+
+    def test_grid_aggregation(self):
+        neighbour = copy.deepcopy(things_test[0])
+        neighbour['Datastreams'][0]['Observations'][0].update({"@iot.id": 103, "result": 23.5})
+        neighbour['Locations'][0]['location']['coordinates'] = [-3.7999, 43.4501]
+        store = ObservationStore.from_things(things_test + [neighbour])
+
+        cell_x, cell_y = granularity_to_degrees(100, 'm', 43.45)
+        self.assertAlmostEqual(cell_y, 100 / 111320.0)
+        self.assertGreater(cell_x, cell_y)
+
+        mean = GridAggregation(cell_x, cell_y, 'mean').apply(store)
+        self.assertEqual(len(mean), 2, 'Observations in the same cell should be aggregated')
+        self.assertEqual(sorted(mean.result.tolist()), [22.5, 27.0])
+        self.assertEqual(sorted(mean.observation_id.tolist()), [102, 103])
+        self.assertEqual(sorted(GridAggregation(cell_x, cell_y, 'max').apply(store).result.tolist()), [23.5, 27.0])
+        self.assertEqual(sorted(GridAggregation(cell_x, cell_y, 'count').apply(store).result.tolist()), [1, 2])
+
+
+    def test_parse_things_page(self):
+        body = json.dumps({"@iot.count": 2, "value": things_test, "@iot.nextLink": "http://host/v1.0/Things?$skip=2"}).encode('utf-8')
+        expected = ObservationStore.from_things(things_test)
+        ijson = stream_parser.ijson
+        try:
+            for parser in {ijson, None}:  # incremental when ijson is installed, and the fallback
+                stream_parser.ijson = parser
+                store, next_link = stream_parser.parse_things_page(io.BytesIO(body), buffer_size=7, low_memory=True)
+                self.assertEqual(next_link, "http://host/v1.0/Things?$skip=2")
+                self.assertEqual(store.observation_id.tolist(), expected.observation_id.tolist())
+                self.assertEqual(store.result.tolist(), expected.result.tolist())
+                self.assertEqual(store.x.tolist(), expected.x.tolist())
+
+            # locations before the datastreams, older observations, results which are not numbers
+            things = copy.deepcopy(things_test)
+            things[0] = {"Locations": things[0]['Locations'] + [{"location": {"coordinates": [9.0, 9.0]}}],
+                         "Datastreams": things[0]['Datastreams'], "@iot.id": things[0]['@iot.id']}
+            things[1]['Datastreams'][0]['Observations'].append({"@iot.id": 5, "resultTime": None, "result": 1,
+                                                                "phenomenonTime": "2017-01-10T10:00:00.000Z"})
+            things[1]['Datastreams'].append({"@iot.id": 13, "unitOfMeasurement": {"symbol": "lux"},
+                                             "Observations": [{"@iot.id": 6, "resultTime": None, "result": [1, 2],
+                                                               "phenomenonTime": "2018-01-10T10:06:00.000Z"}]})
+            things[0]['Datastreams'][0]['Observations'][0]['result'] = {"7": 3}  # keys are not results
+            expected = ObservationStore.from_things(things)
+            for parser in {ijson, None}:
+                stream_parser.ijson = parser
+                store, next_link = stream_parser.parse_things_page(io.BytesIO(json.dumps({"value": things}).encode()),
+                                                                   low_memory=True)
+                self.assertIsNone(next_link)
+                for column in ObservationStore.columns:
+                    np.testing.assert_array_equal(getattr(store, column), getattr(expected, column))
+                self.assertEqual(store.symbols, expected.symbols)
+        finally:
+            stream_parser.ijson = ijson
+
+    def test_concat(self):
+        store = ObservationStore.from_things(things_test)
+        lux = copy.deepcopy(things_test[:1])
+        lux[0]['Datastreams'][0]['unitOfMeasurement']['symbol'] = 'lux'
+        joined = ObservationStore.concat([ObservationStore.from_things(lux), store])
+        self.assertEqual(len(joined), 3)
+        self.assertEqual([joined.symbols[unit] for unit in joined.unit.tolist()], ['lux', 'degC', 'degC'])
+
+
+class TestPrefilter(unittest.TestCase):
+
+    def test_simple_condition(self):
+        store = ObservationStore.from_things(things_test)
+        condition = compile_conditions({">": ["Temperature", 25]})
+        self.assertEqual(condition.filter_store(store, 'Temperature').observation_id.tolist(), [102])
+        self.assertEqual([t['@iot.id'] for t in condition.filter_things(things_test, 'Temperature')], [2])
+
+    def test_nested_conditions(self):
+        store = ObservationStore.from_things(things_test)
+        # Luminosity is not in the batch: it can match, so only the Temperature statements filter
+        condition = compile_conditions({"and": [{"!": {"<": ["Temperature", 25]}}, {">": ["Luminosity", 100]}]})
+        self.assertEqual(condition.variables, ['Temperature', 'Luminosity'])
+        self.assertEqual(condition.filter_store(store, 'Temperature').observation_id.tolist(), [102])
+        condition = compile_conditions({"or": [{">": ["Temperature", 25]}, {">": ["Luminosity", 100]}]})
+        self.assertEqual(len(condition.filter_store(store, 'Temperature')), 2)
+
+    def test_negated_unknowns(self):
+        store = ObservationStore.from_things(things_test)
+        # with Luminosity unknown the conjunction may be false for every observation, so its negation may be true
+        condition = compile_conditions({"!": {"and": [{"<": ["Temperature", 25]}, {">": ["Luminosity", 100]}]}})
+        self.assertEqual(condition.filter_store(store, 'Temperature').observation_id.tolist(), [101, 102])
+        condition = compile_conditions({"!": {"or": [{"<": ["Temperature", 25]}, {">": ["Luminosity", 100]}]}})
+        self.assertEqual(condition.filter_store(store, 'Temperature').observation_id.tolist(), [102])
+
+    def test_string_conditions(self):
+        store = ObservationStore.from_things(things_test)
+        # results are stored as floats: a string condition cannot be evaluated, every observation may match
+        condition = compile_conditions({"==": ["Temperature", "N"]})
+        self.assertEqual(len(condition.filter_store(store, 'Temperature')), 2)
+        self.assertEqual(len(condition.filter_things(things_test, 'Temperature')), 2)
+        self.assertEqual(condition.mask({'Temperature': np.array(['N', 'S'], dtype=object)}, 2).tolist(),
+                         [True, False])
+
+
+class TestFetchPlanner(unittest.TestCase):
+
+    def test_shared_fetch_and_routing(self):
+        planner = FetchPlanner('http://localhost/v1.0')
+        events = []
+        for extent in ("POLYGON((-3.81 43.44, -3.795 43.44, -3.795 43.47, -3.81 43.47, -3.81 43.44))",
+                       "POLYGON((-3.805 43.44, -3.78 43.44, -3.78 43.47, -3.805 43.47, -3.805 43.44))"):
+            new_definition = copy.deepcopy(definition)
+            new_definition['properties']['spatial']['extent'] = extent
+            events.append(ge.GEvent(new_definition))
+            planner.add(events[-1])
+
+        groups = planner.groups()
+        self.assertEqual(list(groups), ['Temperature'])
+        self.assertEqual(len(groups['Temperature'].requests), 1)
+        self.assertIn('-3.81', groups['Temperature'].requests[0])
+        self.assertIn('-3.78', groups['Temperature'].requests[0])
+
+        routed = groups['Temperature'].route(things_test)
+        self.assertEqual(routed[events[0].id_], [things_test[0]])
+        self.assertEqual(routed[events[1].id_], things_test)
+        stores = groups['Temperature'].route_store(ObservationStore.from_things(things_test))
+        self.assertEqual(stores[events[0].id_].thing_id.tolist(), [1])
+
+        planner.remove(events[1])
+        self.assertEqual(list(planner.groups()['Temperature'].events), [events[0].id_])
+
+    def test_disjoint_extents(self):
+        # the area between the extents is not requested
+        planner = FetchPlanner('http://localhost/v1.0')
+        cover = planner.cover_extents(["POLYGON((0 0, 1 0, 1 1, 0 1, 0 0))", "POLYGON((5 0, 6 0, 6 1, 5 1, 5 0))"])
+        self.assertEqual(len(cover), 2)
+        self.assertFalse(any(ge.wkt.loads(polygon).intersects(ge.shapely.Point(3, 0.5)) for polygon in cover))
+
+    def test_routed_generator(self):
+        events = []
+        for extent, threshold in (("POLYGON((-3.81 43.44, -3.795 43.44, -3.795 43.47, -3.81 43.47, -3.81 43.44))", 0),
+                                  ("POLYGON((-3.805 43.44, -3.78 43.44, -3.78 43.47, -3.805 43.47, -3.805 43.44))", 25)):
+            new_definition = copy.deepcopy(definition)
+            new_definition['properties']['spatial']['extent'] = extent
+            new_definition['properties']['attributive']['conditions'] = {'>': ['Temperature', threshold]}
+            events.append(ge.GEvent(new_definition).compile())
+        receivers = [TestDelivery.Receiver(failures=0), TestDelivery.Receiver(failures=0)]
+        routes = {event.id_: (receiver, event.condition, None) for event, receiver in zip(events, receivers)}
+        generator = ge.StreamGenerator(list(things_test), '2100-01-01T00:00:00Z', None, batch_size=100,
+                                       routes=routes, router=ge.ExtentIndex(events))
+        generator.stream_to_cep()
+        received = [[event['event']['metaData']['observation_id'] for event in json.loads(receiver.received[0])]
+                    for receiver in receivers]
+        # thing 2 is outside the first extent, and the result of thing 1 is below the threshold of the second event
+        self.assertEqual(received, [[101], [102]])
+
+        # events sharing a receiver: thing 1 is in both extents and is pushed once
+        shared = TestDelivery.Receiver(failures=0)
+        generator.routes = {event.id_: (shared, None, None) for event in events}
+        generator.stream_to_cep()
+        self.assertEqual(sorted(event['event']['metaData']['observation_id'] for event in json.loads(shared.received[0])),
+                         [101, 102])
+
+
+class TestLocalCep(unittest.TestCase):
+
+    def test_filter_to_json_logic(self):
+        statement = local_cep.filter_to_json_logic("Temperature > -1000 and not (meta_symbol == 'degC')")
+        self.assertEqual(statement, {"and": [{">": [{"var": "Temperature"}, -1000]}, {"!": {"==": [{"var": "meta_symbol"}, "degC"]}}]})
+
+    def test_geo_within(self):
+        statement = local_cep.filter_to_json_logic(
+            "x_coord >= 0 and geo:within(x_coord, y_coord, '{\"type\":\"Polygon\",\"coordinates\":[[[0,0],[1,0],[0,1],[0,0]]]}')")
+        self.assertEqual(statement['and'][1]['geo:within'][:2], [{"var": "x_coord"}, {"var": "y_coord"}])
+        mask = compile_conditions(statement).mask({'x_coord': np.array([0.2, 0.8]), 'y_coord': np.array([0.2, 0.8])}, 2)
+        self.assertEqual(mask.tolist(), [True, False])
+
+    def test_shared_stream_extent(self):
+        # the bounding box of the triangle contains both things, the triangle only the first one
+        triangle = copy.deepcopy(definition)
+        triangle['properties']['spatial']['extent'] = "POLYGON((-3.81 43.44, -3.78 43.44, -3.81 43.47, -3.81 43.44))"
+        triangle['properties']['attributive']['conditions'] = {">": ["Temperature", 0]}
+        registry = ge.SharedStreamRegistry(conf["geosmart.sys"]["cep"])
+        handler = ge.EventHandler(ge.GEvent(triangle), conf, shared_streams=registry)
+        notifications = []
+        engine = local_cep.LocalCEP(notify=lambda publisher, events: notifications.extend(events))
+        engine.deploy_configuration(handler.prepare_cep_configuration('http://localhost:80'))
+        self.assertIn('geo:within', handler.prepare_cep_configuration('http://localhost:80')['plans'][0])
+        # preparing the files again does not duplicate the receivers of the event
+        self.assertEqual(handler.receiver_endpoints, [registry.receiver_endpoint('Temperature')])
+
+        events = cep.EventMapper(ge.StreamGenerator.stream_definition).map_things(things_test, 'g1')
+        engine.send('httpReceiver' + registry.receiver_id('Temperature'), cep.EventMapper.encode_batch(events))
+        self.assertEqual([event['event']['metaData']['observation_id'] for event in notifications], [101])
+
+    def test_event_detection(self):
+        hot_day = copy.deepcopy(definition)
+        hot_day['properties']['attributive']['conditions'] = {">": ["Temperature", 25]}
+        handler = ge.EventHandler(ge.GEvent(hot_day), conf)
+        notifications = []
+        engine = local_cep.LocalCEP(notify=lambda publisher, events: notifications.extend(events))
+        engine.deploy_configuration(handler.prepare_cep_configuration('http://localhost:80'))
+        # publish to the ui buffer instead of the http target
+        engine.publishers = {name: (stream, 'ui', url) for name, (stream, type_, url) in engine.publishers.items()}
+
+        events = cep.EventMapper(ge.StreamGenerator.stream_definition).map_things(things_test, 'g1')
+        receiver = engine.receiver('httpReceiver' + handler.event_id + '1')
+        self.assertEqual(receiver.send(cep.EventMapper.encode_batch(events)), 200)
+        self.assertEqual(len(notifications), 1, 'Only one observation is above the threshold')
+        self.assertEqual(notifications[0]['event']['metaData']['observation_id'], 102)
+
+
+    def test_composite_event_detection(self):
+        with open(file_dir + '/composite_event_def.json') as composite_file:
+            composite = json.load(composite_file)
+        composite['properties']['attributive']['conditions'] = {"and": [{">": ["Temperature", 25]}, {"<": ["Luminosity", 3]}]}
+        handler = ge.EventHandler(ge.GEvent(composite), conf)
+        configuration = handler.prepare_cep_configuration('http://localhost:80')
+        self.assertEqual(len(configuration['plans']), 1, 'A composite event is detected by a single plan')
+        notifications = []
+        engine = local_cep.LocalCEP(notify=lambda publisher, events: notifications.extend(events))
+        engine.deploy_configuration(configuration)
+
+        dark = copy.deepcopy(things_test[:1])
+        dark[0]['Datastreams'][0]['Observations'][0]['result'] = 1.5
+        temperature = cep.EventMapper(configuration['streams'][0]).map_things(things_test, 'g1')
+        luminosity = cep.EventMapper(configuration['streams'][1]).map_things(dark, 'g2')
+        engine.send('httpReceiver' + handler.event_id + '1', cep.EventMapper.encode_batch(temperature))
+        self.assertEqual(notifications, [], 'Luminosity was not observed yet')
+        engine.send('httpReceiver' + handler.event_id + '2', cep.EventMapper.encode_batch(luminosity))
+        self.assertEqual(len(notifications), 1, 'Only one observation is above the threshold')
+        self.assertEqual(notifications[0]['event']['payloadData']['Temperature'], 27.0)
+        self.assertEqual(notifications[0]['event']['payloadData']['Luminosity'], 1.5)
+
+    def test_composite_event_disjunction(self):
+        with open(file_dir + '/composite_event_def.json') as composite_file:
+            composite = json.load(composite_file)
+        composite['properties']['attributive']['conditions'] = {"or": [
+            {">": ["Temperature", 25]}, {"and": [{"<": ["Luminosity", 3]}, {">": ["Humidity", 80]}]}]}
+        handler = ge.EventHandler(ge.GEvent(composite), conf)
+        configuration = handler.prepare_cep_configuration('http://localhost:80')
+        self.assertIn('full outer join', configuration['plans'][0])
+        self.assertIn('on e1.Temperature > 25 or e2.Luminosity < 3', configuration['plans'][0],
+                      'Intermediate joins are restricted to the phenomena joined so far')
+        notifications = []
+        engine = local_cep.LocalCEP(notify=lambda publisher, events: notifications.extend(events))
+        engine.deploy_configuration(configuration)
+
+        def send(position, result):
+            things = copy.deepcopy(things_test[:1])
+            things[0]['Datastreams'][0]['Observations'][0]['result'] = result
+            events = cep.EventMapper(configuration['streams'][position - 1]).map_things(things, 'g' + str(position))
+            engine.send('httpReceiver' + handler.event_id + str(position), cep.EventMapper.encode_batch(events))
+
+        engine.send('httpReceiver' + handler.event_id + '1', cep.EventMapper.encode_batch(
+            cep.EventMapper(configuration['streams'][0]).map_things(things_test, 'g1')))
+        self.assertEqual(len(notifications), 1, 'Temperature alone satisfies the condition')
+        payload = notifications[0]['event']['payloadData']
+        self.assertEqual((payload['Temperature'], payload['Luminosity'], payload['Humidity']), (27.0, None, None))
+        self.assertEqual(notifications[0]['event']['metaData']['observation_id'], 102)
+        send(2, 1.5)
+        self.assertTrue(all(event['event']['payloadData']['Temperature'] == 27.0 for event in notifications),
+                        'Luminosity alone does not satisfy the condition')
+        send(3, 85)
+        payloads = [(event['event']['payloadData']['Temperature'], event['event']['payloadData']['Luminosity'],
+                     event['event']['payloadData']['Humidity']) for event in notifications]
+        self.assertIn((21.5, 1.5, 85), payloads, 'Luminosity and humidity satisfy the condition')
+
+    def test_composite_event_intermediate_joins(self):
+        with open(file_dir + '/composite_event_def.json') as composite_file:
+            composite = json.load(composite_file)
+        composite['properties']['attributive']['conditions'] = {"and": [
+            {">": ["Temperature", 25]}, {"<": ["Luminosity", 3]}, {"!": [{">": ["Humidity", 80]}]}]}
+        handler = ge.EventHandler(ge.GEvent(composite), conf)
+        plan = handler.prepare_cep_configuration('http://localhost:80')['plans'][0]
+        self.assertIn('as e2 on e1.Temperature > 25 and e2.Luminosity < 3 select', plan)
+        self.assertIn('as e3 on j2.Temperature > 25 and j2.Luminosity < 3 and not (e3.Humidity > 80) select', plan)
+        self.assertNotIn('outer', plan)
+        self.assertEqual(cep.partial_condition(composite['properties']['attributive']['conditions'], ['Humidity']),
+                         {"!": [{">": ["Humidity", 80]}]})
+        self.assertIsNone(cep.partial_condition({"!": [{"and": [{">": ["Humidity", 80]}, {"<": ["Luminosity", 3]}]}]},
+                                                ['Humidity']), 'Negation of an unknown conjunction is unknown')
+
+
+class TestDelivery(unittest.TestCase):
+
+    class Receiver:
+        """ In-process receiver failing its first posts"""
+        def __init__(self, failures):
+            self.failures = failures
+            self.received = []
+
+        def send(self, payload):
+            if self.failures > 0:
+                self.failures -= 1
+                raise ConnectionError('receiver is down')
+            self.received.append(payload)
+            return 200
+
+    def test_retries(self):
+        receiver = self.Receiver(failures=2)
+        delivery = DeliveryQueue(receiver, workers=1, max_retries=3, backoff=0.001)
+        done = []
+        self.assertTrue(delivery.submit(b'[{}]', 1, done.append))
+        self.assertTrue(delivery.join(5))
+        stats = delivery.stats()
+        delivery.close()
+        self.assertEqual(receiver.received, [b'[{}]'])
+        self.assertEqual(done, [200])
+        self.assertEqual((stats["delivered"], stats["retries"], stats["failed"]), (1, 2, 0))
+        self.assertEqual(stats["circuit"], 'closed')
+
+    def test_circuit_breaker(self):
+        receiver = self.Receiver(failures=1000)
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        delivery = DeliveryQueue(receiver, max_queue=2, workers=1, max_retries=0, breaker=breaker)
+        for _ in range(2):
+            delivery.submit(b'[{}]', 1)
+            delivery.join(5)
+        self.assertEqual(breaker.state, 'open')
+        # the worker waits for the breaker: the queue fills up and new events are dropped
+        accepted = [delivery.submit(b'[{}]', 1) for _ in range(5)]
+        self.assertIn(False, accepted)
+        self.assertEqual(receiver.failures, 998, 'No posts while the circuit is open')
+        delivery.close(0.1)
+        stats = delivery.stats()
+        self.assertEqual(stats["delivered"], 0)
+        self.assertEqual(stats["submitted"] + accepted.count(False), 7)
+        self.assertEqual(stats["failed"] + stats["dropped"], 7)
+
+    def test_close_half_open(self):
+        probing, release = threading.Event(), threading.Event()
+
+        class SlowReceiver:
+            def send(self, payload):
+                probing.set()
+                release.wait(5)
+                return 200
+
+        class CountingBreaker(CircuitBreaker):
+            calls = 0
+
+            def allow(self):
+                self.calls += 1
+                return CircuitBreaker.allow(self)
+
+        breaker = CountingBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()  # the next post is a probe
+        delivery = DeliveryQueue(SlowReceiver(), workers=2, breaker=breaker)
+        delivery.submit(b'[{}]', 1)
+        self.assertTrue(probing.wait(5))
+        delivery.submit(b'[{}]', 1)  # waits for the probe
+        time.sleep(0.1)
+        timer = threading.Timer(0.3, release.set)
+        timer.start()
+        delivery.close(0.1)
+        timer.join()
+        self.assertLess(breaker.calls, 20, 'The worker waiting for the probe spins on close')
+        stats = delivery.stats()
+        self.assertEqual((stats["delivered"], stats["failed"]), (1, 1))
+
+    def test_batch_splitting(self):
+        events = [{"v": 10 + i} for i in range(7)]  # 8 bytes each, encoded
+
+        receiver = self.Receiver(failures=0)
+        batcher = ge.EventBatcher(receiver, max_events=3, max_bytes=1024, flush_interval=None)
+        for event in events:
+            batcher.add(event)
+        self.assertEqual(len(receiver.received), 2, 'Full batches are sent as events are added')
+        results = batcher.join()
+        self.assertEqual([size for size, _ in results], [3, 3, 1])
+        self.assertEqual([status for _, status in results], [200, 200, 200])
+        self.assertEqual([event for payload in receiver.received for event in json.loads(payload)], events)
+
+        receiver = self.Receiver(failures=0)
+        batcher = ge.EventBatcher(receiver, max_events=100, max_bytes=25, flush_interval=None)
+        for event in events:
+            batcher.add(event)
+        batcher.join()
+        self.assertEqual([len(json.loads(payload)) for payload in receiver.received], [2, 2, 2, 1])
+        self.assertTrue(all(len(payload) <= 25 for payload in receiver.received), 'Batches exceed max_bytes')
+        self.assertEqual([event for payload in receiver.received for event in json.loads(payload)], events)
+
+        receiver = self.Receiver(failures=0)
+        batcher = ge.EventBatcher(receiver, max_events=100, max_bytes=25, flush_interval=None)
+        batcher.add({"v": 10})
+        batcher.add({"text": "x" * 40})
+        batcher.add({"v": 11})
+        batcher.join()
+        self.assertEqual([len(json.loads(payload)) for payload in receiver.received], [1, 1, 1],
+                         'An event larger than max_bytes is sent alone')
+
+
+class TestBuffer(unittest.TestCase):
+
+    extent = "POLYGON((-3.81 43.44, -3.78 43.44, -3.78 43.47, -3.81 43.47, -3.81 43.44))"
+
+    def test_add_time_filter(self):
+        request = ge.prepare_observations_request('http://localhost/v1.0', self.extent, 'Temperature')
+        filtered = ge.add_time_filter(request, '2018-01-10T10:00:00.000Z')
+        self.assertIn("name eq 'Temperature' and Datastreams/Observations/phenomenonTime gt "
+                      "2018-01-10T10:00:00.000Z&$select=", filtered)
+        self.assertIn("$expand=Observations($filter=phenomenonTime gt 2018-01-10T10:00:00.000Z;$orderby", filtered)
+
+    def test_drop_seen(self):
+        request = ge.prepare_observations_request('http://localhost/v1.0', self.extent, 'Temperature')
+        buffer = ge.Buffer(request, 10, prefetch=False, incremental=True)
+        self.assertEqual(len(list(buffer._drop_seen(things_test))), 2)
+        # observations are dropped once they are confirmed as pushed, not when they are fetched
+        self.assertEqual(len(list(buffer._drop_seen(things_test))), 2)
+        self.assertEqual(buffer._next_request(), request)
+        buffer.confirm([101])
+        self.assertEqual([thing['@iot.id'] for thing in buffer._drop_seen(things_test)], [2])
+        self.assertIn('phenomenonTime gt 2018-01-10T10:00:00.000Z', buffer._next_request())
+
+        newer = copy.deepcopy(things_test[0])
+        newer['Datastreams'][0]['Observations'][0].update({"@iot.id": 103,
+                                                           "phenomenonTime": "2018-01-10T10:10:00.000Z"})
+        self.assertEqual([thing['@iot.id'] for thing in buffer._drop_seen([newer, things_test[1]])], [1, 2])
+        buffer.confirm()
+        self.assertEqual(list(buffer._drop_seen([newer] + things_test)), [])
+
+    def test_interleaved_confirms(self):
+        request = ge.prepare_observations_request('http://localhost/v1.0', self.extent, 'Temperature')
+        newer = copy.deepcopy(things_test[0])
+        newer['Datastreams'][0]['Observations'][0].update({"@iot.id": 103,
+                                                           "phenomenonTime": "2018-01-10T10:10:00.000Z"})
+        for order in ([[101, 102], [103]], [[103], [101, 102]]):
+            buffer = ge.Buffer(request, 10, prefetch=False, incremental=True)
+            list(buffer._drop_seen(things_test))  # first update, pushed and not confirmed yet
+            list(buffer._drop_seen([newer]))  # second update, with a newer observation of the same Datastream
+            buffer.confirm(order[0])
+            buffer.confirm(order[1])  # the confirmation of the other update arrives late
+            self.assertEqual(sorted(last[1] for last in buffer.last_seen.values()), [102, 103])
+            self.assertEqual(list(buffer._drop_seen([newer] + things_test)), [], 'Confirmed observations are pushed again')
+            self.assertEqual((buffer._pending, buffer._pending_ids), ({}, {}))
+
+        buffer = ge.Buffer(request, 10, prefetch=False, incremental=True)
+        list(buffer._drop_seen(things_test))
+        list(buffer._drop_seen([newer]))
+        buffer.confirm([101])
+        self.assertEqual(buffer.last_seen[11][1], 101, 'The confirmation of the first update is not lost')
+        self.assertEqual([thing['@iot.id'] for thing in buffer._drop_seen([newer] + things_test)], [1, 2])
+
+    def test_stale_datastreams(self):
+        request = ge.prepare_observations_request('http://localhost/v1.0', self.extent, 'Temperature')
+        buffer = ge.Buffer(request, 10, prefetch=False, incremental=True, stale_after=60)
+        list(buffer._drop_seen(things_test))
+        buffer.confirm()
+        # the sensor of Datastream 11 stopped reporting five minutes before the newest observation
+        self.assertIn('phenomenonTime gt 2018-01-10T10:05:00.000Z', buffer._next_request())
+        self.assertEqual(list(buffer.last_seen), [12])
+        self.assertEqual(ge.Buffer(request, 10, prefetch=False).stale_after, 100)
+
+    def test_streamed_pages(self):
+        # without updates, every push streams the pages of the Sensor API through the pipeline
+        with FakeSensorApi(make_things(450)) as api:
+            request = ge.prepare_observations_request('http://localhost/v1.0', self.extent, 'Temperature')
+            buffer = ge.Buffer(request, 10, prefetch=False, incremental=True)
+            receiver = TestDelivery.Receiver(failures=0)
+            generator = ge.StreamGenerator(buffer, '2100-01-01T00:00:00Z', receiver, batch_size=100)
+            generator.stream_to_cep()
+        self.assertEqual(len(api.requests), 3)
+        self.assertEqual(generator.pipeline_stats['fetch']['items'], 3)
+        self.assertEqual(sum(size for size, status in generator.batch_results), 450)
+        self.assertEqual(len(buffer.last_seen), 450)
+
+    def test_confirm_after_push(self):
+        request = ge.prepare_observations_request('http://localhost/v1.0', self.extent, 'Temperature')
+        buffer = ge.Buffer(request, 10, prefetch=False, incremental=True)
+        receiver = TestDelivery.Receiver(failures=1)
+        generator = ge.StreamGenerator(buffer, '2100-01-01T00:00:00Z', receiver, batch_size=100)
+        buffer.data = list(buffer._drop_seen(things_test))
+        generator.stream_to_cep()
+        self.assertIsInstance(generator.batch_results[0][1], ConnectionError)
+        self.assertEqual(buffer.last_seen, {}, 'Observations of a failed push are fetched again')
+        buffer.data = list(buffer._drop_seen(things_test))
+        self.assertEqual(len(buffer.data), 2)
+        generator.stream_to_cep()
+        self.assertEqual(len(receiver.received), 1)
+        self.assertEqual(sorted(last[1] for last in buffer.last_seen.values()), [101, 102])
+        self.assertEqual(list(buffer._drop_seen(things_test)), [])
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_stages_overlap(self):
+        def fetch():
+            for page in range(5):
+                time.sleep(0.02)
+                yield page
+        pushed = []
+        pipeline = Pipeline([('map', lambda page: (time.sleep(0.02), [[page * 10]])[1]),
+                             ('push', lambda events: (time.sleep(0.02), pushed.extend(events))[1])])
+        stats = pipeline.run(fetch())
+        self.assertEqual(pushed, [0, 10, 20, 30, 40])
+        self.assertEqual([stats[name]['items'] for name in ('fetch', 'map', 'push')], [5, 5, 5])
+        self.assertLess(pipeline.elapsed, 0.25, 'Stages did not overlap')
+
+    def test_stage_failure(self):
+        def fail(page):
+            raise ValueError('bad page')
+        with self.assertRaises(ValueError):
+            Pipeline([('map', fail), ('push', lambda events: None)]).run(range(100))
+
+    def test_generator_pipeline(self):
+        receiver = TestDelivery.Receiver(failures=0)
+        things = (things_test[i % 2] for i in range(250))  # two pages of Things
+        generator = ge.StreamGenerator(things, '2100-01-01T00:00:00Z', receiver, batch_size=100)
+        generator.stream_to_cep()
+        self.assertEqual(sum(size for size, status in generator.batch_results), 250)
+        self.assertEqual(len(receiver.received), 3)
+        self.assertEqual(generator.pipeline_stats['push']['items'], 2)
+
+
+class TestJsonCodec(unittest.TestCase):
+
+    def test_codecs(self):
+        event = {"event": {"metaData": {"observation_id": 101, "result_time": "2018-01-10T10:00:00.000Z", "symbol": "degC"}, "correlationData": {"event_id": "g1"}, "payloadData": {"Temperature": 21.5, "x_coord": -3.8, "y_coord": 43.45}}}
+        for name, codec in json_codec.codecs.items():
+            encoded = codec.dumps(event)
+            self.assertIsInstance(encoded, bytes, name)
+            self.assertEqual(codec.loads(encoded), event, name)
+            self.assertEqual(codec.loads(encoded.decode('utf-8')), event, name)
+        self.assertIs(json_codec.configure('stdlib'), json_codec.StdlibCodec)
+        self.assertEqual(json_codec.loads(json_codec.dumps([event])), [event])
+        json_codec.configure('auto')
+        with self.assertRaises(ValueError):
+            json_codec.configure('ujson')
+
+    def test_not_finite_values(self):
+        # non numeric results are stored as NaN: every codec encodes them as null, producing valid JSON
+        payload = {"payloadData": {"Temperature": float('nan'), "x_coord": float('inf'), "y_coord": 43.45}}
+        for name, codec in json_codec.codecs.items():
+            self.assertEqual(json.loads(codec.dumps([payload])),
+                             [{"payloadData": {"Temperature": None, "x_coord": None, "y_coord": 43.45}}], name)
+
+
+class TestHttpClient(unittest.TestCase):
+
+    def test_sessions_of_finished_threads(self):
+        client = http_client.HttpClient()
+        for _ in range(10):  # as stream_to_cep, a new executor on every call
+            with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+                sessions = list(executor.map(lambda _: client.session(), range(8)))
+            self.assertLessEqual(len(set(map(id, sessions))), 4)  # one session per worker thread
+            self.assertIs(sessions[0].get_adapter('http://localhost'), client.session().get_adapter('http://localhost'))
+            del sessions
+        gc.collect()
+        self.assertEqual(client.stats()["sessions"], 1)  # only the session of this thread is left
+        client.close()
+
+
+class TestScheduler(unittest.TestCase):
+
+    def test_periodic_and_one_off_tasks(self):
+        runs = []
+        tasks = scheduler.Scheduler(tick=0.01, wheel_size=8, workers=2)
+        periodic = tasks.schedule_periodic('periodic', 0.05, lambda: runs.append('periodic'))
+        tasks.schedule_after('once', 0.12, lambda: tasks.cancel(periodic))
+        tasks.start()
+        time.sleep(0.3)
+        tasks.stop()
+        self.assertIn(runs.count('periodic'), [2, 3], 'Periodic task did not run at its interval')
+        self.assertEqual(tasks.stats(), {}, 'Cancelled and one-off tasks should not remain scheduled')
+
+    def test_missed_deadlines(self):
+        tasks = scheduler.Scheduler(tick=0.01, workers=1)
+        slow = tasks.schedule_periodic('slow', 0.02, lambda: time.sleep(0.1), delay=0)
+        tasks.start()
+        time.sleep(0.25)
+        tasks.stop()
+        self.assertGreater(slow.missed, 0, 'Deadlines reached while the task is running should be counted as missed')
+
+
+
+class TestLifecycle(unittest.TestCase):
+
+    class Runtime:
+        def __init__(self):
+            self.calls = []
+
+        def activate(self, event, scheduler, until):
+            self.calls.append(('activate', event.id_, until))
+            return {}
+
+        def deactivate(self, event, scheduler, resources):
+            self.calls.append(('deactivate', event.id_))
+
+    def test_shared_streams_of_active_events(self):
+        with tempfile.TemporaryDirectory() as home:
+            runtime_conf = copy.deepcopy(conf)
+            cep_cof = runtime_conf["geosmart.sys"]["cep"]
+            cep_cof.update({"deployer": "local", "local home directory": home, "root url": "http://127.0.0.1:9"})
+            make_cep_home(home)
+            index = ge.ExtentIndex()
+            runtime = EventRuntime(runtime_conf, 'http://localhost/v1.0', 'http://localhost:80', ready_timeout=0,
+                                   extent_index=index)
+            tasks = scheduler.Scheduler()
+            until = ge.datetime.datetime(2100, 1, 1, tzinfo=ge.datetime.timezone.utc)
+            events = []
+            for extent in ("POLYGON((0 0, 1 0, 1 1, 0 1, 0 0))", "POLYGON((5 0, 6 0, 6 1, 5 1, 5 0))"):
+                new_definition = copy.deepcopy(definition)
+                new_definition['properties']['spatial']['extent'] = extent
+                events.append(ge.GEvent(new_definition).compile())
+            resources = []
+            for event in events:
+                index.add(event)
+                resources.append(runtime.activate(event, tasks, until))
+
+            streams = runtime.streams()
+            self.assertEqual(list(streams), ['Temperature'])
+            buffer, generator = streams['Temperature']
+            self.assertEqual(len(buffer.request), 2, 'One request per extent')
+            self.assertEqual(set(generator.routes), {event.id_ for event in events})
+            self.assertEqual(len([name for name in tasks.tasks if name.startswith('stream-')]), 1)
+
+            runtime.deactivate(events[0], tasks, resources[0])
+            self.assertEqual(list(generator.routes), [events[1].id_])
+            self.assertEqual(len(buffer.request), 1)
+            runtime.deactivate(events[1], tasks, resources[1])
+            self.assertEqual(runtime.streams(), {})
+            self.assertEqual(tasks.tasks, {})
+            self.assertEqual(os.listdir(home + cep_cof['plan subdir']), [])
+
+    def test_delivery_queue_per_receiver(self):
+        with tempfile.TemporaryDirectory() as home:
+            runtime_conf = copy.deepcopy(conf)
+            cep_cof = runtime_conf["geosmart.sys"]["cep"]
+            cep_cof.update({"deployer": "local", "local home directory": home, "root url": "http://127.0.0.1:9"})
+            make_cep_home(home)
+            runtime = EventRuntime(runtime_conf, 'http://localhost/v1.0', 'http://localhost:80', ready_timeout=0,
+                                   shared_streams=ge.SharedStreamRegistry(cep_cof),
+                                   delivery_conf={"workers": 1}, extent_index=ge.ExtentIndex())
+            tasks = scheduler.Scheduler()
+            until = ge.datetime.datetime(2100, 1, 1, tzinfo=ge.datetime.timezone.utc)
+            events = [ge.GEvent(definition).compile(), ge.GEvent(definition).compile()]
+            resources = [runtime.activate(event, tasks, until) for event in events]
+
+            # both events push to the shared receiver of Temperature, through a single queue and circuit breaker
+            deliveries = runtime.deliveries()
+            self.assertEqual(len(deliveries), 1)
+            generator = runtime.streams()['Temperature'][1]
+            self.assertEqual({route[2] for route in generator.routes.values()}, set(deliveries.values()))
+
+            runtime.deactivate(events[0], tasks, resources[0])
+            self.assertEqual(runtime.deliveries(), deliveries, 'The queue is still used by the second event')
+            runtime.deactivate(events[1], tasks, resources[1])
+            self.assertEqual(runtime.deliveries(), {})
+
+    def test_activation_in_time_and_validity(self):
+        utc = ge.datetime.timezone.utc
+        runtime = self.Runtime()
+        tasks = scheduler.Scheduler()
+        index = ge.ExtentIndex()
+        manager = LifecycleManager(tasks, runtime, index)
+        # time and validity of the test event intersect on 2016-11-24, from 10:00 to 11:00
+        active, future, expired = ge.GEvent(definition), ge.GEvent(definition), ge.GEvent(definition)
+        self.assertEqual(manager.add(active, now=ge.datetime.datetime(2016, 11, 24, 10, 30, tzinfo=utc)), 'active')
+        self.assertEqual(runtime.calls, [('activate', active.id_, ge.datetime.datetime(2016, 11, 24, 11, tzinfo=utc))])
+        self.assertEqual(manager.add(future, now=ge.datetime.datetime(2016, 11, 24, 9, tzinfo=utc)), 'scheduled')
+        self.assertIn('activate-' + future.id_, tasks.tasks)
+        self.assertEqual(manager.add(expired, now=ge.datetime.datetime(2017, 1, 1, tzinfo=utc)), 'expired')
+        self.assertEqual(len(runtime.calls), 1, 'Expired events should not be activated')
+        self.assertEqual(manager.stats(), {'scheduled': 1, 'active': 1, 'expired': 1, 'failed': 0})
+        self.assertEqual([event.id_ for event in index.events_at(-3.80, 43.45)], [active.id_])
+
+        manager.remove(active)
+        self.assertEqual(runtime.calls[-1], ('deactivate', active.id_))
+        self.assertEqual(manager.active(), [])
+        self.assertEqual(len(index), 0)
+
+
 if __name__ == '__main__':
     unittest.main()
 